@@ -2,7 +2,7 @@ import asyncio
 import base64
 import logging
 import os
-from datetime import datetime, timedelta
+from datetime import datetime
 from typing import Optional, Tuple
 
 from telegram import (
@@ -23,7 +23,8 @@ from telegram.ext import (
     filters,
 )
 
-from database import Database
+from database import AsyncDatabase
+from bot.broadcast import DeliveryRecorder, broadcast
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
@@ -61,13 +62,13 @@ def _decrypt_token() -> str:
 class AdminBot:
     def __init__(self):
         self.token = _decrypt_token()
-        self.db = Database()
+        self.db = AsyncDatabase()
 
     # ===== Helpers =====
-    def _ensure_owner(self, update: Update) -> int:
+    async def _ensure_owner(self, update: Update) -> int:
         tg_user = update.effective_user
         full_name = f"{tg_user.first_name or ''} {tg_user.last_name or ''}".strip()
-        return self.db.upsert_system_user_from_telegram(tg_user.id, tg_user.username or "", full_name)
+        return await self.db.upsert_system_user_from_telegram(tg_user.id, tg_user.username or "", full_name)
 
     async def _send_owner_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         keyboard = [
@@ -79,7 +80,7 @@ class AdminBot:
 
     # ===== Commands =====
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        owner_id = self._ensure_owner(update)
+        owner_id = await self._ensure_owner(update)
         await update.message.reply_text(f"Админ-бот готов. Ваш ID: {owner_id}")
         await self._send_owner_menu(update, context)
 
@@ -99,19 +100,20 @@ class AdminBot:
             await query.edit_message_text("Пришлите токен вашего бота:")
             return ADD_BOT_WAIT_TOKEN
         if data == "stats":
-            owner_id = self._ensure_owner(update)
-            # Подписчики
-            total = self.db.get_total_subscribers_count(owner_id)
-            day_ago = (datetime.now() - timedelta(days=1)).isoformat()
-            week_ago = (datetime.now() - timedelta(days=7)).isoformat()
-            new_24h = self.db.get_new_subscribers_count(owner_id, day_ago)
-            new_7d = self.db.get_new_subscribers_count(owner_id, week_ago)
-            text = (
-                f"Подписчики\n"
-                f"— Всего: {total}\n"
-                f"— За 24ч: +{new_24h}\n"
-                f"— За 7д: +{new_7d}\n"
-            )
+            owner_id = await self._ensure_owner(update)
+            # Подписчики и сообщения по окнам одним запросом
+            metrics = await self.db.get_dashboard_metrics(owner_id)
+            lines = [
+                f"Подписчики\n— Всего: {metrics['total_subscribers']}\n"
+                f"— Недоступны (заблокировали бота): {metrics['inactive_subscribers']}\n"
+            ]
+            for label, key in (("24ч", "24h"), ("7д", "7d"), ("30д", "30d")):
+                window = metrics[key]
+                lines.append(
+                    f"За {label}: +{window['new_subscribers']} новых, "
+                    f"{window['active_subscribers']} активных, {window['messages']} сообщений\n"
+                )
+            text = "".join(lines)
             await query.edit_message_text(text)
             return ConversationHandler.END
         if data == "welcome_file":
@@ -126,10 +128,10 @@ class AdminBot:
         return ADD_BOT_WAIT_USERNAME
 
     async def add_bot_username(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        owner_id = self._ensure_owner(update)
+        owner_id = await self._ensure_owner(update)
         bot_token = context.user_data.pop("tmp_bot_token", "")
         bot_username = update.message.text.strip().lstrip("@")
-        ok = self.db.update_user_bot_token(owner_id, bot_token, bot_username)
+        ok = await self.db.update_user_bot_token(owner_id, bot_token, bot_username)
         if ok:
             await update.message.reply_text("Бот добавлен. Можно создавать рассылки.")
         else:
@@ -160,7 +162,7 @@ class AdminBot:
         return BROADCAST_WAIT_SCHEDULE
 
     async def broadcast_get_schedule(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        owner_id = self._ensure_owner(update)
+        owner_id = await self._ensure_owner(update)
         schedule_str = update.message.text.strip().lower()
         text = context.user_data.pop("bc_text", "")
         photo_file_id = context.user_data.pop("bc_photo_file_id", None)
@@ -171,7 +173,7 @@ class AdminBot:
             except Exception:
                 await update.message.reply_text("Неверный формат времени. Повторите команду /start и создайте заново.")
                 return ConversationHandler.END
-        campaign_id = self.db.create_campaign(owner_id, text, photo_file_id, scheduled_at)
+        campaign_id = await self.db.create_campaign(owner_id, text, photo_file_id, scheduled_at)
         if scheduled_at:
             await update.message.reply_text(f"Кампания #{campaign_id} запланирована на {scheduled_at}.")
         else:
@@ -185,7 +187,7 @@ class AdminBot:
         return WELCOME_WAIT_FILE
 
     async def welcome_file(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        owner_id = self._ensure_owner(update)
+        owner_id = await self._ensure_owner(update)
         caption = context.user_data.pop("welcome_caption", "")
         file_id = None
         if update.message.document:
@@ -195,7 +197,7 @@ class AdminBot:
         else:
             await update.message.reply_text("Нужно отправить документ или фото.")
             return WELCOME_WAIT_FILE
-        self.db.update_user_welcome_file_id(owner_id, file_id, caption)
+        await self.db.update_user_welcome_file_id(owner_id, file_id, caption)
         await update.message.reply_text("Приветственный файл обновлён.")
         return ConversationHandler.END
 
@@ -203,50 +205,34 @@ class AdminBot:
     async def _send_campaign(self, owner_id: int, campaign_id: int, text: Optional[str], photo_file_id: Optional[str]):
         try:
             # Получаем токен бота владельца
-            settings = self.db.get_user_settings(owner_id)
+            settings = await self.db.get_user_settings(owner_id)
             bot_token = settings.get("bot_token") or ""
             if not bot_token:
                 await asyncio.sleep(0)  # yield
-                self.db.mark_campaign_status(campaign_id, "failed")
+                await self.db.mark_campaign_status(campaign_id, "failed")
                 return
-            # Получаем подписчиков
-            users = self.db.get_users_for_bot(owner_id)
-            import requests
-            base_url = f"https://api.telegram.org/bot{bot_token}"
-            sent = 0
-            failed = 0
-            for u in users:
-                uid = u["id"]
-                try:
-                    if photo_file_id:
-                        url = f"{base_url}/sendPhoto"
-                        payload = {"chat_id": uid, "photo": photo_file_id}
-                        if text:
-                            payload["caption"] = text
-                        r = requests.post(url, data=payload, timeout=20)
-                    else:
-                        url = f"{base_url}/sendMessage"
-                        payload = {"chat_id": uid, "text": text or "", "parse_mode": "HTML"}
-                        r = requests.post(url, json=payload, timeout=20)
-                    ok = False
-                    if r.status_code == 200:
-                        resp = r.json()
-                        ok = bool(resp.get("ok"))
-                    if ok:
-                        sent += 1
-                        self.db.log_delivery(uid, owner_id, campaign_id, "success", None)
-                    else:
-                        failed += 1
-                        self.db.log_delivery(uid, owner_id, campaign_id, "failed", r.text[:200])
-                except Exception as e:
-                    failed += 1
-                    self.db.log_delivery(uid, owner_id, campaign_id, "failed", str(e)[:200])
-                await asyncio.sleep(0)  # cooperative
-            self.db.mark_campaign_status(campaign_id, "sent" if failed == 0 else "failed")
+            
+            # Итоги доставки копятся в памяти и пишутся пачками в потоке, не на event loop админ-бота
+            recorder = DeliveryRecorder(self.db.sync, campaign_id, owner_id,
+                                        totals=await self.db.get_delivery_counts(campaign_id))
+            recorder.start()
+            try:
+                sent, failed = await broadcast(
+                    bot_token,
+                    self.db.iter_recipient_ids(owner_id),
+                    on_result=recorder.add,
+                    text=text or "",
+                    photo=photo_file_id,
+                    parse_mode="HTML",
+                )
+            finally:
+                await recorder.close(final=False)
+            await self.db.compact_deliveries(campaign_id)
+            await self.db.mark_campaign_status(campaign_id, "sent" if failed == 0 else "failed")
             logger.info(f"Campaign #{campaign_id} done: sent={sent}, failed={failed}")
         except Exception as e:
             logger.error(f"Campaign #{campaign_id} error: {e}")
-            self.db.mark_campaign_status(campaign_id, "failed")
+            await self.db.mark_campaign_status(campaign_id, "failed")
 
     async def scheduler_tick(self, context: ContextTypes.DEFAULT_TYPE):
         # Функционал рассылок отключён для админ-бота
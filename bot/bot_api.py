@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Клиент Telegram Bot API
+Один клиент на токен бота с пулом keep-alive соединений к api.telegram.org:
+синхронные вызовы из веб-панели и TelegramBot не открывают новое TLS-соединение на каждое сообщение
+"""
+
+import logging
+import os
+import threading
+from typing import Dict, Optional
+
+import httpx
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+API_URL = "https://api.telegram.org"
+
+def _http2_enabled() -> bool:
+    """HTTP/2 включается настройкой и только при установленном пакете h2"""
+    if not Config.BOT_API_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        logger.warning("⚠️ BOT_API_HTTP2 включён, но пакет h2 не установлен — используем HTTP/1.1")
+        return False
+
+class BotAPIClient:
+    """Синхронный клиент Bot API для одного токена"""
+
+    def __init__(self, bot_token: str, pool_size: int = None, timeout: float = None):
+        self.bot_token = bot_token
+        pool_size = pool_size or Config.BOT_API_POOL_SIZE
+        self._client = httpx.Client(
+            base_url=f"{API_URL}/bot{bot_token}/",
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(timeout or Config.BOT_API_TIMEOUT, connect=Config.BOT_API_CONNECT_TIMEOUT),
+            http2=_http2_enabled(),
+        )
+
+    def call(self, method: str, data: Dict = None, files: Dict = None, timeout: float = None) -> Dict:
+        """Вызвать метод Bot API. Возвращает ответ Telegram как dict ({'ok': ..., 'result'/'description': ...})"""
+        kwargs = {}
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        if files:
+            response = self._client.post(method, data=data, files=files, **kwargs)
+        else:
+            response = self._client.post(method, json=data or {}, **kwargs)
+        try:
+            return response.json()
+        except ValueError:
+            return {'ok': False, 'error_code': response.status_code, 'description': response.text[:200]}
+
+    def send_message(self, chat_id: int, text: str, parse_mode: str = None) -> Dict:
+        data = {'chat_id': chat_id, 'text': text}
+        if parse_mode:
+            data['parse_mode'] = parse_mode
+        return self.call('sendMessage', data)
+
+    def send_document(self, chat_id: int, document, filename: str = None, caption: str = '',
+                      content_type: str = 'application/octet-stream') -> Dict:
+        """document — file_id (строка) или открытый файл для загрузки"""
+        data = {'chat_id': chat_id, 'caption': caption or ''}
+        if isinstance(document, str):
+            return self.call('sendDocument', {**data, 'document': document})
+        return self.call('sendDocument', data, files={'document': (filename, document, content_type)})
+
+    def get_chat(self, chat_id: int) -> Dict:
+        return self.call('getChat', {'chat_id': chat_id})
+
+    def close(self):
+        self._client.close()
+
+# Клиенты по токену; после fork (gunicorn) процесс создаёт свои соединения
+_clients: Dict[str, BotAPIClient] = {}
+_clients_pid: Optional[int] = None
+_clients_lock = threading.Lock()
+
+def get_client(bot_token: str) -> BotAPIClient:
+    """Общий клиент для токена бота"""
+    global _clients, _clients_pid
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            _clients = {}
+            _clients_pid = os.getpid()
+        client = _clients.get(bot_token)
+        if client is None:
+            client = BotAPIClient(bot_token)
+            _clients[bot_token] = client
+        return client
+
+def make_request(pool_size: int = None):
+    """HTTPXRequest для telegram.Bot с теми же пулом, таймаутами и версией HTTP"""
+    from telegram.request import HTTPXRequest
+
+    return HTTPXRequest(
+        connection_pool_size=pool_size or Config.BOT_API_POOL_SIZE,
+        connect_timeout=Config.BOT_API_CONNECT_TIMEOUT,
+        read_timeout=Config.BOT_API_TIMEOUT,
+        write_timeout=Config.BOT_API_TIMEOUT,
+        pool_timeout=Config.BOT_API_TIMEOUT,
+        http_version='2' if _http2_enabled() else '1.1',
+    )
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+Движок рассылок
+Отправляет сообщения подписчикам с ограниченным параллелизмом под лимиты Telegram Bot API:
+общий token bucket на токен бота (~30 сообщений/с) и не чаще 1 сообщения/с в один чат
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from datetime import timedelta
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from config import Config
+from bot.file_cache import FileIdCache
+
+logger = logging.getLogger(__name__)
+
+class RateLimiter:
+    """Token bucket на один токен бота плюс интервал между сообщениями в один чат.
+    Не привязан к event loop: слот резервируется под threading.Lock, ожидание выполняет вызывающая корутина,
+    поэтому один лимитер можно делить между потоками и циклами."""
+
+    # Сколько чатов помнить до очистки устаревших записей
+    CHAT_HISTORY_LIMIT = 10000
+
+    def __init__(self, rate: float, burst: int = None, per_chat_interval: float = 1.0):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.per_chat_interval = per_chat_interval
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._chat_next: Dict[int, float] = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, chat_id: int = None) -> float:
+        """Зарезервировать отправку. Возвращает, сколько секунд нужно подождать"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+
+            start = max(now, self._paused_until)
+            if self._tokens < 0:
+                start = max(start, now - self._tokens / self.rate)
+
+            if chat_id is not None:
+                start = max(start, self._chat_next.get(chat_id, 0.0))
+                self._chat_next[chat_id] = start + self.per_chat_interval
+                if len(self._chat_next) > self.CHAT_HISTORY_LIMIT:
+                    self._chat_next = {c: t for c, t in self._chat_next.items() if t > now}
+
+            return start - now
+
+    def pause(self, seconds: float):
+        """Приостановить все отправки бота (ответ 429 с retry_after)"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = min(self._tokens, 0.0)
+
+    def pause_remaining(self) -> float:
+        with self._lock:
+            return max(0.0, self._paused_until - time.monotonic())
+
+    async def acquire(self, chat_id: int = None):
+        """Дождаться своего слота (с учётом паузы, объявленной после резервирования)"""
+        delay = self.reserve(chat_id)
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.pause_remaining()
+
+# Лимитеры по токену бота: все рассылки одного бота в процессе делят общий лимит
+_limiters: Dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+def get_rate_limiter(bot_token: str) -> RateLimiter:
+    """Общий лимитер для токена бота"""
+    with _limiters_lock:
+        limiter = _limiters.get(bot_token)
+        if limiter is None:
+            limiter = RateLimiter(Config.BROADCAST_RATE_PER_SECOND)
+            _limiters[bot_token] = limiter
+        return limiter
+
+def _retry_after_seconds(error: Exception) -> Optional[float]:
+    """retry_after из ошибки 429 (telegram.error.RetryAfter и аналоги)"""
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after is None:
+        return None
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+# Постоянные ошибки доставки: подписчик исключается из аудитории бота до своего следующего сообщения
+PERMANENT_DELIVERY_ERRORS = ('blocked', 'deactivated', 'chat_not_found')
+
+def classify_delivery_error(error: Exception) -> str:
+    """Вид ошибки отправки: blocked, deactivated, chat_not_found, rate_limited или transient.
+    Определяется по типу и тексту ошибки Bot API (telegram.error.Forbidden, BadRequest, RetryAfter)"""
+    if _retry_after_seconds(error) is not None:
+        return 'rate_limited'
+    message = str(error).lower()
+    if 'user is deactivated' in message:
+        return 'deactivated'
+    if 'chat not found' in message or 'user not found' in message:
+        return 'chat_not_found'
+    if type(error).__name__ == 'Forbidden' or message.startswith('forbidden'):
+        # bot was blocked by the user, bot can't initiate conversation, bot was kicked
+        return 'blocked'
+    return 'transient'
+
+class BroadcastEngine:
+    """Рассылка с ограниченным параллелизмом под лимитом бота"""
+
+    def __init__(self, bot_token: str, concurrency: int = None, max_retries: int = None):
+        self.limiter = get_rate_limiter(bot_token)
+        self.concurrency = concurrency or Config.BROADCAST_CONCURRENCY
+        self.max_retries = Config.BROADCAST_MAX_RETRIES if max_retries is None else max_retries
+
+    async def _deliver(self, chat_id: int, send: Callable[[int], Awaitable]) -> Tuple[bool, Optional[Exception]]:
+        attempt = 0
+        while True:
+            await self.limiter.acquire(chat_id)
+            try:
+                await send(chat_id)
+                return True, None
+            except Exception as e:
+                retry_after = _retry_after_seconds(e)
+                if retry_after is not None and attempt < self.max_retries:
+                    attempt += 1
+                    logger.warning(f"⏳ Лимит Telegram, пауза {retry_after} с перед повтором для {chat_id}")
+                    self.limiter.pause(retry_after)
+                    continue
+                return False, e
+
+    async def stream(self, chat_ids: Union[Iterable[int], AsyncIterable[int]], send: Callable[[int], Awaitable],
+                     on_result: Callable[[int, bool, Optional[Exception]], None] = None,
+                     progress_every: int = 100) -> AsyncIterator[Dict]:
+        """Выполнить рассылку, отдавая прогресс каждые progress_every получателей и в конце.
+        send(chat_id) — корутина отправки одному получателю, on_result(chat_id, ok, error) — итог по получателю."""
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        results: asyncio.Queue = asyncio.Queue()
+        progress = {'processed': 0, 'sent': 0, 'failed': 0, 'done': False}
+
+        async def producer():
+            # Получатели читаются по мере отправки: из списка, генератора или асинхронного итератора
+            if hasattr(chat_ids, '__aiter__'):
+                async for chat_id in chat_ids:
+                    await queue.put(chat_id)
+            else:
+                for chat_id in chat_ids:
+                    await queue.put(chat_id)
+            for _ in range(self.concurrency):
+                await queue.put(None)
+
+        async def worker():
+            while True:
+                chat_id = await queue.get()
+                if chat_id is None:
+                    return
+                ok, error = await self._deliver(chat_id, send)
+                await results.put((chat_id, ok, error))
+
+        async def supervise():
+            tasks = [asyncio.create_task(producer())]
+            tasks += [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                # Если упал источник получателей, воркеры так и ждали бы queue.get(): снимаем все задачи
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                await results.put(None)
+
+        supervisor = asyncio.create_task(supervise())
+        try:
+            while True:
+                item = await results.get()
+                if item is None:
+                    break
+                chat_id, ok, error = item
+                progress['processed'] += 1
+                if ok:
+                    progress['sent'] += 1
+                else:
+                    progress['failed'] += 1
+                    kind = classify_delivery_error(error)
+                    if kind in PERMANENT_DELIVERY_ERRORS:
+                        logger.info(f"🚫 Пользователь {chat_id} недоступен ({kind}): {error}")
+                    else:
+                        logger.error(f"❌ Ошибка отправки пользователю {chat_id}: {error}")
+                if on_result:
+                    on_result(chat_id, ok, error)
+                if progress['processed'] % progress_every == 0:
+                    yield dict(progress)
+            # Пробрасываем ошибку источника получателей, если она была
+            await supervisor
+        finally:
+            if not supervisor.done():
+                supervisor.cancel()
+
+        progress['done'] = True
+        yield dict(progress)
+
+    async def run(self, chat_ids: Union[Iterable[int], AsyncIterable[int]], send: Callable[[int], Awaitable],
+                  on_result: Callable[[int, bool, Optional[Exception]], None] = None,
+                  on_progress: Callable[[Dict], None] = None) -> Tuple[int, int]:
+        """Выполнить рассылку целиком. Возвращает (успешно, ошибок)"""
+        progress = {'sent': 0, 'failed': 0}
+        async for progress in self.stream(chat_ids, send, on_result=on_result):
+            if on_progress:
+                on_progress(progress)
+        return progress['sent'], progress['failed']
+
+class DeliveryRecorder:
+    """Буфер итогов рассылки кампании: add() подходит как on_result и только копит результаты в памяти.
+    В БД (Database.record_deliveries) они уходят пачкой из фоновой задачи start() при накоплении
+    DELIVERY_FLUSH_SIZE или раз в DELIVERY_FLUSH_SECONDS, либо явным await flush(); запись выполняется
+    в потоке, event loop её не ждёт. Получатели с постоянной ошибкой в той же транзакции исключаются
+    из аудитории бота. totals — счётчики кампании после последней успешной записи."""
+
+    def __init__(self, db, campaign_id: int, owner_user_id: int, totals: Dict = None,
+                 flush_size: int = None, flush_seconds: float = None):
+        self.db = db
+        self.campaign_id = campaign_id
+        self.owner_user_id = owner_user_id
+        self.totals = dict(totals or {'sent_count': 0, 'failed_count': 0})
+        self.flush_size = flush_size or Config.DELIVERY_FLUSH_SIZE
+        self.flush_seconds = flush_seconds or Config.DELIVERY_FLUSH_SECONDS
+        self._pending = []
+        self._unreachable = []
+        self._full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    def add(self, chat_id: int, ok: bool, error: Optional[Exception]):
+        if ok:
+            self._pending.append((chat_id, True, None))
+        else:
+            kind = classify_delivery_error(error)
+            self._pending.append((chat_id, False, f"{kind}: {error}"[:200]))
+            if kind in PERMANENT_DELIVERY_ERRORS:
+                self._unreachable.append((chat_id, kind))
+        if len(self._pending) >= self.flush_size:
+            self._full.set()
+
+    def _write(self, pending: List, unreachable: List) -> Dict:
+        with self.db.transaction():
+            totals = self.db.record_deliveries(self.campaign_id, self.owner_user_id, pending)
+            self.db.deactivate_subscribers(self.owner_user_id, unreachable)
+        return totals
+
+    async def flush(self, final: bool = False) -> bool:
+        """Записать накопленные итоги. Ошибка записи посреди рассылки только логируется (итоги остаются
+        в буфере до следующей попытки); при final=True она пробрасывается. False — запись не удалась"""
+        async with self._flush_lock:
+            self._full.clear()
+            if not self._pending:
+                return True
+            pending, self._pending = self._pending, []
+            unreachable, self._unreachable = self._unreachable, []
+            try:
+                self.totals = await asyncio.to_thread(self._write, pending, unreachable)
+                return True
+            except Exception as e:
+                # Вернём итоги в буфер: их запишет следующий flush
+                self._pending[:0] = pending
+                self._unreachable[:0] = unreachable
+                if final:
+                    raise
+                logger.error(f"❌ Кампания #{self.campaign_id}: не удалось записать итоги доставки, повторим: {e}")
+                return False
+
+    def start(self):
+        """Запустить фоновую запись пачек на текущем event loop"""
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def close(self, final: bool = True) -> bool:
+        """Остановить фоновую запись и записать остаток (final — как в flush).
+        Фоновую задачу не отменяем, а дожидаемся: запись в потоке отменить всё равно нельзя"""
+        if self._task is not None:
+            self._closing = True
+            self._full.set()
+            await self._task
+            self._task = None
+        return await self.flush(final)
+
+def make_sender(bot, text: str = None, photo: str = None, document: FileIdCache = None,
+                filename: str = None, caption: str = None, parse_mode: str = None) -> Callable[[int], Awaitable]:
+    """Корутина отправки одного сообщения через telegram.Bot: фото, документ или текст.
+    document — кэш file_id (FileIdCache.load): файл загружается один раз, остальным получателям уходит его file_id."""
+    async def send(chat_id: int):
+        if photo:
+            return await bot.send_photo(chat_id=chat_id, photo=photo, caption=caption or text or None)
+        if document:
+            return await document.send(bot, chat_id, filename=filename, caption=caption)
+        return await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+    return send
+
+async def broadcast(bot_token: str, chat_ids: Union[Iterable[int], AsyncIterable[int]],
+                    on_result: Callable[[int, bool, Optional[Exception]], None] = None,
+                    on_progress: Callable[[Dict], None] = None, **content) -> Tuple[int, int]:
+    """Рассылка от имени бота без запущенного Application (веб-панель, админ-бот).
+    content — аргументы make_sender: text, photo, filename, caption, parse_mode, а также document_path."""
+    from telegram import Bot
+    from bot.bot_api import make_request
+
+    document_path = content.pop('document_path', None)
+    if document_path:
+        # Хэш файла и запрос к кэшу file_id — вне event loop
+        content['document'] = await FileIdCache.load(bot_token, document_path)
+    engine = BroadcastEngine(bot_token)
+    request = make_request(pool_size=engine.concurrency)
+    async with Bot(bot_token, request=request) as bot:
+        return await engine.run(chat_ids, make_sender(bot, **content), on_result=on_result, on_progress=on_progress)
+
+def run_broadcast(bot_token: str, chat_ids: Union[Iterable[int], AsyncIterable[int]], **kwargs) -> Tuple[int, int]:
+    """Синхронная обёртка над broadcast() для кода вне event loop"""
+    return asyncio.run(broadcast(bot_token, chat_ids, **kwargs))
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Воркер очереди рассылок
+Забирает кампании из таблицы campaigns с арендой (lease), рассылает их через движок рассылок,
+продлевает аренду и сохраняет точку продолжения, чтобы после падения продолжить с последнего получателя
+"""
+
+import asyncio
+import logging
+import os
+import socket
+import time
+from collections import deque
+from typing import AsyncIterable, AsyncIterator, Dict, Optional
+
+from config import Config
+from database import AsyncDatabase
+from bot.broadcast import DeliveryRecorder, broadcast
+
+logger = logging.getLogger(__name__)
+
+# Папка для файлов, которые веб-панель передаёт воркеру
+BROADCAST_UPLOAD_FOLDER = os.path.join(Config.UPLOAD_FOLDER, 'broadcasts')
+
+class LeaseLost(Exception):
+    """Аренда кампании перехвачена другим воркером"""
+
+class _Watermark:
+    """Нижняя граница обработанных получателей: все id <= value уже обработаны.
+    Получатели идут по возрастанию id, а завершаются в произвольном порядке."""
+
+    def __init__(self, value: int):
+        self.value = value
+        self._pending = deque()
+        self._done = set()
+
+    async def track(self, chat_ids: AsyncIterable[int]) -> AsyncIterator[int]:
+        async for chat_id in chat_ids:
+            self._pending.append(chat_id)
+            yield chat_id
+
+    def done(self, chat_id: int):
+        self._done.add(chat_id)
+        while self._pending and self._pending[0] in self._done:
+            self.value = self._pending.popleft()
+            self._done.discard(self.value)
+
+class BroadcastWorker:
+    """Обработчик очереди рассылок"""
+
+    def __init__(self, worker_id: str = None, db_path: str = 'data/bot.db'):
+        # Запросы из корутины кампании идут через пул потоков БД, синхронные (claim) — напрямую
+        self.adb = AsyncDatabase(db_path)
+        self.db = self.adb.sync
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_seconds = Config.BROADCAST_LEASE_SECONDS
+        self.heartbeat_seconds = Config.BROADCAST_HEARTBEAT_SECONDS
+        self.is_running = False
+
+    def run_forever(self):
+        """Опрашивать очередь и обрабатывать кампании по одной"""
+        self.is_running = True
+        logger.info(f"🚀 Воркер рассылок {self.worker_id} запущен")
+        while self.is_running:
+            job = self.db.claim_campaign(self.worker_id, self.lease_seconds)
+            if job is None:
+                time.sleep(Config.BROADCAST_POLL_SECONDS)
+                continue
+            asyncio.run(self.process(job))
+
+    def stop(self):
+        self.is_running = False
+
+    async def process(self, job: Dict):
+        """Разослать одну кампанию, продолжая с сохранённой точки"""
+        campaign_id = job['id']
+        owner_id = job['user_id']
+        start_after = job['last_recipient_id'] or 0
+        watermark = _Watermark(start_after)
+        # Точка продолжения, до которой итоги доставки уже записаны в БД
+        checkpoint = {'mark': start_after}
+        recorder: Optional[DeliveryRecorder] = None
+        try:
+            settings = await self.adb.get_user_settings(owner_id)
+            bot_token = settings.get('bot_token') or ''
+            if not bot_token:
+                await self.adb.complete_campaign(campaign_id, self.worker_id, 'failed', error='Бот не настроен')
+                return
+
+            # Счётчики ведёт только сводка campaign_deliveries: после сбоя они уже учитывают итоги,
+            # записанные позже последнего heartbeat
+            recorder = DeliveryRecorder(self.db, campaign_id, owner_id,
+                                        totals=await self.adb.get_delivery_counts(campaign_id))
+            # Продолжаем после последнего подтверждённого получателя, пропуская уже обработанных после него
+            processed = await self.adb.get_delivered_recipient_ids(campaign_id, start_after)
+            if start_after:
+                logger.info(f"🔁 Кампания #{campaign_id}: продолжаем после получателя {start_after}")
+
+            async def recipients():
+                async for uid in self.adb.iter_recipient_ids(owner_id, start_after):
+                    if uid not in processed:
+                        yield uid
+
+            def on_result(uid: int, ok: bool, error: Optional[Exception]):
+                recorder.add(uid, ok, error)
+                watermark.done(uid)
+
+            async def heartbeat():
+                while True:
+                    await asyncio.sleep(self.heartbeat_seconds)
+                    if not await self._checkpoint(job, recorder, watermark, checkpoint):
+                        raise LeaseLost()
+
+            recorder.start()
+            send_task = asyncio.create_task(broadcast(
+                bot_token,
+                watermark.track(recipients()),
+                on_result=on_result,
+                text=job['text'] or '',
+                photo=job['photo_file_id'],
+                document_path=job['document_path'],
+                filename=job['filename'],
+                caption=job['caption'],
+                parse_mode=job['parse_mode'],
+            ))
+            heartbeat_task = asyncio.create_task(heartbeat())
+            await asyncio.wait({send_task, heartbeat_task}, return_when=asyncio.FIRST_COMPLETED)
+            if heartbeat_task.done():
+                send_task.cancel()
+                heartbeat_task.result()
+            heartbeat_task.cancel()
+            send_task.result()
+
+            # Итоговая запись обязана пройти: иначе кампания уйдёт на повтор с последней записанной точки
+            await recorder.close(final=True)
+            if not await self.adb.complete_campaign(campaign_id, self.worker_id, 'sent'):
+                # Аренду забрал другой воркер: файл рассылки ему ещё нужен
+                logger.warning(f"⚠️ Кампания #{campaign_id}: аренда перехвачена другим воркером, завершает он")
+                return
+            self._cleanup_document(job)
+            logger.info(f"✅ Кампания #{campaign_id} завершена: sent={recorder.totals['sent_count']}, "
+                        f"failed={recorder.totals['failed_count']}")
+
+        except LeaseLost:
+            # Сообщения уже отправлены: их итоги записываем, даже если кампанию забрал другой воркер
+            await recorder.close(final=False)
+            logger.warning(f"⚠️ Кампания #{campaign_id}: аренда потеряна, обработку прекращаем")
+        except Exception as e:
+            logger.error(f"❌ Кампания #{campaign_id}: ошибка {e}")
+            # Сохраняем прогресс, чтобы повтор продолжил с последнего записанного получателя
+            if recorder is not None:
+                await recorder.close(final=False)
+                await self._checkpoint(job, recorder, watermark, checkpoint)
+            await self.adb.retry_campaign(campaign_id, self.worker_id, str(e),
+                                          max_attempts=Config.BROADCAST_MAX_ATTEMPTS)
+
+    async def _checkpoint(self, job: Dict, recorder: DeliveryRecorder, watermark: '_Watermark',
+                          checkpoint: Dict) -> bool:
+        """Записать итоги доставки и продлить аренду с точкой продолжения. False — аренда потеряна.
+        Точка сдвигается, только если итоги всех получателей до неё записаны"""
+        mark = watermark.value
+        if await recorder.flush():
+            checkpoint['mark'] = mark
+        return await self.adb.heartbeat_campaign(job['id'], self.worker_id, checkpoint['mark'],
+                                                 recorder.totals['sent_count'], recorder.totals['failed_count'],
+                                                 self.lease_seconds)
+
+    def _cleanup_document(self, job: Dict):
+        """Удалить файл рассылки, сохранённый веб-панелью для воркера"""
+        path = job.get('document_path')
+        if path and os.path.dirname(os.path.abspath(path)) == os.path.abspath(BROADCAST_UPLOAD_FOLDER):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
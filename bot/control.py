@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Канал управления ботами между веб-панелью и процессом-раннером
+Веб-панель записывает команду в таблицу bot_commands и ждёт результат, раннер (UserBotManager)
+забирает команды своих ботов и ботов без живой аренды, выполняет и записывает ответ.
+Команды: start, stop, reload, status, send.
+"""
+
+import logging
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from config import Config
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+COMMANDS = ('start', 'stop', 'reload', 'status', 'send')
+
+def send_command(bot_user_id: int, command: str, payload: Dict = None, timeout: float = None) -> Dict:
+    """Выполнить команду в раннере ботов и дождаться ответа.
+    Возвращает {'ok': bool, ...}; если ни один раннер не ответил — {'ok': False, 'error': ...}"""
+    if command not in COMMANDS:
+        raise ValueError(f"Неизвестная команда: {command}")
+    db = Database()
+    command_id = db.enqueue_bot_command(bot_user_id, command, payload)
+    deadline = time.monotonic() + (timeout or Config.CONTROL_TIMEOUT_SECONDS)
+    while time.monotonic() < deadline:
+        time.sleep(Config.CONTROL_POLL_SECONDS)
+        row = db.get_bot_command(command_id)
+        if row and row['status'] in ('done', 'failed'):
+            return {'ok': row['status'] == 'done', **(row['result'] or {})}
+
+    # Команду, которую никто не взял, отменяем, чтобы она не выполнилась позже
+    if db.expire_bot_command(command_id):
+        return {'ok': False, 'error': 'Процесс ботов не отвечает'}
+    return {'ok': False, 'error': 'Процесс ботов не успел выполнить команду'}
+
+class ControlServer:
+    """Исполнитель команд в процессе с UserBotManager"""
+
+    def __init__(self, manager, owns: Callable[[int], bool] = None):
+        self.manager = manager
+        self.owns = owns
+        self.db = Database()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="bot-control", daemon=True)
+        self._thread.start()
+        logger.info("📡 Канал управления ботами запущен")
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        last_cleanup = last_refresh = 0.0
+        while not self._stop.is_set():
+            try:
+                for command in self.db.claim_bot_commands(self.manager.owner_id):
+                    if self.owns is not None and not self.owns(command['bot_user_id']):
+                        continue
+                    if self.db.take_bot_command(command['id'], self.manager.owner_id):
+                        self._execute(command)
+                if time.monotonic() - last_refresh >= Config.SETTINGS_POLL_SECONDS:
+                    # Правки настроек из веб-панели и админ-бота применяются без перезапуска ботов
+                    self.manager.refresh_settings()
+                    last_refresh = time.monotonic()
+                if time.monotonic() - last_cleanup > 600:
+                    self.db.cleanup_bot_commands()
+                    last_cleanup = time.monotonic()
+            except Exception as e:
+                logger.error(f"❌ Ошибка канала управления ботами: {e}")
+            self._stop.wait(Config.CONTROL_POLL_SECONDS)
+
+    def _execute(self, command: Dict):
+        user_id = command['bot_user_id']
+        name = command['command']
+        try:
+            handler = getattr(self, f"_cmd_{name}", None)
+            if handler is None:
+                raise ValueError(f"Неизвестная команда: {name}")
+            ok, result = handler(user_id, command['payload'])
+        except Exception as e:
+            ok, result = False, {'error': str(e)}
+        self.db.finish_bot_command(command['id'], ok, result)
+        logger.info(f"📡 Команда {name} для бота {user_id}: {'ok' if ok else result.get('error')}")
+
+    def _cmd_start(self, user_id: int, payload: Dict):
+        user_bot = self.manager.get_bot(user_id)
+        if user_bot and user_bot.is_running:
+            return True, {'message': 'Бот уже запущен'}
+        return self._cmd_reload(user_id, payload)
+
+    def _cmd_reload(self, user_id: int, payload: Dict):
+        if self.manager.reload_bot(user_id):
+            return True, {'message': 'Бот успешно перезагружен'}
+        return False, {'error': 'Не удалось перезагрузить бота'}
+
+    def _cmd_stop(self, user_id: int, payload: Dict):
+        if self.manager.stop_bot(user_id):
+            return True, {'message': 'Бот остановлен'}
+        return False, {'error': 'Бот не запущен'}
+
+    def _cmd_status(self, user_id: int, payload: Dict):
+        user_bot = self.manager.get_bot(user_id)
+        return True, {
+            'running': bool(user_bot and user_bot.is_running),
+            'bot_username': user_bot.bot_username if user_bot else None,
+            'start_failed': bool(user_bot and user_bot.start_failed),
+            'owner_id': self.manager.owner_id,
+        }
+
+    def _cmd_send(self, user_id: int, payload: Dict):
+        """Отправить сообщение от имени запущенного бота"""
+        user_bot = self.manager.get_bot(user_id)
+        if not user_bot or not user_bot.is_running:
+            return False, {'error': 'Бот не запущен'}
+        coro = user_bot.application.bot.send_message(
+            chat_id=payload['chat_id'], text=payload['text'], parse_mode=payload.get('parse_mode')
+        )
+        message = self.manager.run_coroutine(user_id, coro).result(timeout=Config.CONTROL_TIMEOUT_SECONDS)
+        return True, {'message_id': message.message_id}
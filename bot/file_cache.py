@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Кэш file_id для отправки файлов
+Файл загружается в Telegram один раз на бота: file_id первой успешной отправки сохраняется
+в таблице file_id_cache по sha256 содержимого, остальные получатели получают файл по file_id
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+# Хэши по (путь, размер, mtime), чтобы не перечитывать файл на каждый /start
+_hashes: Dict[Tuple[str, int, int], str] = {}
+_hashes_lock = threading.Lock()
+
+def bot_id_from_token(bot_token: str) -> str:
+    """Числовой id бота из токена: file_id действителен только для бота, который его получил"""
+    return bot_token.split(':', 1)[0]
+
+def file_sha256(file_path: str) -> str:
+    """sha256 содержимого файла"""
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    with _hashes_lock:
+        cached = _hashes.get(key)
+    if cached:
+        return cached
+
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    content_hash = digest.hexdigest()
+    with _hashes_lock:
+        _hashes[key] = content_hash
+    return content_hash
+
+def is_invalid_file_id_error(error) -> bool:
+    """Telegram отверг file_id (файл удалён или id от другого бота)"""
+    text = str(error).lower()
+    return 'file identifier' in text or 'file_id' in text or 'file reference' in text
+
+class FileIdCache:
+    """file_id одного файла для одного бота, общий для всех получателей"""
+
+    def __init__(self, bot_token: str, file_path: str, db: Database = None):
+        self.db = db or Database()
+        self.bot_id = bot_id_from_token(bot_token)
+        self.file_path = file_path
+        self.content_hash = file_sha256(file_path)
+        self.file_id: Optional[str] = self.db.get_cached_file_id(self.bot_id, self.content_hash)
+        self._upload_lock: Optional[asyncio.Lock] = None
+
+    @classmethod
+    async def load(cls, bot_token: str, file_path: str) -> 'FileIdCache':
+        """Создать кэш из async-кода: хэш файла и запрос к БД выполняются вне event loop"""
+        return await asyncio.to_thread(cls, bot_token, file_path)
+
+    def remember(self, file_id: str):
+        """Сохранить file_id после успешной загрузки"""
+        if file_id and file_id != self.file_id:
+            self.file_id = file_id
+            self.db.save_cached_file_id(self.bot_id, self.content_hash, file_id)
+            logger.info(f"📎 file_id для {os.path.basename(self.file_path)} сохранён, дальше отправляем без загрузки")
+
+    def forget(self):
+        """Сбросить file_id, который Telegram больше не принимает"""
+        if self.file_id:
+            logger.warning(f"⚠️ file_id для {os.path.basename(self.file_path)} недействителен, загрузим файл заново")
+            self.file_id = None
+            self.db.delete_cached_file_id(self.bot_id, self.content_hash)
+
+    async def send(self, bot, chat_id: int, filename: str = None, caption: str = None):
+        """Отправить документ через telegram.Bot: по file_id, а если его ещё нет — загрузкой файла.
+        Параллельные отправки ждут первую загрузку и используют её file_id."""
+        if self.file_id:
+            try:
+                return await bot.send_document(chat_id=chat_id, document=self.file_id, caption=caption)
+            except Exception as e:
+                if not is_invalid_file_id_error(e):
+                    raise
+                await asyncio.to_thread(self.forget)
+
+        if self._upload_lock is None:
+            self._upload_lock = asyncio.Lock()
+        async with self._upload_lock:
+            if self.file_id:
+                return await bot.send_document(chat_id=chat_id, document=self.file_id, caption=caption)
+            with open(self.file_path, 'rb') as file:
+                message = await bot.send_document(chat_id=chat_id, document=file, filename=filename, caption=caption)
+            if message is not None and message.document:
+                await asyncio.to_thread(self.remember, message.document.file_id)
+            return message
+
+    def post(self, bot_token: str, chat_id: int, filename: str, caption: str = '',
+             content_type: str = 'application/octet-stream') -> Dict:
+        """Синхронная отправка документа через клиент Bot API (веб-панель, TelegramBot).
+        Возвращает ответ Telegram как dict."""
+        from bot.bot_api import get_client
+
+        client = get_client(bot_token)
+        if self.file_id:
+            result = client.send_document(chat_id, self.file_id, caption=caption)
+            if result.get('ok') or not is_invalid_file_id_error(result.get('description', '')):
+                return result
+            self.forget()
+
+        with open(self.file_path, 'rb') as file:
+            result = client.send_document(chat_id, file, filename, caption, content_type)
+        if result.get('ok'):
+            document = result.get('result', {}).get('document') or {}
+            self.remember(document.get('file_id'))
+        return result
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Буфер записи входящих данных (write-behind)
+Обработчики ботов только кладут сообщения и пользователей в очередь в памяти, отдельный поток
+записывает их пачками одной транзакцией раз в INGEST_FLUSH_MS или при накоплении INGEST_BATCH_SIZE строк.
+Event loop ботов не ждёт диск; при остановке буфер сбрасывается.
+Пачка, которую не удалось записать INGEST_MAX_RETRIES раз подряд, пишется построчно: строки с ошибкой
+данных откладываются в dead-letter, остальные записываются. Буфер ограничен INGEST_MAX_PENDING строками,
+сверх этого новые строки отбрасываются (счётчик dropped).
+"""
+
+import atexit
+import logging
+import sqlite3
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from config import Config
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+class IngestBuffer:
+    """Очередь сообщений и пользователей с пакетной записью в БД"""
+
+    # Сколько последних строк dead-letter держать в памяти для разбора
+    DEAD_LETTER_LIMIT = 1000
+
+    def __init__(self, flush_ms: int = None, batch_size: int = None, max_pending: int = None,
+                 max_retries: int = None, db_path: str = None):
+        self.flush_interval = (flush_ms or Config.INGEST_FLUSH_MS) / 1000
+        self.batch_size = batch_size or Config.INGEST_BATCH_SIZE
+        self.max_pending = max_pending or Config.INGEST_MAX_PENDING
+        self.max_retries = Config.INGEST_MAX_RETRIES if max_retries is None else max_retries
+        self.db_path = db_path
+        self.dropped = 0
+        self.dead_letters: deque = deque(maxlen=self.DEAD_LETTER_LIMIT)
+        self.dead_lettered = 0
+        self._failures = 0
+        self._users: List[tuple] = []
+        self._messages: List[tuple] = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="ingest-writer", daemon=True)
+            self._thread.start()
+
+    def _database(self) -> Database:
+        return Database(self.db_path) if self.db_path else Database()
+
+    def _enqueue(self, rows: List[tuple], row: tuple):
+        with self._lock:
+            pending = len(self._users) + len(self._messages)
+            if pending >= self.max_pending:
+                # БД не успевает (или недоступна): обработчики ботов не ждём, строку отбрасываем
+                self.dropped += 1
+                if self.dropped == 1 or self.dropped % 1000 == 0:
+                    logger.warning(f"⚠️ Буфер записи переполнен ({pending} строк), отброшено строк: {self.dropped}")
+                return
+            rows.append(row)
+            pending += 1
+            self._ensure_thread()
+        if pending >= self.batch_size:
+            self._wakeup.set()
+
+    def add_user(self, user_id: int, username: str = None, first_name: str = None, last_name: str = None,
+                 bot_user_id: int = None):
+        """Сохранить/обновить пользователя (и подписку на бота) в следующей пачке"""
+        self._enqueue(self._users, (user_id, username, first_name, last_name, bot_user_id, _now_ms()))
+
+    def add_message(self, user_id: int, text: str, is_from_user: bool = True, bot_user_id: int = None):
+        """Сохранить сообщение в следующей пачке"""
+        self._enqueue(self._messages, (user_id, text, is_from_user, bot_user_id, _now_ms()))
+
+    def flush(self) -> int:
+        """Записать всё накопленное. Возвращает число записанных строк"""
+        with self._flush_lock:
+            with self._lock:
+                users, self._users = self._users, []
+                messages, self._messages = self._messages, []
+            if not users and not messages:
+                return 0
+            try:
+                written = self._database().ingest_batch(users, messages)
+                self._failures = 0
+                logger.debug(f"💾 Записано пачкой: {len(users)} пользователей, {len(messages)} сообщений")
+                return written
+            except Exception as e:
+                self._failures += 1
+                logger.error(f"❌ Ошибка пакетной записи ({len(users)} пользователей, {len(messages)} сообщений, "
+                             f"попытка {self._failures}): {e}")
+                if self._failures <= self.max_retries:
+                    # Возвращаем строки в начало очереди, следующая попытка запишет их вместе с новыми
+                    self._requeue(users, messages)
+                    return 0
+            # Пачка не пишется целиком: ищем строки, которые её ломают
+            self._failures = 0
+            return self._write_rows(users, messages)
+
+    def _requeue(self, users: List[tuple], messages: List[tuple]):
+        with self._lock:
+            self._users[:0] = users
+            self._messages[:0] = messages
+
+    def _write_rows(self, users: List[tuple], messages: List[tuple]) -> int:
+        """Построчная запись пачки. Строки с ошибкой данных уходят в dead-letter,
+        при ошибке самой БД (заблокирована, нет места) остаток возвращается в очередь"""
+        db = self._database()
+        rows: List[Tuple[str, tuple]] = [('user', row) for row in users] + [('message', row) for row in messages]
+        written = 0
+        for index, (kind, row) in enumerate(rows):
+            try:
+                written += db.ingest_batch([row], []) if kind == 'user' else db.ingest_batch([], [row])
+            except sqlite3.OperationalError as e:
+                logger.error(f"❌ БД недоступна при построчной записи: {e}")
+                rest = rows[index:]
+                self._requeue([r for k, r in rest if k == 'user'], [r for k, r in rest if k == 'message'])
+                break
+            except Exception as e:
+                self.dead_lettered += 1
+                self.dead_letters.append((kind, row, str(e)))
+                logger.error(f"☠️ Строка ({kind}) не записана и отложена в dead-letter: {row!r}: {e}")
+        return written
+
+    def stats(self) -> Dict:
+        """Состояние буфера: строк в очереди, отброшено при переполнении, отложено в dead-letter"""
+        with self._lock:
+            pending = len(self._users) + len(self._messages)
+        return {'pending': pending, 'dropped': self.dropped, 'dead_lettered': self.dead_lettered}
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self):
+        """Остановить поток записи и сбросить остаток"""
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+        self.flush()
+
+# Общий буфер процесса
+ingest = IngestBuffer()
+atexit.register(ingest.flush)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Многопроцессный запуск пользовательских ботов
+Супервизор держит K процессов-шардов, боты распределяются по шардам консистентным хешированием
+по system_users.id. Каждый шард периодически сверяет свои боты с БД (новые запускает, удалённые
+останавливает), упавший шард перезапускается, состояние шардов собирается в отчёт.
+"""
+
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from typing import Dict, List
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+class HashRing:
+    """Консистентное хеширование: при изменении числа шардов переезжает лишь ~1/K ботов"""
+
+    def __init__(self, shards: int, replicas: int = 100):
+        self.shards = shards
+        self._ring = sorted(
+            (self._hash(f"shard-{shard}-{replica}"), shard)
+            for shard in range(shards)
+            for replica in range(replicas)
+        )
+        self._keys = [key for key, _ in self._ring]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+    def shard_for(self, user_id: int) -> int:
+        index = bisect.bisect(self._keys, self._hash(f"user-{user_id}")) % len(self._ring)
+        return self._ring[index][1]
+
+def run_shard(shard: int, shards: int, reports: multiprocessing.Queue):
+    """Точка входа процесса-шарда"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f'%(asctime)s - shard {shard} - %(levelname)s - %(message)s'
+    )
+    from bot.ingest import ingest
+    from bot.user_bot_manager import UserBotManager
+
+    if Config.BOT_INGRESS == 'webhook':
+        # Общий webhook-сервер не умеет направлять обновления в нужный процесс
+        logger.warning("⚠️ Шарды работают только в режиме polling, BOT_INGRESS=webhook игнорируется")
+        Config.BOT_INGRESS = 'polling'
+
+    ring = HashRing(shards)
+    manager = UserBotManager()
+    manager.start_control_server(lambda user_id: ring.shard_for(user_id) == shard)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    logger.info(f"🚀 Шард {shard}/{shards} запущен (pid {os.getpid()})")
+    while not stop.is_set():
+        try:
+            changes = manager.sync_with_db(lambda user_id: ring.shard_for(user_id) == shard)
+            if changes['started'] or changes['stopped']:
+                logger.info(f"🔄 Шард {shard}: запущено {changes['started']}, остановлено {changes['stopped']}")
+            bots = manager.get_all_bots()
+            reports.put({
+                'shard': shard,
+                'pid': os.getpid(),
+                'bots': sorted(bots),
+                'running': sum(1 for bot in bots.values() if bot.is_running),
+                'subscribers': manager.get_total_subscribers(),
+                'ingest': ingest.stats(),
+                'updated_at': time.time(),
+            })
+        except Exception as e:
+            logger.error(f"❌ Шард {shard}: ошибка сверки ботов: {e}")
+        stop.wait(Config.SHARD_SYNC_SECONDS)
+
+    manager.stop_all_bots()
+    logger.info(f"🛑 Шард {shard} остановлен")
+
+class ShardSupervisor:
+    """Запускает шарды, перезапускает упавшие и собирает отчёт"""
+
+    # Пауза перед перезапуском упавшего шарда (удваивается при повторных падениях, до 60 с)
+    RESTART_DELAY = 2
+
+    def __init__(self, shards: int = None):
+        self.shards = max(1, shards or Config.BOT_SHARDS)
+        self._ctx = multiprocessing.get_context('spawn')
+        self._reports = self._ctx.Queue()
+        self._processes: Dict[int, multiprocessing.Process] = {}
+        self._restarts: Dict[int, int] = {shard: 0 for shard in range(self.shards)}
+        self._next_start: Dict[int, float] = {shard: 0.0 for shard in range(self.shards)}
+        self._state: Dict[int, Dict] = {}
+        self.is_running = False
+
+    def _start_shard(self, shard: int):
+        process = self._ctx.Process(target=run_shard, args=(shard, self.shards, self._reports),
+                                    name=f"bot-shard-{shard}", daemon=False)
+        process.start()
+        self._processes[shard] = process
+
+    def _check_shards(self):
+        """Перезапустить упавшие шарды"""
+        now = time.monotonic()
+        for shard in range(self.shards):
+            process = self._processes.get(shard)
+            if process is not None and process.is_alive():
+                continue
+            if process is not None:
+                self._restarts[shard] += 1
+                delay = min(60, self.RESTART_DELAY * 2 ** min(self._restarts[shard] - 1, 5))
+                self._next_start[shard] = now + delay
+                self._state.pop(shard, None)
+                logger.warning(f"⚠️ Шард {shard} завершился (код {process.exitcode}), перезапуск через {delay} с")
+                self._processes.pop(shard)
+            if now >= self._next_start[shard]:
+                self._start_shard(shard)
+
+    def _drain_reports(self):
+        while True:
+            try:
+                report = self._reports.get_nowait()
+            except queue.Empty:
+                return
+            self._state[report['shard']] = report
+
+    def report(self) -> List[Dict]:
+        """Состояние каждого шарда"""
+        self._drain_reports()
+        result = []
+        for shard in range(self.shards):
+            process = self._processes.get(shard)
+            state = self._state.get(shard, {})
+            result.append({
+                'shard': shard,
+                'pid': process.pid if process else None,
+                'alive': bool(process and process.is_alive()),
+                'restarts': self._restarts[shard],
+                'bots': len(state.get('bots', [])),
+                'running': state.get('running', 0),
+                'subscribers': state.get('subscribers', 0),
+                'ingest': state.get('ingest', {}),
+                'updated_at': state.get('updated_at'),
+            })
+        return result
+
+    def log_report(self):
+        for row in self.report():
+            ingest_stats = row['ingest']
+            logger.info(
+                f"📊 Шард {row['shard']}: pid={row['pid']} alive={row['alive']} "
+                f"ботов={row['bots']} запущено={row['running']} подписчиков={row['subscribers']} "
+                f"перезапусков={row['restarts']} буфер записи={ingest_stats.get('pending', 0)} "
+                f"отброшено={ingest_stats.get('dropped', 0)} dead-letter={ingest_stats.get('dead_lettered', 0)}"
+            )
+
+    def run_forever(self):
+        self.is_running = True
+        logger.info(f"🚀 Супервизор запускает {self.shards} шардов")
+        last_report = time.monotonic()
+        while self.is_running:
+            self._check_shards()
+            self._drain_reports()
+            if time.monotonic() - last_report >= Config.SHARD_REPORT_SECONDS:
+                self.log_report()
+                last_report = time.monotonic()
+            time.sleep(1)
+        self.stop_shards()
+
+    def stop(self):
+        self.is_running = False
+
+    def stop_shards(self):
+        """Остановить все шарды (SIGTERM, затем ожидание)"""
+        for process in self._processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in self._processes.values():
+            process.join(timeout=30)
+        self._processes.clear()
+        logger.info("🛑 Все шарды остановлены")
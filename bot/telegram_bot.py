@@ -4,7 +4,10 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 from config import Config
 import asyncio
-from database import Database
+from database import AsyncDatabase, Database
+from bot.bot_api import get_client
+from bot.file_cache import FileIdCache
+from bot.ingest import ingest
 
 # Настройка логирования
 logging.basicConfig(
@@ -17,6 +20,8 @@ class TelegramBot:
     def __init__(self):
         self.token = Config.TELEGRAM_TOKEN
         self.db = Database()
+        # Для async-обработчиков: запросы к БД выполняются в пуле потоков, не блокируя event loop
+        self.adb = AsyncDatabase()
         self.welcome_message = self.db.get_setting('welcome_message') or "Добро пожаловать! 👋"
         self.welcome_pdf_path = self.db.get_setting('welcome_pdf_path')
         logger.info("TelegramBot инициализирован с базой данных")
@@ -31,7 +36,7 @@ class TelegramBot:
         last_name = update.effective_user.last_name
         
         # Добавляем пользователя в базу данных
-        self.db.add_user(user_id, username, first_name, last_name)
+        await self.adb.add_user(user_id, username, first_name, last_name)
         logger.info(f"Добавлен подписчик: {user_id} ({username or first_name or f'user_{user_id}'})")
         
         # Отправляем приветственное сообщение
@@ -43,7 +48,9 @@ class TelegramBot:
                 logger.info(f"Отправляем PDF файл пользователю {user_id}: {self.welcome_pdf_path}")
                 
                 # Используем прямой API для отправки документа
-                success = self.send_document_to_user(user_id, self.welcome_pdf_path, "welcome.pdf", "Добро пожаловать! 📄")
+                success = await asyncio.to_thread(
+                    self.send_document_to_user, user_id, self.welcome_pdf_path, "welcome.pdf", "Добро пожаловать! 📄"
+                )
                 
                 if success:
                     logger.info(f"PDF файл успешно отправлен пользователю {user_id}")
@@ -72,7 +79,9 @@ class TelegramBot:
         if self.welcome_pdf_path and os.path.exists(self.welcome_pdf_path):
             await update.message.reply_text("📄 Отправляю PDF файл...")
             
-            success = self.send_document_to_user(user_id, self.welcome_pdf_path, "welcome.pdf", "Тестовый PDF файл 📄")
+            success = await asyncio.to_thread(
+                self.send_document_to_user, user_id, self.welcome_pdf_path, "welcome.pdf", "Тестовый PDF файл 📄"
+            )
             
             if success:
                 await update.message.reply_text("✅ PDF файл успешно отправлен!")
@@ -163,27 +172,11 @@ class TelegramBot:
             first_name = update.effective_user.first_name
             last_name = update.effective_user.last_name
             
-            logger.info(f"🔔 ПОЛУЧЕНО СООБЩЕНИЕ от пользователя {user_id}")
-            logger.info(f"📝 Текст: {text[:100]}...")
-            logger.info(f"👤 Username: {username}, First: {first_name}, Last: {last_name}")
-            
-            # Добавляем пользователя в базу данных если его там нет
-            logger.info(f"💾 Добавляем/обновляем пользователя {user_id} в БД...")
-            if self.db.add_user(user_id, username, first_name, last_name):
-                logger.info(f"✅ Пользователь {user_id} добавлен/обновлен в БД")
-            else:
-                logger.error(f"❌ Ошибка добавления пользователя {user_id} в БД")
-            
-            # Сохраняем сообщение пользователя
-            logger.info(f"💾 Сохраняем сообщение от пользователя {user_id} в БД...")
-            if self.db.add_message(user_id, text, is_from_user=True):
-                logger.info(f"✅ Сообщение от пользователя {user_id} сохранено в БД")
-            else:
-                logger.error(f"❌ Ошибка сохранения сообщения от пользователя {user_id} в БД")
+            logger.info(f"🔔 ПОЛУЧЕНО СООБЩЕНИЕ от пользователя {user_id}: {text[:100]}")
             
-            # Проверяем что сообщение действительно сохранилось
-            messages = self.db.get_user_messages(user_id)
-            logger.info(f"📊 Всего сообщений у пользователя {user_id}: {len(messages)}")
+            # Пользователь и сообщение пишутся в БД пачкой буфером ingest, обработчик не ждёт диск
+            ingest.add_user(user_id, username, first_name, last_name)
+            ingest.add_message(user_id, text, is_from_user=True)
             
         except Exception as e:
             logger.error(f"❌ КРИТИЧЕСКАЯ ОШИБКА в handle_message: {e}")
@@ -257,32 +250,26 @@ class TelegramBot:
         
         # Если в БД нет полной информации, получаем из Telegram API
         try:
-            import requests
-            url = f"https://api.telegram.org/bot{self.token}/getChat"
-            data = {'chat_id': user_id}
-            
-            response = requests.post(url, data=data)
+            result = get_client(self.token).get_chat(user_id)
             
-            if response.status_code == 200:
-                result = response.json()
-                if result.get('ok'):
-                    user_data = result['result']
-                    
-                    # Обновляем информацию в БД
-                    username = user_data.get('username')
-                    first_name = user_data.get('first_name', '')
-                    last_name = user_data.get('last_name', '')
-                    
-                    self.db.add_user(user_id, username, first_name, last_name)
-                    
-                    return {
-                        'id': user_data['id'],
-                        'username': username,
-                        'first_name': first_name,
-                        'last_name': last_name,
-                        'full_name': f"{first_name} {last_name}".strip(),
-                        'avatar_url': None
-                    }
+            if result.get('ok'):
+                user_data = result['result']
+                
+                # Обновляем информацию в БД
+                username = user_data.get('username')
+                first_name = user_data.get('first_name', '')
+                last_name = user_data.get('last_name', '')
+                
+                self.db.add_user(user_id, username, first_name, last_name)
+                
+                return {
+                    'id': user_data['id'],
+                    'username': username,
+                    'first_name': first_name,
+                    'last_name': last_name,
+                    'full_name': f"{first_name} {last_name}".strip(),
+                    'avatar_url': None
+                }
             
             return user_info  # Возвращаем то что есть в БД
             
@@ -303,52 +290,21 @@ class TelegramBot:
     def send_document_to_user(self, user_id: int, file_path: str, filename: str, caption: str = ""):
         """Отправка документа конкретному пользователю"""
         try:
-            import requests
-            
             logger.info(f"Начинаем отправку документа пользователю {user_id}")
             logger.info(f"Файл: {file_path}, размер: {os.path.getsize(file_path)} байт")
             
-            url = f"https://api.telegram.org/bot{self.token}/sendDocument"
-            
-            # Читаем файл
-            with open(file_path, 'rb') as file:
-                files = {
-                    'document': (filename, file, 'application/pdf')
-                }
-                data = {
-                    'chat_id': user_id,
-                    'caption': caption
-                }
-                
-                logger.info(f"Отправляем запрос к Telegram API: {url}")
-                response = requests.post(url, data=data, files=files, timeout=30)
-                
-                logger.info(f"Получен ответ: статус {response.status_code}")
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    logger.info(f"Ответ API: {result}")
-                    
-                    if result.get('ok'):
-                        logger.info(f"Документ успешно отправлен пользователю {user_id}")
-                        return True
-                    else:
-                        logger.error(f"Telegram API ошибка: {result}")
-                        return False
-                else:
-                    logger.error(f"HTTP ошибка {response.status_code}: {response.text}")
-                    return False
+            # Файл загружается один раз, дальше отправляется по сохранённому file_id
+            document = FileIdCache(self.token, file_path, self.db)
+            logger.info(f"Отправляем запрос к Telegram API: sendDocument ({'file_id' if document.file_id else 'загрузка'})")
+            result = document.post(self.token, user_id, filename, caption, 'application/pdf')
             
-        except ImportError:
-            logger.error("Модуль requests не установлен. Устанавливаем...")
-            try:
-                import subprocess
-                subprocess.check_call(['pip', 'install', 'requests'])
-                logger.info("requests установлен, повторяем отправку...")
-                return self.send_document_to_user(user_id, file_path, filename, caption)
-            except Exception as e:
-                logger.error(f"Не удалось установить requests: {e}")
+            if result.get('ok'):
+                logger.info(f"Документ успешно отправлен пользователю {user_id}")
+                return True
+            else:
+                logger.error(f"Telegram API ошибка: {result}")
                 return False
+            
         except Exception as e:
             logger.error(f"Ошибка отправки документа пользователю {user_id}: {e}")
             return False
@@ -356,43 +312,19 @@ class TelegramBot:
     def send_message_to_user(self, user_id: int, message: str):
         """Отправка сообщения конкретному пользователю"""
         try:
-            import requests
-            
             logger.info(f"Отправляем сообщение пользователю {user_id}: {message[:50]}...")
             
-            url = f"https://api.telegram.org/bot{self.token}/sendMessage"
-            data = {
-                'chat_id': user_id,
-                'text': message,
-                'parse_mode': 'HTML'
-            }
-            
-            response = requests.post(url, json=data, timeout=30)
+            result = get_client(self.token).send_message(user_id, message, parse_mode='HTML')
             
-            if response.status_code == 200:
-                result = response.json()
-                if result.get('ok'):
-                    logger.info(f"Сообщение успешно отправлено пользователю {user_id}")
-                    # Сохраняем сообщение администратора
-                    self.db.add_message(user_id, message, is_from_user=False)
-                    return True
-                else:
-                    logger.error(f"Telegram API ошибка: {result}")
-                    return False
+            if result.get('ok'):
+                logger.info(f"Сообщение успешно отправлено пользователю {user_id}")
+                # Сохраняем сообщение администратора
+                self.db.add_message(user_id, message, is_from_user=False)
+                return True
             else:
-                logger.error(f"HTTP ошибка {response.status_code}: {response.text}")
+                logger.error(f"Telegram API ошибка: {result}")
                 return False
                 
-        except ImportError:
-            logger.error("Модуль requests не установлен. Устанавливаем...")
-            try:
-                import subprocess
-                subprocess.check_call(['pip', 'install', 'requests'])
-                logger.info("requests установлен, повторяем отправку...")
-                return self.send_message_to_user(user_id, message)
-            except Exception as e:
-                logger.error(f"Не удалось установить requests: {e}")
-                return False
         except Exception as e:
             logger.error(f"Ошибка отправки сообщения пользователю {user_id}: {e}")
             return False
@@ -5,9 +5,13 @@
 """
 
 import asyncio
+import concurrent.futures
 import logging
+import socket
 import threading
-from typing import Dict, Optional, Tuple
+import time
+import uuid
+from typing import Callable, Dict, List, Optional, Tuple
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
 from telegram import Update
 from telegram.ext import ContextTypes
@@ -15,21 +19,80 @@ import sqlite3
 import os
 from datetime import datetime
 
+from config import Config
+from database import AsyncDatabase
+from bot.broadcast import PERMANENT_DELIVERY_ERRORS, BroadcastEngine, classify_delivery_error, make_sender
+from bot.file_cache import FileIdCache
+from bot.ingest import ingest
+
 logger = logging.getLogger(__name__)
 
 class UserBot:
     """Индивидуальный бот пользователя"""
     
-    def __init__(self, user_id: int, bot_token: str, bot_username: str, welcome_message: str, start_command: str):
+    def __init__(self, user_id: int, bot_token: str, bot_username: str, welcome_message: str, start_command: str,
+                 settings: Dict = None):
         self.user_id = user_id
         self.bot_token = bot_token
         self.bot_username = bot_username
         self.welcome_message = welcome_message
         self.start_command = start_command
+        # Кэш настроек из user_settings: /start не обращается к БД, кэш обновляется по settings_version
+        self.settings: Dict = {}
+        self.settings_version = -1
+        self.welcome_document: Optional[FileIdCache] = None
         self.application = None
         self.is_running = False
+        self.start_failed = False
+        # Бот добавлен в менеджер, но start() ещё не завершился
+        self.is_starting = True
         self.subscribers = set()
+        # Цикл, на котором работает Application, и очередь обновлений в режиме webhook
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.updates: Optional[asyncio.Queue] = None
+        self._updates_task: Optional[asyncio.Task] = None
+        if settings:
+            self.apply_settings(settings)
         
+    def apply_settings(self, settings: Dict):
+        """Применить настройки из user_settings к кэшу бота (токен здесь не меняется).
+        Вызывается из любого потока, кроме цикла бота: хэш приветственного файла и запрос к кэшу file_id
+        выполняются здесь, а кэш, который читают обработчики, меняется уже на цикле бота."""
+        document = self._prepare_welcome_document(settings)
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            # Бот ещё не запускался: обработчиков, читающих кэш, нет
+            self._set_settings(settings, document)
+        else:
+            loop.call_soon_threadsafe(self._set_settings, settings, document)
+    
+    def _prepare_welcome_document(self, settings: Dict) -> Optional[FileIdCache]:
+        """Кэш file_id приветственного файла (файловый ввод-вывод и БД — вне цикла бота)"""
+        pdf_path = settings.get('welcome_pdf_path') or ''
+        document = self.welcome_document
+        if document is not None and document.file_path == pdf_path:
+            return document
+        if pdf_path and os.path.exists(pdf_path):
+            try:
+                return FileIdCache(self.bot_token, pdf_path)
+            except Exception as e:
+                logger.error(f"❌ Не удалось подготовить приветственный файл бота {self.user_id}: {e}")
+        return None
+    
+    def _set_settings(self, settings: Dict, document: Optional[FileIdCache]):
+        """Заменить кэш настроек (на цикле бота или до его запуска)"""
+        self.welcome_document = document
+        self.bot_username = settings.get('bot_username') or self.bot_username
+        self.welcome_message = settings.get('welcome_message') or self.welcome_message
+        self.start_command = settings.get('start_command') or self.start_command
+        self.settings = dict(settings)
+        self.settings_version = settings.get('settings_version', 0)
+    
+    def load_settings(self):
+        """Прочитать настройки бота из БД в кэш"""
+        from database import Database
+        self.apply_settings(Database().get_user_settings(self.user_id))
+    
     async def start(self):
         """Запуск бота"""
         try:
@@ -37,8 +100,16 @@ class UserBot:
                 logger.warning(f"Бот пользователя {self.user_id} не имеет токена")
                 return False
                 
-            # Создаем приложение
-            self.application = Application.builder().token(self.bot_token).build()
+            self.loop = asyncio.get_running_loop()
+            if self.settings_version < 0:
+                await asyncio.to_thread(self.load_settings)
+            webhook_mode = Config.BOT_INGRESS == 'webhook'
+            
+            # Создаем приложение (в режиме webhook без updater: обновления приходят на общий webhook-сервер)
+            builder = Application.builder().token(self.bot_token)
+            if webhook_mode:
+                builder = builder.updater(None)
+            self.application = builder.build()
             
             # Добавляем обработчики
             self.application.add_handler(CommandHandler("start", self.start_command_handler))
@@ -48,28 +119,66 @@ class UserBot:
             # Запускаем бота
             await self.application.initialize()
             await self.application.start()
-            await self.application.updater.start_polling()
+            if webhook_mode:
+                from bot.webhook_server import webhook_secret, webhook_url
+                self.updates = asyncio.Queue(maxsize=Config.WEBHOOK_QUEUE_SIZE)
+                self._updates_task = asyncio.create_task(self._process_updates())
+                await self.application.bot.set_webhook(
+                    url=webhook_url(self.bot_token),
+                    secret_token=webhook_secret(self.bot_token),
+                    max_connections=Config.WEBHOOK_MAX_CONNECTIONS,
+                )
+            else:
+                await self.application.updater.start_polling()
             
             self.is_running = True
             logger.info(f"✅ Бот пользователя {self.user_id} (@{self.bot_username}) запущен")
             return True
             
         except Exception as e:
+            self.start_failed = True
             logger.error(f"❌ Ошибка запуска бота пользователя {self.user_id}: {e}")
             return False
+        finally:
+            self.is_starting = False
     
     async def stop(self):
         """Остановка бота"""
         try:
             if self.application:
-                await self.application.updater.stop()
-                await self.application.stop()
+                if self._updates_task:
+                    self._updates_task.cancel()
+                    self._updates_task = None
+                if self.application.updater and self.application.updater.running:
+                    await self.application.updater.stop()
+                if self.application.running:
+                    await self.application.stop()
                 await self.application.shutdown()
                 self.is_running = False
                 logger.info(f"🛑 Бот пользователя {self.user_id} остановлен")
         except Exception as e:
             logger.error(f"❌ Ошибка остановки бота пользователя {self.user_id}: {e}")
     
+    async def enqueue_update(self, data: Dict) -> bool:
+        """Поставить обновление из webhook в очередь бота. False — очередь полна или бот не работает"""
+        if not self.is_running or self.updates is None:
+            return False
+        try:
+            self.updates.put_nowait(Update.de_json(data, self.application.bot))
+            return True
+        except asyncio.QueueFull:
+            logger.warning(f"⚠️ Очередь обновлений бота {self.user_id} переполнена")
+            return False
+    
+    async def _process_updates(self):
+        """Обработка обновлений из webhook-очереди по одному"""
+        while True:
+            update = await self.updates.get()
+            try:
+                await self.application.process_update(update)
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработки обновления в боте {self.user_id}: {e}")
+    
     async def start_command_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /start"""
         try:
@@ -83,10 +192,9 @@ class UserBot:
             # Отправляем приветственное сообщение
             await update.message.reply_text(self.welcome_message)
             
-            # Отправляем приветственный файл по file_id если указан, иначе PDF по локальному пути
-            from database import Database
-            db = Database()
-            user_settings = db.get_user_settings(self.user_id)
+            # Отправляем приветственный файл по file_id если указан, иначе PDF по локальному пути (из кэша настроек)
+            user_settings = self.settings
+            welcome_document = self.welcome_document
             if user_settings:
                 welcome_file_id = user_settings.get('welcome_file_id')
                 welcome_caption = user_settings.get('welcome_file_caption') or "Добро пожаловать! 📎"
@@ -102,16 +210,14 @@ class UserBot:
                             logger.info(f"🖼 Welcome photo_id отправлен пользователю {user_id}")
                         except Exception as e_photo:
                             logger.error(f"❌ Ошибка отправки welcome file_id: {e_doc} / {e_photo}")
-                elif user_settings.get('welcome_pdf_path'):
-                    pdf_path = user_settings['welcome_pdf_path']
-                    import os
-                    if os.path.exists(pdf_path):
-                        try:
-                            filename = os.path.basename(pdf_path)
-                            await self.send_file_to_user(user_id, pdf_path, filename, "Добро пожаловать! 📄")
-                            logger.info(f"📄 PDF файл отправлен пользователю {user_id}")
-                        except Exception as e:
-                            logger.error(f"❌ Ошибка отправки PDF пользователю {user_id}: {e}")
+                elif welcome_document is not None:
+                    try:
+                        filename = os.path.basename(welcome_document.file_path)
+                        await welcome_document.send(self.application.bot, user_id, filename=filename,
+                                                    caption="Добро пожаловать! 📄")
+                        logger.info(f"📄 PDF файл отправлен пользователю {user_id}")
+                    except Exception as e:
+                        logger.error(f"❌ Ошибка отправки PDF пользователю {user_id}: {e}")
             
             # Сохраняем пользователя в базу данных
             self.save_user_to_db(user_id, username, first_name)
@@ -154,53 +260,30 @@ class UserBot:
             logger.error(f"❌ Ошибка обработки сообщения в боте {self.user_id}: {e}")
     
     def save_user_to_db(self, user_id: int, username: str, first_name: str):
-        """Сохранение пользователя в базу данных"""
-        try:
-            from database import Database
-            db = Database()
-            db.add_user(user_id, username, first_name)
-        except Exception as e:
-            logger.error(f"❌ Ошибка сохранения пользователя {user_id}: {e}")
+        """Сохранение пользователя в базу данных (через буфер пакетной записи, без ожидания диска)"""
+        ingest.add_user(user_id, username, first_name, bot_user_id=self.user_id)
     
     def save_message_to_db(self, user_id: int, text: str, is_from_user: bool):
-        """Сохранение сообщения в базу данных"""
-        try:
-            from database import Database
-            db = Database()
-            db.add_message(user_id, text, is_from_user, self.user_id)  # Добавляем bot_user_id
-        except Exception as e:
-            logger.error(f"❌ Ошибка сохранения сообщения: {e}")
+        """Сохранение сообщения в базу данных (через буфер пакетной записи, без ожидания диска)"""
+        ingest.add_message(user_id, text, is_from_user, self.user_id)
     
     def get_subscribers_count(self) -> int:
         """Получение количества подписчиков"""
         return len(self.subscribers)
     
-    async def send_broadcast(self, message: str) -> Tuple[int, int]:
+    async def send_broadcast(self, message: str, on_progress=None) -> Tuple[int, int]:
         """Отправка рассылки всем подписчикам"""
-        success_count = 0
-        failed_count = 0
-        
         # Проверяем что бот запущен
         if not self.application or not self.is_running:
             logger.error(f"❌ Бот {self.user_id} не запущен")
             return 0, 1
         
-        # Получаем подписчиков из базы данных
-        from database import Database
-        db = Database()
-        users = db.get_users_for_bot(self.user_id)
+        total = await AsyncDatabase().get_total_subscribers_count(self.user_id, active_only=True)
+        logger.info(f"📤 Начинаем рассылку для бота {self.user_id}, найдено {total} подписчиков")
         
-        logger.info(f"📤 Начинаем рассылку для бота {self.user_id}, найдено {len(users)} подписчиков")
-        
-        for user in users:
-            user_id = user['id']
-            try:
-                await self.application.bot.send_message(chat_id=user_id, text=message)
-                success_count += 1
-                logger.info(f"✅ Сообщение отправлено пользователю {user_id}")
-            except Exception as e:
-                logger.error(f"❌ Ошибка отправки сообщения пользователю {user_id}: {e}")
-                failed_count += 1
+        success_count, failed_count = await self._run_broadcast(
+            make_sender(self.application.bot, text=message), on_progress
+        )
         
         logger.info(f"📊 Рассылка завершена: {success_count} успешно, {failed_count} ошибок")
         return success_count, failed_count
@@ -208,68 +291,145 @@ class UserBot:
     async def send_file_to_user(self, user_id: int, file_path: str, filename: str, caption: str = ""):
         """Отправка файла конкретному пользователю"""
         try:
-            with open(file_path, 'rb') as file:
-                await self.application.bot.send_document(
-                    chat_id=user_id,
-                    document=file,
-                    filename=filename,
-                    caption=caption
-                )
+            document = await FileIdCache.load(self.bot_token, file_path)
+            await document.send(self.application.bot, user_id, filename=filename, caption=caption)
             logger.info(f"✅ Файл {filename} отправлен пользователю {user_id}")
             return True
         except Exception as e:
             logger.error(f"❌ Ошибка отправки файла пользователю {user_id}: {e}")
             return False
     
-    async def send_broadcast_file(self, file_path: str, filename: str, caption: str = "") -> Tuple[int, int]:
+    async def send_broadcast_file(self, file_path: str, filename: str, caption: str = "", on_progress=None) -> Tuple[int, int]:
         """Отправка файла всем подписчикам"""
-        success_count = 0
-        failed_count = 0
+        # Хэш файла и запрос к кэшу file_id выполняются вне event loop бота
+        document = await FileIdCache.load(self.bot_token, file_path)
+        return await self._run_broadcast(
+            make_sender(self.application.bot, document=document, filename=filename, caption=caption),
+            on_progress
+        )
+    
+    async def _run_broadcast(self, send, on_progress=None) -> Tuple[int, int]:
+        """Рассылка активным подписчикам; недоступные (заблокировали бота и т.п.) исключаются из аудитории"""
+        adb = AsyncDatabase()
+        unreachable = []
         
-        # Получаем подписчиков из базы данных
-        from database import Database
-        db = Database()
-        users = db.get_users_for_bot(self.user_id)
+        def on_result(chat_id: int, ok: bool, error: Optional[Exception]):
+            if not ok:
+                kind = classify_delivery_error(error)
+                if kind in PERMANENT_DELIVERY_ERRORS:
+                    unreachable.append((chat_id, kind))
         
-        for user in users:
-            user_id = user['id']
-            try:
-                with open(file_path, 'rb') as file:
-                    await self.application.bot.send_document(
-                        chat_id=user_id,
-                        document=file,
-                        filename=filename,
-                        caption=caption
-                    )
-                success_count += 1
-                logger.info(f"✅ Файл {filename} отправлен пользователю {user_id}")
-            except Exception as e:
-                logger.error(f"❌ Ошибка отправки файла пользователю {user_id}: {e}")
-                failed_count += 1
-        
-        return success_count, failed_count
+        # Подписчики читаются из базы данных пачками по ходу рассылки
+        engine = BroadcastEngine(self.bot_token)
+        try:
+            return await engine.run(adb.iter_recipient_ids(self.user_id), send,
+                                    on_result=on_result, on_progress=on_progress)
+        finally:
+            await adb.deactivate_subscribers(self.user_id, unreachable)
+
+class _EventLoopThread:
+    """Поток с собственным event loop, на котором работают приложения нескольких ботов"""
+    
+    def __init__(self, index: int):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name=f"user-bots-loop-{index}", daemon=True)
+        self.thread.start()
+    
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+    
+    def submit(self, coro) -> concurrent.futures.Future:
+        """Выполнить корутину на этом цикле из любого потока"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
 
 class UserBotManager:
-    """Менеджер всех пользовательских ботов"""
+    """Менеджер всех пользовательских ботов.
+    Все боты работают на небольшом фиксированном числе общих event loop (Config.USER_BOTS_EVENT_LOOPS),
+    add_bot/stop_bot/reload_bot можно вызывать из любого потока.
+    Бот запускается только под арендой в таблице bot_leases, поэтому несколько процессов
+    с менеджерами не опрашивают один токен одновременно."""
     
-    def __init__(self):
+    # Сколько ждать остановки бота, секунд
+    STOP_TIMEOUT = 30
+    
+    def __init__(self, loops: int = None):
         self.user_bots: Dict[int, UserBot] = {}
+        # Числовой id бота в Telegram (часть токена до ':') -> пользователь, для маршрутизации webhook
+        self.telegram_ids: Dict[str, int] = {}
         self.lock = threading.Lock()
+        self.webhook_server = None
+        self.control_server = None
+        self.loop_count = max(1, loops or Config.USER_BOTS_EVENT_LOOPS)
+        self._loops: List[_EventLoopThread] = []
+        self._instance = uuid.uuid4().hex[:8]
+        self._lease_thread: Optional[threading.Thread] = None
+    
+    @property
+    def owner_id(self) -> str:
+        """Владелец аренд: pid вычисляется при обращении, чтобы после fork процессы различались"""
+        return f"{socket.gethostname()}:{os.getpid()}:{self._instance}"
+    
+    def _ensure_lease_keeper(self):
+        """Поток продления аренд (запускается с первым ботом)"""
+        if self._lease_thread is None or not self._lease_thread.is_alive():
+            self._lease_thread = threading.Thread(target=self._keep_leases, name="bot-leases", daemon=True)
+            self._lease_thread.start()
+    
+    def _keep_leases(self):
+        """Продлевать аренды своих ботов; бота, чью аренду перехватили, останавливать"""
+        from database import Database
+        db = Database()
+        while True:
+            time.sleep(Config.BOT_LEASE_RENEW_SECONDS)
+            try:
+                user_ids = list(self.user_bots)
+                held = db.renew_bot_leases(self.owner_id, user_ids, Config.BOT_LEASE_SECONDS)
+                for user_id in set(user_ids) - held:
+                    logger.warning(f"⚠️ Аренда бота {user_id} потеряна, останавливаем его в этом процессе")
+                    self.stop_bot(user_id, release=False)
+            except Exception as e:
+                logger.error(f"❌ Ошибка продления аренд ботов: {e}")
+    
+    def _loop_for(self, user_id: int) -> _EventLoopThread:
+        """Цикл, на котором работает бот пользователя (создаётся при первом обращении)"""
+        if not self._loops:
+            self._loops = [_EventLoopThread(i) for i in range(self.loop_count)]
+        return self._loops[user_id % self.loop_count]
+    
+    def run_coroutine(self, user_id: int, coro) -> concurrent.futures.Future:
+        """Выполнить корутину на цикле бота пользователя (например, user_bot.send_broadcast) из другого потока"""
+        with self.lock:
+            loop_thread = self._loop_for(user_id)
+        return loop_thread.submit(coro)
         
-    def add_bot(self, user_id: int, bot_token: str, bot_username: str, welcome_message: str, start_command: str) -> bool:
-        """Добавление нового бота"""
+    def add_bot(self, user_id: int, bot_token: str, bot_username: str, welcome_message: str, start_command: str,
+                settings: Dict = None) -> bool:
+        """Добавление нового бота (запуск выполняется асинхронно на общем цикле).
+        settings — уже прочитанные user_settings, иначе бот прочитает их сам при запуске.
+        False — бот арендован другим процессом или не удалось его добавить."""
         try:
+            from database import Database
+            
             with self.lock:
-                # Останавливаем существующий бот если есть
+                # Запускаем только бота, аренду которого удалось взять (или продлить свою)
+                if not Database().acquire_bot_lease(user_id, self.owner_id, Config.BOT_LEASE_SECONDS):
+                    logger.debug(f"⏭ Бот пользователя {user_id} уже запущен другим процессом")
+                    return False
+                self._ensure_lease_keeper()
+                
+                # Останавливаем существующий бот если есть (аренда остаётся за нами)
                 if user_id in self.user_bots:
-                    self.stop_bot(user_id)
+                    self._stop_locked(user_id, release=False)
                 
                 # Создаем новый бот
-                user_bot = UserBot(user_id, bot_token, bot_username, welcome_message, start_command)
+                user_bot = UserBot(user_id, bot_token, bot_username, welcome_message, start_command, settings)
                 self.user_bots[user_id] = user_bot
+                self.telegram_ids[bot_token.split(':', 1)[0]] = user_id
                 
-                # Запускаем бота в отдельном потоке
-                threading.Thread(target=self._run_bot, args=(user_id,), daemon=True).start()
+                # Запускаем бота на общем цикле
+                future = self._loop_for(user_id).submit(user_bot.start())
+                future.add_done_callback(lambda f: self._on_started(user_id, f))
                 
                 logger.info(f"✅ Бот пользователя {user_id} добавлен в менеджер")
                 return True
@@ -278,35 +438,30 @@ class UserBotManager:
             logger.error(f"❌ Ошибка добавления бота пользователя {user_id}: {e}")
             return False
     
-    def _run_bot(self, user_id: int):
-        """Запуск бота в отдельном потоке"""
+    def _on_started(self, user_id: int, future: concurrent.futures.Future):
+        if future.cancelled() or future.exception() is not None:
+            logger.error(f"❌ Ошибка запуска бота пользователя {user_id}: {future.exception() if not future.cancelled() else 'отменён'}")
+    
+    def _stop_locked(self, user_id: int, release: bool = True) -> bool:
+        """Остановить бота; вызывается под self.lock. release — отпустить аренду"""
+        user_bot = self.user_bots.pop(user_id, None)
+        if not user_bot:
+            return False
+        self.telegram_ids.pop(user_bot.bot_token.split(':', 1)[0], None)
         try:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            
-            user_bot = self.user_bots.get(user_id)
-            if user_bot:
-                loop.run_until_complete(user_bot.start())
-                loop.run_forever()
-                
-        except Exception as e:
-            logger.error(f"❌ Ошибка запуска бота пользователя {user_id}: {e}")
+            self._loop_for(user_id).submit(user_bot.stop()).result(timeout=self.STOP_TIMEOUT)
+        finally:
+            if release:
+                from database import Database
+                Database().release_bot_lease(user_id, self.owner_id)
+        logger.info(f"🛑 Бот пользователя {user_id} остановлен")
+        return True
     
-    def stop_bot(self, user_id: int) -> bool:
+    def stop_bot(self, user_id: int, release: bool = True) -> bool:
         """Остановка бота пользователя"""
         try:
             with self.lock:
-                if user_id in self.user_bots:
-                    user_bot = self.user_bots[user_id]
-                    loop = asyncio.new_event_loop()
-                    asyncio.set_event_loop(loop)
-                    loop.run_until_complete(user_bot.stop())
-                    loop.close()
-                    
-                    del self.user_bots[user_id]
-                    logger.info(f"🛑 Бот пользователя {user_id} остановлен")
-                    return True
-            return False
+                return self._stop_locked(user_id, release)
             
         except Exception as e:
             logger.error(f"❌ Ошибка остановки бота пользователя {user_id}: {e}")
@@ -316,6 +471,31 @@ class UserBotManager:
         """Получение бота пользователя"""
         return self.user_bots.get(user_id)
     
+    def get_bot_by_telegram_id(self, bot_id: str) -> Optional[UserBot]:
+        """Бот по числовому id из токена (путь webhook)"""
+        user_id = self.telegram_ids.get(bot_id)
+        return self.user_bots.get(user_id) if user_id is not None else None
+    
+    def start_webhook_server(self, host: str = None, port: int = None):
+        """Запустить общий webhook-сервер на первом цикле менеджера"""
+        from bot.webhook_server import WebhookServer
+        
+        with self.lock:
+            if self.webhook_server:
+                return
+            self.webhook_server = WebhookServer(self, host, port)
+            self._loop_for(0).submit(self.webhook_server.start()).result(timeout=self.STOP_TIMEOUT)
+    
+    def start_control_server(self, owns: Callable[[int], bool] = None):
+        """Принимать команды веб-панели (start/stop/reload/status/send) через таблицу bot_commands"""
+        from bot.control import ControlServer
+        
+        with self.lock:
+            if self.control_server:
+                return
+            self.control_server = ControlServer(self, owns)
+            self.control_server.start()
+    
     def get_all_bots(self) -> Dict[int, UserBot]:
         """Получение всех ботов"""
         return self.user_bots.copy()
@@ -327,26 +507,39 @@ class UserBotManager:
             total += bot.get_subscribers_count()
         return total
     
+    def reconfigure_bot(self, user_id: int, settings: Dict) -> bool:
+        """Применить настройки к боту. Если бот работает (или ещё запускается) с тем же токеном, меняются только
+        тексты и приветственный файл (без остановки Application); иначе бот перезапускается."""
+        bot_token = settings.get('bot_token')
+        if not bot_token:
+            return False
+        user_bot = self.get_bot(user_id)
+        if (user_bot and user_bot.bot_token == bot_token and not user_bot.start_failed
+                and (user_bot.is_running or user_bot.is_starting)):
+            user_bot.apply_settings(settings)
+            logger.info(f"🔄 Настройки бота пользователя {user_id} применены без перезапуска "
+                        f"(версия {settings.get('settings_version', 0)})")
+            return True
+        # add_bot сам остановит старый бот и запустит новый с обновленными настройками
+        return self.add_bot(
+            user_id,
+            bot_token,
+            settings.get('bot_username', ''),
+            settings.get('welcome_message', 'Добро пожаловать! 👋'),
+            settings.get('start_command', 'Добро пожаловать! Нажмите /help для справки.'),
+            settings
+        )
+    
     def reload_bot(self, user_id: int) -> bool:
-        """Перезагрузка бота пользователя"""
+        """Перезагрузка бота пользователя (перезапуск только при смене токена)"""
         try:
             # Получаем настройки из базы данных
             from database import Database
             db = Database()
             user_settings = db.get_user_settings(user_id)
             
-            if user_settings and user_settings.get('bot_token'):
-                # Останавливаем старый бот
-                self.stop_bot(user_id)
-                
-                # Запускаем новый с обновленными настройками
-                return self.add_bot(
-                    user_id,
-                    user_settings['bot_token'],
-                    user_settings.get('bot_username', ''),
-                    user_settings.get('welcome_message', 'Добро пожаловать! 👋'),
-                    user_settings.get('start_command', 'Добро пожаловать! Нажмите /help для справки.')
-                )
+            if user_settings:
+                return self.reconfigure_bot(user_id, user_settings)
             
             return False
             
@@ -354,12 +547,65 @@ class UserBotManager:
             logger.error(f"❌ Ошибка перезагрузки бота пользователя {user_id}: {e}")
             return False
     
+    def refresh_settings(self) -> int:
+        """Обновить кэш настроек запущенных ботов, у которых в БД сменилась settings_version.
+        Возвращает число обновлённых ботов."""
+        from database import Database
+        
+        db = Database()
+        bots = self.get_all_bots()
+        refreshed = 0
+        for user_id, version in db.get_settings_versions(list(bots)).items():
+            if version == bots[user_id].settings_version:
+                continue
+            settings = db.get_user_settings(user_id)
+            if settings['bot_token']:
+                self.reconfigure_bot(user_id, settings)
+            else:
+                self.stop_bot(user_id)
+            refreshed += 1
+        return refreshed
+    
+    def sync_with_db(self, owns: Callable[[int], bool] = None) -> Dict[str, int]:
+        """Привести набор запущенных ботов к настройкам в БД.
+        owns(user_id) — отбор ботов этого процесса (например, шард); по умолчанию все.
+        Возвращает, сколько ботов запущено и остановлено."""
+        from database import Database
+        
+        desired = {
+            config['user_id']: config
+            for config in Database().get_active_bot_configs()
+            if owns is None or owns(config['user_id'])
+        }
+        started = stopped = 0
+        for user_id in set(self.user_bots) - set(desired):
+            if self.stop_bot(user_id):
+                stopped += 1
+        for user_id, config in desired.items():
+            running = self.user_bots.get(user_id)
+            # Бот с тем же токеном не трогаем; не запустившийся перезапускаем при следующей сверке
+            if running and running.bot_token == config['bot_token'] and not running.start_failed:
+                continue
+            if self.add_bot(user_id, config['bot_token'], config['bot_username'],
+                            config['welcome_message'], config['start_command']):
+                started += 1
+        return {'started': started, 'stopped': stopped}
+    
     def stop_all_bots(self):
-        """Остановка всех ботов"""
+        """Остановка всех ботов (параллельно на их циклах)"""
         try:
-            user_ids = list(self.user_bots.keys())
-            for user_id in user_ids:
-                self.stop_bot(user_id)
+            with self.lock:
+                futures = [
+                    self._loop_for(user_id).submit(user_bot.stop())
+                    for user_id, user_bot in self.user_bots.items()
+                ]
+                concurrent.futures.wait(futures, timeout=self.STOP_TIMEOUT)
+                self.user_bots.clear()
+                self.telegram_ids.clear()
+                # Дописываем накопленные сообщения до выхода процесса
+                ingest.flush()
+                from database import Database
+                Database().release_bot_leases(self.owner_id)
             logger.info("🛑 Все боты остановлены")
         except Exception as e:
             logger.error(f"❌ Ошибка остановки всех ботов: {e}")
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Webhook-вход для пользовательских ботов
+Один асинхронный HTTP-сервер принимает обновления всех ботов по пути /tg/<bot_id>/<secret>
+и передаёт их в очередь нужного UserBot. Nginx проксирует /tg/ на WEBHOOK_HOST:WEBHOOK_PORT.
+"""
+
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import sys
+from typing import Dict, Optional, Tuple
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Максимальный размер тела обновления
+MAX_BODY_SIZE = 1024 * 1024
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+            405: 'Method Not Allowed', 413: 'Payload Too Large', 503: 'Service Unavailable'}
+
+def webhook_secret(bot_token: str) -> str:
+    """Секрет webhook бота: выводится из SECRET_KEY и токена, хранить его не нужно"""
+    return hmac.new(Config.SECRET_KEY.encode(), bot_token.encode(), hashlib.sha256).hexdigest()[:32]
+
+def webhook_path(bot_token: str) -> str:
+    bot_id = bot_token.split(':', 1)[0]
+    return f"/tg/{bot_id}/{webhook_secret(bot_token)}"
+
+def webhook_url(bot_token: str) -> str:
+    return Config.WEBHOOK_BASE_URL.rstrip('/') + webhook_path(bot_token)
+
+async def read_request(reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+    """Прочитать HTTP/1.1-запрос: (метод, путь, заголовки в нижнем регистре, тело). None — соединение закрыто"""
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length') or 0)
+    if length > MAX_BODY_SIZE:
+        raise ValueError('payload too large')
+    body = await reader.readexactly(length) if length else b''
+    return method, path, headers, body
+
+class WebhookServer:
+    """HTTP-сервер обновлений Telegram для всех ботов менеджера"""
+
+    def __init__(self, manager, host: str = None, port: int = None):
+        self.manager = manager
+        self.host = host or Config.WEBHOOK_HOST
+        self.port = port or Config.WEBHOOK_PORT
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        logger.info(f"🌐 Webhook-сервер слушает {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Соединение с keep-alive: запросы обрабатываются по очереди"""
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                status = await self._dispatch(method, path, headers, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                writer.write(
+                    f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+                    f"Content-Length: 0\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode()
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method: str, path: str, headers: Dict[str, str], body: bytes) -> int:
+        """Передать обновление боту. Код ответа: 200 — принято, 503 — очередь бота полна (Telegram повторит)"""
+        if method != 'POST':
+            return 405
+        parts = path.split('?', 1)[0].strip('/').split('/')
+        if len(parts) != 3 or parts[0] != 'tg':
+            return 404
+        _, bot_id, secret = parts
+
+        user_bot = self.manager.get_bot_by_telegram_id(bot_id)
+        if not user_bot:
+            return 404
+        expected = webhook_secret(user_bot.bot_token)
+        if not hmac.compare_digest(secret, expected):
+            return 404
+        header_secret = headers.get('x-telegram-bot-api-secret-token')
+        if header_secret is not None and not hmac.compare_digest(header_secret, expected):
+            return 403
+
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return 400
+
+        bot_loop = user_bot.loop
+        if bot_loop is None:
+            return 503
+        if bot_loop is asyncio.get_running_loop():
+            accepted = await user_bot.enqueue_update(data)
+        else:
+            accepted = await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(user_bot.enqueue_update(data), bot_loop))
+        return 200 if accepted else 503
+
+def send_stub_update(user_id: int, text: str, chat_id: int = None, url: str = None) -> int:
+    """Локальная заглушка Telegram: отправить боту пользователя обновление с текстовым сообщением.
+    Возвращает HTTP-код ответа webhook-сервера."""
+    import time
+    import httpx
+    from database import Database
+
+    bot_token = Database().get_user_settings(user_id).get('bot_token')
+    if not bot_token:
+        raise ValueError(f"У пользователя {user_id} нет токена бота")
+    chat_id = chat_id or 1
+    now = int(time.time())
+    update = {
+        'update_id': now,
+        'message': {
+            'message_id': now,
+            'date': now,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Stub'},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}] if text.startswith('/') else [],
+        },
+    }
+    base = url or f"http://{Config.WEBHOOK_HOST}:{Config.WEBHOOK_PORT}"
+    response = httpx.post(base.rstrip('/') + webhook_path(bot_token), json=update,
+                          headers={'X-Telegram-Bot-Api-Secret-Token': webhook_secret(bot_token)})
+    return response.status_code
+
+if __name__ == '__main__':
+    # python -m bot.webhook_server <user_id> "/start" [chat_id]
+    if len(sys.argv) < 3:
+        print('Использование: python -m bot.webhook_server <user_id> <текст> [chat_id]')
+        sys.exit(1)
+    print(send_stub_update(int(sys.argv[1]), sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else None))
@@ -26,3 +26,69 @@ class Config:
         '.zip', '.rar', '.7z'
     }
     UPLOAD_MAX_FILES = 5
+    
+    # Рассылки: лимиты Telegram Bot API (~30 сообщений/с на бота, не чаще 1 сообщения/с в один чат)
+    BROADCAST_RATE_PER_SECOND = float(os.environ.get('BROADCAST_RATE_PER_SECOND') or 30)
+    BROADCAST_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY') or 16)
+    BROADCAST_MAX_RETRIES = int(os.environ.get('BROADCAST_MAX_RETRIES') or 3)
+    
+    # Пользовательские боты: сколько общих event loop (потоков) обслуживают всех ботов
+    USER_BOTS_EVENT_LOOPS = int(os.environ.get('USER_BOTS_EVENT_LOOPS') or 1)
+    
+    # Вход обновлений: polling (getUpdates на каждого бота) или webhook (общий сервер /tg/<bot_id>/<secret>)
+    BOT_INGRESS = os.environ.get('BOT_INGRESS', 'polling').lower()
+    WEBHOOK_BASE_URL = os.environ.get('WEBHOOK_BASE_URL') or 'https://bot.tildahelp.ru'
+    WEBHOOK_HOST = os.environ.get('WEBHOOK_HOST') or '127.0.0.1'
+    WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT') or 8443)
+    WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE') or 100)
+    WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('WEBHOOK_MAX_CONNECTIONS') or 40)
+    
+    # Аренда ботов в БД: токен опрашивает только процесс, держащий аренду (секунды)
+    BOT_LEASE_SECONDS = int(os.environ.get('BOT_LEASE_SECONDS') or 60)
+    BOT_LEASE_RENEW_SECONDS = float(os.environ.get('BOT_LEASE_RENEW_SECONDS') or 20)
+    
+    # Управление ботами из веб-панели через таблицу bot_commands: опрос раннером и ожидание ответа, секунды
+    CONTROL_POLL_SECONDS = float(os.environ.get('CONTROL_POLL_SECONDS') or 0.2)
+    CONTROL_TIMEOUT_SECONDS = float(os.environ.get('CONTROL_TIMEOUT_SECONDS') or 10)
+    # Как часто раннер сверяет версии настроек запущенных ботов с БД, секунды
+    SETTINGS_POLL_SECONDS = float(os.environ.get('SETTINGS_POLL_SECONDS') or 1)
+    
+    # Многопроцессный запуск ботов (run_bot_shards.py): число шардов, период сверки с БД и отчёта, секунды
+    BOT_SHARDS = int(os.environ.get('BOT_SHARDS') or os.cpu_count() or 1)
+    SHARD_SYNC_SECONDS = float(os.environ.get('SHARD_SYNC_SECONDS') or 30)
+    SHARD_REPORT_SECONDS = float(os.environ.get('SHARD_REPORT_SECONDS') or 60)
+    
+    # Потоки БД для AsyncDatabase (запросы обработчиков ботов выполняются вне event loop)
+    DB_EXECUTOR_THREADS = int(os.environ.get('DB_EXECUTOR_THREADS') or 4)
+    
+    # Буфер записи входящих сообщений: пачка пишется раз в INGEST_FLUSH_MS мс или при INGEST_BATCH_SIZE строк
+    INGEST_FLUSH_MS = int(os.environ.get('INGEST_FLUSH_MS') or 200)
+    INGEST_BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE') or 500)
+    # Предел строк в буфере (новые строки сверх него отбрасываются со счётчиком) и число повторов пачки
+    # перед построчной записью (строки, которые не записываются, уходят в dead-letter)
+    INGEST_MAX_PENDING = int(os.environ.get('INGEST_MAX_PENDING') or 50000)
+    INGEST_MAX_RETRIES = int(os.environ.get('INGEST_MAX_RETRIES') or 3)
+    
+    # Клиент Bot API: пул keep-alive соединений на токен бота, таймауты (с), HTTP/2 (нужен пакет h2)
+    BOT_API_POOL_SIZE = int(os.environ.get('BOT_API_POOL_SIZE') or 16)
+    BOT_API_TIMEOUT = float(os.environ.get('BOT_API_TIMEOUT') or 30)
+    BOT_API_CONNECT_TIMEOUT = float(os.environ.get('BOT_API_CONNECT_TIMEOUT') or 10)
+    BOT_API_HTTP2 = os.environ.get('BOT_API_HTTP2', 'false').lower() == 'true'
+    
+    # Страница списка диалогов (/dialogs)
+    DIALOGS_PAGE_SIZE = int(os.environ.get('DIALOGS_PAGE_SIZE') or 50)
+    
+    # Поток событий диалогов (run_dialog_stream.py): адрес, путь для браузера и период чтения новых сообщений, мс
+    STREAM_HOST = os.environ.get('STREAM_HOST', '127.0.0.1')
+    STREAM_PORT = int(os.environ.get('STREAM_PORT') or 8444)
+    STREAM_URL = os.environ.get('STREAM_URL', '/api/stream/dialogs')
+    STREAM_POLL_MS = int(os.environ.get('STREAM_POLL_MS') or 300)
+    
+    # Очередь рассылок (воркер run_broadcast_worker.py)
+    BROADCAST_LEASE_SECONDS = int(os.environ.get('BROADCAST_LEASE_SECONDS') or 60)
+    BROADCAST_HEARTBEAT_SECONDS = int(os.environ.get('BROADCAST_HEARTBEAT_SECONDS') or 15)
+    BROADCAST_POLL_SECONDS = float(os.environ.get('BROADCAST_POLL_SECONDS') or 2)
+    BROADCAST_MAX_ATTEMPTS = int(os.environ.get('BROADCAST_MAX_ATTEMPTS') or 5)
+    # Итоги доставки пишутся пачкой при накоплении DELIVERY_FLUSH_SIZE результатов или раз в DELIVERY_FLUSH_SECONDS
+    DELIVERY_FLUSH_SIZE = int(os.environ.get('DELIVERY_FLUSH_SIZE') or 1000)
+    DELIVERY_FLUSH_SECONDS = float(os.environ.get('DELIVERY_FLUSH_SECONDS') or 5)
@@ -1,184 +1,128 @@
 import sqlite3
+import asyncio
+import functools
+import json
 import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+from migrations import migrate, pack_ids, unpack_ids
 
 logger = logging.getLogger(__name__)
 
+# PRAGMA, применяемые один раз при открытии соединения
+SQLITE_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA cache_size=-20000',  # ~20MB страничного кеша на соединение
+    'PRAGMA temp_store=MEMORY',
+)
+
+# Пул соединений: одно долгоживущее соединение на поток (и его event loop) для каждого файла БД
+_pool = threading.local()
+
+# Файлы БД, для которых миграции уже применены в этом процессе
+_initialized_paths = set()
+_init_lock = threading.Lock()
+
+def _now_ms() -> int:
+    """Текущее время в unix-миллисекундах"""
+    return int(time.time() * 1000)
+
+def _hour_ms(ms: int) -> int:
+    """Начало часа (unix-ms) для метки времени в unix-ms"""
+    return ms - ms % 3600000
+
+def _to_ms(value) -> int:
+    """Перевод метки времени (unix-ms, datetime или isoformat-строка в локальном времени) в unix-ms"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return int(value.timestamp() * 1000)
+
+def _ms_to_iso(ts_ms: Optional[int]) -> Optional[str]:
+    """unix-ms в isoformat локального времени (как раньше хранилось в messages.timestamp)"""
+    if ts_ms is None:
+        return None
+    return datetime.fromtimestamp(ts_ms / 1000).isoformat()
+
 class Database:
     def __init__(self, db_path: str = 'data/bot.db'):
         self.db_path = db_path
         self.init_database()
     
-    def init_database(self):
-        """Инициализация базы данных и создание таблиц"""
+    def _get_connection(self) -> sqlite3.Connection:
+        """Постоянное соединение текущего потока"""
+        connections = getattr(_pool, 'connections', None)
+        if connections is None:
+            connections = _pool.connections = {}
+        
+        entry = connections.get(self.db_path)
+        # После fork (gunicorn preload_app) соединение родителя использовать нельзя
+        if entry is not None and entry[0] == os.getpid():
+            return entry[1]
+        
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        connections[self.db_path] = (os.getpid(), conn)
+        logger.debug(f"Открыто соединение с БД {self.db_path} в потоке {threading.current_thread().name}")
+        return conn
+    
+    @contextmanager
+    def transaction(self):
+        """Транзакция на соединении потока: commit при успехе, rollback при ошибке.
+        Вложенные вызовы выполняются внутри внешней транзакции."""
+        conn = self._get_connection()
+        depths = getattr(_pool, 'depths', None)
+        if depths is None:
+            depths = _pool.depths = {}
+        depth = depths.get(self.db_path, 0)
+        depths[self.db_path] = depth + 1
         try:
-            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
-            
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                # Таблица пользователей
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS users (
-                        id INTEGER PRIMARY KEY,
-                        username TEXT,
-                        first_name TEXT,
-                        last_name TEXT,
-                        full_name TEXT,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        last_message_text TEXT,
-                        last_message_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-                
-                # Таблица сообщений
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS messages (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER NOT NULL,
-                        text TEXT NOT NULL,
-                        is_from_user BOOLEAN NOT NULL,
-                        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        bot_user_id INTEGER,
-                        FOREIGN KEY (user_id) REFERENCES users (id),
-                        FOREIGN KEY (bot_user_id) REFERENCES system_users (id)
-                    )
-                ''')
-                
-                # Таблица настроек (общие для системы)
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS settings (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        key TEXT UNIQUE NOT NULL,
-                        value TEXT,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-                
-                # Таблица пользователей системы
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS system_users (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        username TEXT UNIQUE NOT NULL,
-                        password_hash TEXT NOT NULL,
-                        role TEXT DEFAULT 'user',
-                        full_name TEXT,
-                        email TEXT,
-                        account_expires TIMESTAMP,
-                        is_active BOOLEAN DEFAULT 1,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        last_login TIMESTAMP,
-                        created_by INTEGER,
-                        FOREIGN KEY (created_by) REFERENCES system_users (id)
-                    )
-                ''')
-                
-                # Таблица индивидуальных настроек пользователей
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS user_settings (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER NOT NULL,
-                        welcome_message TEXT DEFAULT 'Добро пожаловать! 👋',
-                        welcome_pdf_path TEXT DEFAULT '',
-                        welcome_file_id TEXT DEFAULT '',
-                        welcome_file_caption TEXT DEFAULT '',
-                        bot_token TEXT DEFAULT '',
-                        bot_username TEXT DEFAULT '',
-                        bot_name TEXT DEFAULT 'Мой бот',
-                        bot_description TEXT DEFAULT '',
-                        start_command TEXT DEFAULT 'Добро пожаловать! Нажмите /help для справки.',
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES system_users (id)
-                    )
-                ''')
-                
-                # ===== Дополнительные таблицы для рассылок и логов доставки =====
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS campaigns (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER NOT NULL,
-                        text TEXT,
-                        photo_file_id TEXT,
-                        scheduled_at TIMESTAMP,
-                        status TEXT DEFAULT 'scheduled', -- scheduled, sending, sent, failed, canceled
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES system_users (id)
-                    )
-                ''')
-                
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS delivery_logs (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER NOT NULL,         -- подписчик (получатель)
-                        bot_user_id INTEGER NOT NULL,     -- владелец бота
-                        campaign_id INTEGER,
-                        status TEXT NOT NULL,             -- success, failed
-                        error TEXT,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (bot_user_id) REFERENCES system_users (id),
-                        FOREIGN KEY (campaign_id) REFERENCES campaigns (id)
-                    )
-                ''')
-                
-                # Миграции-страховки: добавляем недостающие колонки, если таблица уже была
-                for alter in [
-                    "ALTER TABLE user_settings ADD COLUMN welcome_file_id TEXT",
-                    "ALTER TABLE user_settings ADD COLUMN welcome_file_caption TEXT",
-                    "ALTER TABLE user_settings ADD COLUMN bot_token TEXT",
-                    "ALTER TABLE user_settings ADD COLUMN bot_username TEXT"
-                ]:
-                    try:
-                        cursor.execute(alter)
-                    except sqlite3.OperationalError:
-                        pass
-                
-                # Миграция: добавляем поле bot_user_id если его нет
-                try:
-                    cursor.execute('ALTER TABLE messages ADD COLUMN bot_user_id INTEGER')
-                    logger.info("Добавлено поле bot_user_id в таблицу messages")
-                except sqlite3.OperationalError:
-                    # Поле уже существует
-                    pass
-                
-                # Очищаем дублирующиеся записи пользователей
-                try:
-                    cursor.execute('''
-                        DELETE FROM users 
-                        WHERE id IN (
-                            SELECT id FROM users 
-                            GROUP BY id 
-                            HAVING COUNT(*) > 1
-                        )
-                    ''')
-                    logger.info("Очищены дублирующиеся записи пользователей")
-                except Exception as e:
-                    logger.warning(f"Ошибка очистки дублей: {e}")
-                
-                # Создаем индексы для быстрого поиска
-                cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages(user_id)')
-                cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp)')
-                cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_bot_user_id ON messages(bot_user_id)')
-                cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)')
-                cursor.execute('CREATE INDEX IF NOT EXISTS idx_system_users_username ON system_users(username)')
-                cursor.execute('CREATE INDEX IF NOT EXISTS idx_system_users_role ON system_users(role)')
-                cursor.execute('CREATE INDEX IF NOT EXISTS idx_system_users_expires ON system_users(account_expires)')
-                
+            yield conn
+            if depth == 0:
                 conn.commit()
-                logger.info("База данных инициализирована успешно")
-                
-        except Exception as e:
-            logger.error(f"Ошибка инициализации базы данных: {e}")
+        except BaseException:
+            if depth == 0:
+                conn.rollback()
             raise
+        finally:
+            depths[self.db_path] = depth
+    
+    def close(self):
+        """Закрыть соединение текущего потока"""
+        connections = getattr(_pool, 'connections', None) or {}
+        entry = connections.pop(self.db_path, None)
+        if entry is not None and entry[0] == os.getpid():
+            entry[1].close()
+    
+    def init_database(self):
+        """Инициализация схемы: миграции применяются один раз на процесс"""
+        with _init_lock:
+            if self.db_path in _initialized_paths:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+                migrate(self._get_connection())
+                _initialized_paths.add(self.db_path)
+                logger.info("База данных инициализирована успешно")
+            except Exception as e:
+                logger.error(f"Ошибка инициализации базы данных: {e}")
+                raise
     
-    def add_user(self, user_id: int, username: str = None, first_name: str = None, last_name: str = None) -> bool:
-        """Добавление или обновление пользователя"""
+    def add_user(self, user_id: int, username: str = None, first_name: str = None, last_name: str = None,
+                 bot_user_id: int = None) -> bool:
+        """Добавление или обновление пользователя (и подписка на бота, если указан bot_user_id)"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.transaction() as conn:
                 cursor = conn.cursor()
                 
                 full_name = f"{first_name or ''} {last_name or ''}".strip()
@@ -188,7 +132,12 @@ class Database:
                     VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
                 ''', (user_id, username, first_name, last_name, full_name))
                 
-                conn.commit()
+                if bot_user_id is not None:
+                    # Как в ingest_batch: подписка и диалог появляются при первом контакте (/start)
+                    now_ms = _now_ms()
+                    self._touch_subscriber(cursor, bot_user_id, user_id, now_ms)
+                    self._touch_thread(cursor, bot_user_id, user_id, now_ms)
+                
                 logger.info(f"Пользователь {user_id} добавлен/обновлен в БД")
                 return True
                 
@@ -199,7 +148,7 @@ class Database:
     def get_user(self, user_id: int) -> Optional[Dict]:
         """Получение информации о пользователе"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.transaction() as conn:
                 cursor = conn.cursor()
                 
                 cursor.execute('''
@@ -227,19 +176,18 @@ class Database:
     def get_all_users(self) -> List[Dict]:
         """Получение всех пользователей"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.transaction() as conn:
                 cursor = conn.cursor()
                 
                 cursor.execute('''
                     SELECT u.id, u.username, u.first_name, u.last_name, u.full_name, 
                            u.created_at, u.last_activity,
-                           m.text as last_message_text, m.timestamp as last_message_time
+                           m.text as last_message_text, m.ts as last_message_time
                     FROM users u
-                    LEFT JOIN (
-                        SELECT user_id, text, timestamp,
-                               ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY timestamp DESC) as rn
-                        FROM messages
-                    ) m ON u.id = m.user_id AND m.rn = 1
+                    LEFT JOIN messages m ON m.id = (
+                        -- Последнее сообщение пользователя: один шаг по idx_messages_user_id(user_id, id)
+                        SELECT id FROM messages WHERE user_id = u.id ORDER BY id DESC LIMIT 1
+                    )
                     ORDER BY u.last_activity DESC
                 ''')
                 
@@ -254,7 +202,7 @@ class Database:
                         'created_at': row[5],
                         'last_activity': row[6],
                         'last_message_text': row[7],
-                        'last_message_time': row[8]
+                        'last_message_time': _ms_to_iso(row[8])
                     })
                 
                 return users
@@ -268,7 +216,7 @@ class Database:
         """Создать или получить system_user для владельца по его Telegram ID.
         Используем telegram_user_id как первичный ключ для удобной связи."""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.transaction() as conn:
                 cursor = conn.cursor()
                 
                 # Пытаемся получить по id
@@ -291,7 +239,6 @@ class Database:
                     INSERT INTO system_users (id, username, password_hash, role, full_name, is_active, created_at)
                     VALUES (?, ?, ?, 'user', ?, 1, CURRENT_TIMESTAMP)
                 ''', (telegram_user_id, username or f"user_{telegram_user_id}", password_hash, full_name))
-                conn.commit()
                 return telegram_user_id
         except Exception as e:
             logger.error(f"Ошибка upsert system_user от Telegram ID {telegram_user_id}: {e}")
@@ -300,71 +247,194 @@ class Database:
     def add_message(self, user_id: int, text: str, is_from_user: bool = True, bot_user_id = None) -> bool:
         """Добавление сообщения"""
         try:
-            logger.info(f"🔍 Database.add_message: user_id={user_id}, text='{text[:50]}...', is_from_user={is_from_user}, bot_user_id={bot_user_id}")
-            # Логируем в файл
-            with open('/tmp/debug.log', 'a') as f:
-                f.write(f"🔍 DEBUG: Database.add_message: user_id={user_id}, text='{text[:50]}...', is_from_user={is_from_user}, bot_user_id={bot_user_id}\n")
-            
-            with sqlite3.connect(self.db_path) as conn:
+            with self.transaction() as conn:
                 cursor = conn.cursor()
                 
-                # Проверяем существует ли пользователь
-                cursor.execute('SELECT id FROM users WHERE id = ?', (user_id,))
-                user_exists = cursor.fetchone()
-                
-                if not user_exists:
-                    logger.warning(f"⚠️ Пользователь {user_id} не найден в БД, создаем...")
-                    cursor.execute('''
-                        INSERT OR IGNORE INTO users (id, username, first_name, last_name, full_name)
-                        VALUES (?, ?, ?, ?, ?)
-                    ''', (user_id, f'user_{user_id}', '', '', f'User {user_id}'))
-                
-                # Добавляем сообщение
-                logger.info(f"💾 Добавляем сообщение в БД...")
-                current_time = datetime.now().isoformat()
+                # Заглушка пользователя, если он ещё не сохранён (без отдельного SELECT)
                 cursor.execute('''
-                    INSERT INTO messages (user_id, text, is_from_user, timestamp, bot_user_id)
+                    INSERT OR IGNORE INTO users (id, username, first_name, last_name, full_name)
                     VALUES (?, ?, ?, ?, ?)
-                ''', (user_id, text, is_from_user, current_time, bot_user_id))
+                ''', (user_id, f'user_{user_id}', '', '', f'User {user_id}'))
+                
+                now_ms = _now_ms()
+                cursor.execute('''
+                    INSERT INTO messages (user_id, text, is_from_user, timestamp, ts, bot_user_id)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (user_id, text, is_from_user, _ms_to_iso(now_ms), now_ms, bot_user_id))
+                
+                # Обновляем материализованный список подписчиков бота и диалог
+                if bot_user_id is not None:
+                    message_id = cursor.lastrowid
+                    self._touch_subscriber(cursor, bot_user_id, user_id, now_ms,
+                                           message_id=message_id, inbound=is_from_user)
+                    self._touch_thread(cursor, bot_user_id, user_id, now_ms,
+                                       message_id=message_id, text=text, inbound=is_from_user)
                 
                 # Обновляем время последней активности пользователя
                 cursor.execute('''
                     UPDATE users SET last_activity = CURRENT_TIMESTAMP WHERE id = ?
                 ''', (user_id,))
                 
-                conn.commit()
-                logger.info(f"✅ Сообщение успешно добавлено для пользователя {user_id}")
-                
-                # Проверяем что сообщение действительно сохранилось
-                cursor.execute('''
-                    SELECT COUNT(*) FROM messages 
-                    WHERE user_id = ? AND bot_user_id = ?
-                ''', (user_id, bot_user_id))
-                count = cursor.fetchone()[0]
-                logger.info(f"📊 Всего сообщений у пользователя {user_id} с ботом {bot_user_id}: {count}")
-                # Логируем в файл
-                with open('/tmp/debug.log', 'a') as f:
-                    f.write(f"📊 DEBUG: Всего сообщений у пользователя {user_id} с ботом {bot_user_id}: {count}\n")
-                
+                logger.debug(f"Сообщение пользователя {user_id} (бот {bot_user_id}) сохранено")
                 return True
                 
         except Exception as e:
             logger.error(f"❌ Ошибка добавления сообщения для пользователя {user_id}: {e}")
-            import traceback
-            logger.error(f"🔍 Traceback: {traceback.format_exc()}")
             return False
     
+    def ingest_batch(self, users: List[tuple], messages: List[tuple]) -> int:
+        """Пакетная запись входящих данных одной транзакцией (буфер bot/ingest.py).
+        users: (user_id, username, first_name, last_name, bot_user_id, ts_ms)
+        messages: (user_id, text, is_from_user, bot_user_id, ts_ms)
+        Возвращает число записанных строк."""
+        if not users and not messages:
+            return 0
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            
+            if users:
+                cursor.executemany('''
+                    INSERT OR REPLACE INTO users (id, username, first_name, last_name, full_name, last_activity)
+                    VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ''', [
+                    (user_id, username, first_name, last_name, f"{first_name or ''} {last_name or ''}".strip())
+                    for user_id, username, first_name, last_name, _, _ in users
+                ])
+                for user_id, _, _, _, bot_user_id, ts_ms in users:
+                    if bot_user_id is not None:
+                        self._touch_subscriber(cursor, bot_user_id, user_id, ts_ms)
+                        self._touch_thread(cursor, bot_user_id, user_id, ts_ms)
+            
+            if messages:
+                cursor.executemany('''
+                    INSERT OR IGNORE INTO users (id, username, first_name, last_name, full_name)
+                    VALUES (?, ?, '', '', ?)
+                ''', [(user_id, f'user_{user_id}', f'User {user_id}') for user_id in {m[0] for m in messages}])
+                
+                cursor.executemany('''
+                    INSERT INTO messages (user_id, text, is_from_user, timestamp, ts, bot_user_id)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', [
+                    (user_id, text, is_from_user, _ms_to_iso(ts_ms), ts_ms, bot_user_id)
+                    for user_id, text, is_from_user, bot_user_id, ts_ms in messages
+                ])
+                # Под блокировкой записи id вставленных строк идут подряд и заканчиваются last_insert_rowid()
+                cursor.execute('SELECT last_insert_rowid()')
+                first_id = cursor.fetchone()[0] - len(messages) + 1
+                for offset, (user_id, text, is_from_user, bot_user_id, ts_ms) in enumerate(messages):
+                    if bot_user_id is not None:
+                        self._touch_subscriber(cursor, bot_user_id, user_id, ts_ms,
+                                               message_id=first_id + offset, inbound=is_from_user)
+                        self._touch_thread(cursor, bot_user_id, user_id, ts_ms,
+                                           message_id=first_id + offset, text=text, inbound=is_from_user)
+                
+                cursor.executemany('''
+                    UPDATE users SET last_activity = CURRENT_TIMESTAMP WHERE id = ?
+                ''', [(user_id,) for user_id in {m[0] for m in messages}])
+        
+        return len(users) + len(messages)
+    
+    def _touch_subscriber(self, cursor, bot_user_id: int, user_id: int, now_ms: int,
+                          message_id: int = None, inbound: bool = True):
+        """Инкрементальное обновление bot_subscribers и почасовой статистики bot_stats_rollup.
+        Подписчиком пользователь становится только по своей активности (входящее сообщение или /start):
+        исходящее сообщение незнакомому пользователю подписчика не создаёт.
+        last_seen отражает только активность самого подписчика."""
+        has_message = message_id is not None
+        if not inbound:
+            cursor.execute('''
+                UPDATE bot_subscribers SET
+                    last_message_id = COALESCE(?, last_message_id),
+                    message_count = message_count + ?
+                WHERE bot_user_id = ? AND user_id = ?
+            ''', (message_id, int(has_message), bot_user_id, user_id))
+            self._bump_rollup(cursor, bot_user_id, _hour_ms(now_ms), messages_out=int(has_message))
+            return
+        
+        cursor.execute('''
+            SELECT 1 FROM bot_subscribers WHERE bot_user_id = ? AND user_id = ?
+        ''', (bot_user_id, user_id))
+        is_new = cursor.fetchone() is None
+        
+        cursor.execute('''
+            INSERT INTO bot_subscribers (bot_user_id, user_id, first_seen, last_seen, last_message_id, message_count)
+            VALUES (:bot_user_id, :user_id, :now, :now, :message_id, :count)
+            ON CONFLICT (bot_user_id, user_id) DO UPDATE SET
+                last_seen = MAX(last_seen, excluded.last_seen),
+                last_message_id = COALESCE(excluded.last_message_id, last_message_id),
+                message_count = message_count + excluded.message_count,
+                -- Подписчик снова написал боту: значит, бот ему доступен
+                status = 'active',
+                inactive_reason = NULL,
+                inactive_since = NULL
+        ''', {
+            'bot_user_id': bot_user_id,
+            'user_id': user_id,
+            'now': now_ms,
+            'message_id': message_id,
+            'count': int(has_message),
+        })
+        
+        self._bump_rollup(
+            cursor, bot_user_id, _hour_ms(now_ms),
+            messages_in=int(has_message),
+            new_subscribers=int(is_new),
+        )
+    
+    def _touch_thread(self, cursor, bot_user_id: int, user_id: int, ts_ms: int,
+                      message_id: int = None, text: str = None, inbound: bool = True):
+        """Обновление строки диалога в threads. Без message_id — только создать диалог (первый контакт)"""
+        if message_id is None:
+            cursor.execute('''
+                INSERT OR IGNORE INTO threads (bot_user_id, user_id, last_message_at) VALUES (?, ?, ?)
+            ''', (bot_user_id, user_id, ts_ms))
+            return
+        cursor.execute('''
+            INSERT INTO threads (bot_user_id, user_id, last_message_id, last_message_text, last_message_at,
+                                 unread_count, message_count)
+            VALUES (:bot_user_id, :user_id, :message_id, substr(:text, 1, 200), :ts, :unread, 1)
+            ON CONFLICT (bot_user_id, user_id) DO UPDATE SET
+                last_message_id = excluded.last_message_id,
+                last_message_text = excluded.last_message_text,
+                last_message_at = MAX(last_message_at, excluded.last_message_at),
+                -- ответ администратора означает, что диалог прочитан
+                unread_count = CASE WHEN :inbound THEN unread_count + 1 ELSE 0 END,
+                message_count = message_count + 1
+        ''', {
+            'bot_user_id': bot_user_id,
+            'user_id': user_id,
+            'message_id': message_id,
+            'text': text or '',
+            'ts': ts_ms,
+            'unread': int(bool(inbound)),
+            'inbound': bool(inbound),
+        })
+    
+    def _bump_rollup(self, cursor, bot_user_id: int, hour: int, messages_in: int = 0, messages_out: int = 0,
+                     new_subscribers: int = 0):
+        """Увеличение счётчиков почасовой статистики бота"""
+        if not (messages_in or messages_out or new_subscribers):
+            return
+        cursor.execute('''
+            INSERT INTO bot_stats_rollup (bot_user_id, hour, messages_in, messages_out, new_subscribers)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (bot_user_id, hour) DO UPDATE SET
+                messages_in = messages_in + excluded.messages_in,
+                messages_out = messages_out + excluded.messages_out,
+                new_subscribers = new_subscribers + excluded.new_subscribers
+        ''', (bot_user_id, hour, messages_in, messages_out, new_subscribers))
+    
     def get_user_messages(self, user_id: int, limit: int = 100) -> List[Dict]:
         """Получение сообщений пользователя"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.transaction() as conn:
                 cursor = conn.cursor()
                 
                 cursor.execute('''
-                    SELECT id, text, is_from_user, timestamp
+                    SELECT id, text, is_from_user, ts
                     FROM messages 
                     WHERE user_id = ?
-                    ORDER BY timestamp ASC
+                    ORDER BY id ASC
                     LIMIT ?
                 ''', (user_id, limit))
                 
@@ -374,7 +444,7 @@ class Database:
                         'id': row[0],
                         'text': row[1],
                         'is_from_user': bool(row[2]),
-                        'timestamp': row[3]
+                        'timestamp': _ms_to_iso(row[3])
                     })
                 
                 return messages
@@ -386,7 +456,7 @@ class Database:
     def get_setting(self, key: str) -> Optional[str]:
         """Получение настройки"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.transaction() as conn:
                 cursor = conn.cursor()
                 
                 cursor.execute('SELECT value FROM settings WHERE key = ?', (key,))
@@ -401,7 +471,7 @@ class Database:
     def set_setting(self, key: str, value: str) -> bool:
         """Установка настройки"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.transaction() as conn:
                 cursor = conn.cursor()
                 
                 cursor.execute('''
@@ -409,7 +479,6 @@ class Database:
                     VALUES (?, ?, CURRENT_TIMESTAMP)
                 ''', (key, value))
                 
-                conn.commit()
                 return True
                 
         except Exception as e:
@@ -419,7 +488,7 @@ class Database:
     def get_subscribers_count(self) -> int:
         """Получение количества подписчиков"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.transaction() as conn:
                 cursor = conn.cursor()
                 
                 cursor.execute('SELECT COUNT(*) FROM users')
@@ -432,16 +501,15 @@ class Database:
     def cleanup_old_messages(self, days: int = 30) -> int:
         """Очистка старых сообщений"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.transaction() as conn:
                 cursor = conn.cursor()
                 
                 cursor.execute('''
                     DELETE FROM messages 
-                    WHERE timestamp < datetime('now', '-{} days')
-                '''.format(days))
+                    WHERE ts < ?
+                ''', (_now_ms() - days * 86400000,))
                 
                 deleted_count = cursor.rowcount
-                conn.commit()
                 
                 logger.info(f"Удалено {deleted_count} старых сообщений")
                 return deleted_count
@@ -457,7 +525,7 @@ class Database:
                           account_expires: str = None, created_by: int = None) -> bool:
         """Создание системного пользователя"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.transaction() as conn:
                 cursor = conn.cursor()
                 
                 cursor.execute('''
@@ -466,7 +534,6 @@ class Database:
                     VALUES (?, ?, ?, ?, ?, ?, ?)
                 ''', (username, password_hash, role, full_name, email, account_expires, created_by))
                 
-                conn.commit()
                 logger.info(f"Создан системный пользователь: {username} с ролью {role}")
                 return True
                 
@@ -476,7 +543,7 @@ class Database:
     
     def get_system_user(self, username_or_id):
         """Получить пользователя системы по username или ID"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
             
             # Проверяем, является ли параметр числом (ID) или строкой (username)
@@ -517,14 +584,13 @@ class Database:
     def update_system_user_password(self, username: str, new_password_hash: str) -> bool:
         """Обновление пароля системного пользователя"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.transaction() as conn:
                 cursor = conn.cursor()
                 
                 cursor.execute('''
                     UPDATE system_users SET password_hash = ? WHERE username = ?
                 ''', (new_password_hash, username))
                 
-                conn.commit()
                 logger.info(f"Пароль обновлен для пользователя {username}")
                 return True
                 
@@ -535,14 +601,13 @@ class Database:
     def update_system_user_expiry(self, username: str, account_expires: str) -> bool:
         """Обновление времени истечения аккаунта"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.transaction() as conn:
                 cursor = conn.cursor()
                 
                 cursor.execute('''
                     UPDATE system_users SET account_expires = ? WHERE username = ?
                 ''', (account_expires, username))
                 
-                conn.commit()
                 logger.info(f"Время истечения обновлено для пользователя {username}: {account_expires}")
                 return True
                 
@@ -553,7 +618,7 @@ class Database:
     def get_expired_accounts(self) -> List[Dict]:
         """Получение списка истекших аккаунтов"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.transaction() as conn:
                 cursor = conn.cursor()
                 
                 cursor.execute('''
@@ -583,7 +648,7 @@ class Database:
     def deactivate_expired_accounts(self) -> int:
         """Деактивация истекших аккаунтов"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.transaction() as conn:
                 cursor = conn.cursor()
                 
                 cursor.execute('''
@@ -593,7 +658,6 @@ class Database:
                 ''')
                 
                 deactivated_count = cursor.rowcount
-                conn.commit()
                 
                 logger.info(f"Деактивировано {deactivated_count} истекших аккаунтов")
                 return deactivated_count
@@ -605,7 +669,7 @@ class Database:
     def get_all_system_users(self) -> List[Dict]:
         """Получение всех системных пользователей"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.transaction() as conn:
                 cursor = conn.cursor()
                 
                 cursor.execute('''
@@ -639,14 +703,13 @@ class Database:
     def update_last_login(self, username: str) -> bool:
         """Обновление времени последнего входа"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.transaction() as conn:
                 cursor = conn.cursor()
                 
                 cursor.execute('''
                     UPDATE system_users SET last_login = CURRENT_TIMESTAMP WHERE username = ?
                 ''', (username,))
                 
-                conn.commit()
                 return True
                 
         except Exception as e:
@@ -655,11 +718,11 @@ class Database:
 
     def get_user_settings(self, user_id):
         """Получить настройки пользователя"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT welcome_message, welcome_pdf_path, bot_token, bot_username, bot_name, bot_description, start_command, created_at, updated_at,
-                       welcome_file_id, welcome_file_caption
+                       welcome_file_id, welcome_file_caption, settings_version
                 FROM user_settings 
                 WHERE user_id = ?
             ''', (user_id,))
@@ -677,7 +740,8 @@ class Database:
                     'created_at': result[7],
                     'updated_at': result[8],
                     'welcome_file_id': result[9] if len(result) > 9 else '',
-                    'welcome_file_caption': result[10] if len(result) > 10 else ''
+                    'welcome_file_caption': result[10] if len(result) > 10 else '',
+                    'settings_version': result[11]
                 }
             else:
                 # Создать настройки по умолчанию для пользователя
@@ -685,7 +749,6 @@ class Database:
                     INSERT INTO user_settings (user_id, welcome_message, welcome_pdf_path, bot_token, bot_username, bot_name, bot_description, start_command, welcome_file_id, welcome_file_caption)
                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                 ''', (user_id, 'Добро пожаловать! 👋', '', '', '', 'Мой бот', '', 'Добро пожаловать! Нажмите /help для справки.', '', ''))
-                conn.commit()
                 
                 return {
                     'welcome_message': 'Добро пожаловать! 👋',
@@ -698,82 +761,118 @@ class Database:
                     'created_at': datetime.now().isoformat(),
                     'updated_at': datetime.now().isoformat(),
                     'welcome_file_id': '',
-                    'welcome_file_caption': ''
+                    'welcome_file_caption': '',
+                    'settings_version': 0
                 }
 
     def update_user_welcome_message(self, user_id, message):
         """Обновить приветственное сообщение пользователя"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 UPDATE user_settings 
-                SET welcome_message = ?, updated_at = ?
+                SET welcome_message = ?, updated_at = ?, settings_version = settings_version + 1
                 WHERE user_id = ?
             ''', (message, datetime.now().isoformat(), user_id))
-            conn.commit()
             return True
 
     def update_user_welcome_pdf(self, user_id, pdf_path):
         """Обновить путь к PDF файлу пользователя"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 UPDATE user_settings 
-                SET welcome_pdf_path = ?, updated_at = ?
+                SET welcome_pdf_path = ?, updated_at = ?, settings_version = settings_version + 1
                 WHERE user_id = ?
             ''', (pdf_path, datetime.now().isoformat(), user_id))
-            conn.commit()
             return True
     
     def update_user_welcome_file_id(self, user_id, file_id: str, caption: str = ''):
         """Сохранить file_id и подпись для приветственного файла"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 UPDATE user_settings 
-                SET welcome_file_id = ?, welcome_file_caption = ?, updated_at = ?
+                SET welcome_file_id = ?, welcome_file_caption = ?, updated_at = ?, settings_version = settings_version + 1
                 WHERE user_id = ?
             ''', (file_id, caption, datetime.now().isoformat(), user_id))
-            conn.commit()
             return True
 
     def update_user_bot_settings(self, user_id, bot_name, bot_description, start_command):
         """Обновить настройки бота пользователя"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 UPDATE user_settings 
-                SET bot_name = ?, bot_description = ?, start_command = ?, updated_at = ?
+                SET bot_name = ?, bot_description = ?, start_command = ?, updated_at = ?, settings_version = settings_version + 1
                 WHERE user_id = ?
             ''', (bot_name, bot_description, start_command, datetime.now().isoformat(), user_id))
-            conn.commit()
             return True
 
     def update_user_bot_token(self, user_id, bot_token, bot_username):
         """Обновить токен и username бота пользователя"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 UPDATE user_settings 
-                SET bot_token = ?, bot_username = ?, updated_at = ?
+                SET bot_token = ?, bot_username = ?, updated_at = ?, settings_version = settings_version + 1
                 WHERE user_id = ?
             ''', (bot_token, bot_username, datetime.now().isoformat(), user_id))
-            conn.commit()
             return True
     
+    def get_settings_versions(self, user_ids: List[int]) -> Dict[int, int]:
+        """Текущие версии настроек ботов {user_id: settings_version}"""
+        if not user_ids:
+            return {}
+        placeholders = ','.join('?' * len(user_ids))
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT user_id, settings_version FROM user_settings WHERE user_id IN ({placeholders})
+            ''', list(user_ids))
+            return {row[0]: row[1] for row in cursor.fetchall()}
+
+    def get_active_bot_configs(self) -> List[Dict]:
+        """Настройки ботов активных пользователей, у которых задан токен"""
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT s.user_id, s.bot_token, s.bot_username, s.welcome_message, s.start_command
+                FROM user_settings s
+                JOIN system_users u ON u.id = s.user_id
+                WHERE u.is_active = 1 AND s.bot_token IS NOT NULL AND s.bot_token != ''
+                ORDER BY s.user_id
+            ''')
+            return [
+                {
+                    'user_id': row[0],
+                    'bot_token': row[1],
+                    'bot_username': row[2] or '',
+                    'welcome_message': row[3] or 'Добро пожаловать! 👋',
+                    'start_command': row[4] or 'Добро пожаловать! Нажмите /help для справки.',
+                }
+                for row in cursor.fetchall()
+            ]
+    
     # ===== Кампании (рассылки) и логи =====
-    def create_campaign(self, owner_user_id: int, text: str = None, photo_file_id: str = None, scheduled_at: str = None) -> int:
-        with sqlite3.connect(self.db_path) as conn:
+    def create_campaign(self, owner_user_id: int, text: str = None, photo_file_id: str = None, scheduled_at: str = None,
+                        document_path: str = None, filename: str = None, caption: str = None,
+                        parse_mode: str = None) -> int:
+        """Создать кампанию (задание в очереди рассылок).
+        scheduled_at — локальное время 'YYYY-MM-DD HH:MM:SS'; очередь упорядочена по run_at в unix-ms"""
+        run_at = _to_ms(scheduled_at) if scheduled_at else _now_ms()
+        with self.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                INSERT INTO campaigns (user_id, text, photo_file_id, scheduled_at, status, created_at, updated_at)
-                VALUES (?, ?, ?, ?, 'scheduled', CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-            ''', (owner_user_id, text, photo_file_id, scheduled_at))
-            conn.commit()
+                INSERT INTO campaigns (user_id, text, photo_file_id, scheduled_at, run_at, document_path, filename,
+                                       caption, parse_mode, status, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'scheduled', CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+            ''', (owner_user_id, text, photo_file_id, scheduled_at, run_at, document_path, filename, caption,
+                  parse_mode))
             return cursor.lastrowid
     
     def list_campaigns(self, owner_user_id: int, limit: int = 50):
-        with sqlite3.connect(self.db_path) as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT id, text, photo_file_id, scheduled_at, status, created_at
@@ -781,7 +880,7 @@ class Database:
                 WHERE user_id = ?
                 ORDER BY 
                     CASE WHEN scheduled_at IS NULL THEN 1 ELSE 0 END,
-                    COALESCE(scheduled_at, created_at) DESC
+                    run_at DESC, id DESC
                 LIMIT ?
             ''', (owner_user_id, limit))
             rows = cursor.fetchall()
@@ -798,69 +897,451 @@ class Database:
     
     def get_due_campaigns(self):
         """Кампании к отправке сейчас"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT id, user_id, text, photo_file_id
                 FROM campaigns
-                WHERE status = 'scheduled' AND (scheduled_at IS NULL OR scheduled_at <= CURRENT_TIMESTAMP)
-                ORDER BY COALESCE(scheduled_at, created_at) ASC
-            ''')
+                WHERE status = 'scheduled' AND run_at <= ?
+                ORDER BY run_at ASC
+            ''', (_now_ms(),))
             return [{'id': r[0], 'user_id': r[1], 'text': r[2], 'photo_file_id': r[3]} for r in cursor.fetchall()]
     
     def mark_campaign_status(self, campaign_id: int, status: str):
-        with sqlite3.connect(self.db_path) as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 UPDATE campaigns SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?
             ''', (status, campaign_id))
-            conn.commit()
             return True
     
-    def log_delivery(self, recipient_user_id: int, owner_user_id: int, campaign_id: int, status: str, error: str = None):
-        with sqlite3.connect(self.db_path) as conn:
+    def record_deliveries(self, campaign_id: int, owner_user_id: int,
+                          results: List[Tuple[int, bool, Optional[str]]]) -> Dict:
+        """Записать пачку итогов рассылки [(user_id, ok, error)] одной транзакцией.
+        Ошибки попадают в delivery_logs, id получателей — отдельной строкой пачки в campaign_delivery_chunks,
+        в сводке campaign_deliveries растут только счётчики. Стоимость записи не зависит от размера кампании;
+        пачки собираются в сводку один раз в compact_deliveries. Возвращает текущие счётчики кампании."""
+        delivered = [uid for uid, ok, _ in results if ok]
+        failed = [uid for uid, ok, _ in results if not ok]
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            if results:
+                cursor.executemany('''
+                    INSERT INTO delivery_logs (user_id, bot_user_id, campaign_id, status, error, created_at)
+                    VALUES (?, ?, ?, 'failed', ?, CURRENT_TIMESTAMP)
+                ''', [(uid, owner_user_id, campaign_id, error) for uid, ok, error in results if not ok])
+                cursor.execute('''
+                    INSERT INTO campaign_delivery_chunks (campaign_id, delivered, failed) VALUES (?, ?, ?)
+                ''', (campaign_id, pack_ids(delivered), pack_ids(failed)))
+                cursor.execute('''
+                    INSERT INTO campaign_deliveries (campaign_id, bot_user_id, sent_count, failed_count, updated_at)
+                    VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT(campaign_id) DO UPDATE SET
+                        sent_count = sent_count + excluded.sent_count,
+                        failed_count = failed_count + excluded.failed_count,
+                        updated_at = excluded.updated_at
+                ''', (campaign_id, owner_user_id, len(delivered), len(failed)))
+            return self.get_delivery_counts(campaign_id)
+    
+    def get_delivery_counts(self, campaign_id: int) -> Dict:
+        """Счётчики доставки кампании (без чтения списков получателей)"""
+        with self.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                INSERT INTO delivery_logs (user_id, bot_user_id, campaign_id, status, error, created_at)
-                VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-            ''', (recipient_user_id, owner_user_id, campaign_id, status, error))
-            conn.commit()
-            return True
+                SELECT sent_count, failed_count FROM campaign_deliveries WHERE campaign_id = ?
+            ''', (campaign_id,))
+            row = cursor.fetchone()
+            return {'sent_count': row[0] if row else 0, 'failed_count': row[1] if row else 0}
+    
+    def _merge_deliveries(self, cursor, campaign_id: int) -> Optional[Tuple[List[int], List[int]]]:
+        """Сводка кампании вместе с ещё не собранными пачками: (доставлено, ошибки) без повторов.
+        Успешная доставка в любой пачке снимает ошибку получателя"""
+        cursor.execute('''
+            SELECT delivered, failed FROM campaign_deliveries WHERE campaign_id = ?
+        ''', (campaign_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        delivered, failed = set(unpack_ids(row[0])), set(unpack_ids(row[1]))
+        cursor.execute('''
+            SELECT delivered, failed FROM campaign_delivery_chunks WHERE campaign_id = ?
+        ''', (campaign_id,))
+        for chunk_delivered, chunk_failed in cursor.fetchall():
+            delivered.update(unpack_ids(chunk_delivered))
+            failed.update(unpack_ids(chunk_failed))
+        return sorted(delivered), sorted(failed - delivered)
+    
+    def compact_deliveries(self, campaign_id: int) -> Optional[Dict]:
+        """Собрать пачки кампании в сводку: один blob на список, точные счётчики. Вызывается при завершении"""
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            merged = self._merge_deliveries(cursor, campaign_id)
+            if merged is None:
+                return None
+            delivered, failed = merged
+            cursor.execute('''
+                UPDATE campaign_deliveries
+                SET sent_count = ?, failed_count = ?, delivered = ?, failed = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE campaign_id = ?
+            ''', (len(delivered), len(failed), pack_ids(delivered), pack_ids(failed), campaign_id))
+            cursor.execute('DELETE FROM campaign_delivery_chunks WHERE campaign_id = ?', (campaign_id,))
+            return {'sent_count': len(delivered), 'failed_count': len(failed)}
+    
+    def get_delivery_summary(self, campaign_id: int) -> Optional[Dict]:
+        """Сводка доставки кампании: счётчики и отсортированные списки id получателей
+        (для идущей кампании пачки сливаются при чтении)"""
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            merged = self._merge_deliveries(cursor, campaign_id)
+            if merged is None:
+                return None
+            cursor.execute('''
+                SELECT bot_user_id, sent_count, failed_count, updated_at FROM campaign_deliveries WHERE campaign_id = ?
+            ''', (campaign_id,))
+            row = cursor.fetchone()
+            return {
+                'campaign_id': campaign_id,
+                'bot_user_id': row[0],
+                'sent_count': row[1],
+                'failed_count': row[2],
+                'delivered': merged[0],
+                'failed': merged[1],
+                'updated_at': row[3],
+            }
+    
+    def get_failed_recipient_ids(self, campaign_id: int) -> List[int]:
+        """Получатели кампании, которым сообщение так и не доставлено"""
+        summary = self.get_delivery_summary(campaign_id)
+        return summary['failed'] if summary else []
     
     def get_broadcast_stats(self, owner_user_id: int, since: str = None):
         """Статистика по доставкам кампаний"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
-            if since:
-                cursor.execute('''
-                    SELECT status, COUNT(*) FROM delivery_logs
-                    WHERE bot_user_id = ? AND created_at >= ?
-                    GROUP BY status
-                ''', (owner_user_id, since))
-            else:
-                cursor.execute('''
-                    SELECT status, COUNT(*) FROM delivery_logs
-                    WHERE bot_user_id = ?
-                    GROUP BY status
-                ''', (owner_user_id,))
-            rows = cursor.fetchall()
-            return {r[0]: r[1] for r in rows}
+            cursor.execute('''
+                SELECT COALESCE(SUM(sent_count), 0), COALESCE(SUM(failed_count), 0) FROM campaign_deliveries
+                WHERE bot_user_id = ? AND (? IS NULL OR updated_at >= ?)
+            ''', (owner_user_id, since, since))
+            sent, failed = cursor.fetchone()
+            return {'success': sent, 'failed': failed}
+
+    # ===== Очередь рассылок: campaigns как задания с арендой =====
+    def get_campaign(self, campaign_id: int) -> Optional[Dict]:
+        """Получить кампанию со всеми полями очереди"""
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, user_id, text, photo_file_id, document_path, filename, caption, parse_mode,
+                       scheduled_at, run_at, status, attempts, last_error, lease_owner, lease_expires_at,
+                       last_recipient_id, sent_count, failed_count, created_at, updated_at
+                FROM campaigns WHERE id = ?
+            ''', (campaign_id,))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            columns = ['id', 'user_id', 'text', 'photo_file_id', 'document_path', 'filename', 'caption', 'parse_mode',
+                       'scheduled_at', 'run_at', 'status', 'attempts', 'last_error', 'lease_owner', 'lease_expires_at',
+                       'last_recipient_id', 'sent_count', 'failed_count', 'created_at', 'updated_at']
+            return dict(zip(columns, row))
+    
+    def claim_campaign(self, worker_id: str, lease_seconds: int = 60) -> Optional[Dict]:
+        """Взять в работу одну кампанию с арендой: запланированную к текущему моменту
+        или брошенную упавшим воркером (аренда истекла). Порядок и срок — по run_at (unix-ms);
+        кампании без run_at (status = 'stale' после миграции 20) в очередь не попадают"""
+        now_ms = _now_ms()
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id FROM campaigns
+                WHERE (status = 'scheduled' AND run_at <= ?)
+                   OR (status = 'sending' AND lease_expires_at < ?)
+                ORDER BY run_at ASC
+                LIMIT 1
+            ''', (now_ms, now_ms))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            
+            # Условный UPDATE: если кампанию успел забрать другой воркер, rowcount будет 0
+            cursor.execute('''
+                UPDATE campaigns
+                SET status = 'sending', lease_owner = ?, lease_expires_at = ?, attempts = attempts + 1,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND (status = 'scheduled' OR (status = 'sending' AND lease_expires_at < ?))
+            ''', (worker_id, now_ms + lease_seconds * 1000, row[0], now_ms))
+            if cursor.rowcount == 0:
+                return None
+        
+        logger.info(f"📥 Кампания #{row[0]} взята в работу воркером {worker_id}")
+        return self.get_campaign(row[0])
+    
+    def heartbeat_campaign(self, campaign_id: int, worker_id: str, last_recipient_id: int,
+                           sent_count: int, failed_count: int, lease_seconds: int = 60) -> bool:
+        """Продлить аренду и сохранить точку продолжения. False — аренда потеряна"""
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE campaigns
+                SET lease_expires_at = ?, last_recipient_id = ?, sent_count = ?, failed_count = ?,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND lease_owner = ? AND status = 'sending'
+            ''', (_now_ms() + lease_seconds * 1000, last_recipient_id, sent_count, failed_count,
+                  campaign_id, worker_id))
+            return cursor.rowcount == 1
+    
+    def complete_campaign(self, campaign_id: int, worker_id: str, status: str = 'sent',
+                          sent_count: int = None, failed_count: int = None, error: str = None) -> bool:
+        """Завершить кампанию и освободить аренду. Пачки итогов собираются в сводку,
+        счётчики кампании берутся из неё, если не переданы явно"""
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1 FROM campaigns WHERE id = ? AND lease_owner = ?', (campaign_id, worker_id))
+            if cursor.fetchone() is None:
+                return False
+            totals = self.compact_deliveries(campaign_id)
+            if totals:
+                sent_count = totals['sent_count'] if sent_count is None else sent_count
+                failed_count = totals['failed_count'] if failed_count is None else failed_count
+            cursor.execute('''
+                UPDATE campaigns
+                SET status = ?, sent_count = COALESCE(?, sent_count), failed_count = COALESCE(?, failed_count),
+                    last_error = COALESCE(?, last_error), lease_owner = NULL, lease_expires_at = NULL,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND lease_owner = ?
+            ''', (status, sent_count, failed_count, error, campaign_id, worker_id))
+            return cursor.rowcount == 1
+    
+    def retry_campaign(self, campaign_id: int, worker_id: str, error: str,
+                       delay_seconds: int = 60, max_attempts: int = 5) -> bool:
+        """Вернуть кампанию в очередь после ошибки (с задержкой) или пометить failed после max_attempts"""
+        retry_at = _now_ms() + delay_seconds * 1000
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE campaigns
+                SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'scheduled' END,
+                    run_at = CASE WHEN attempts >= ? THEN run_at ELSE ? END,
+                    last_error = ?, lease_owner = NULL, lease_expires_at = NULL,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND lease_owner = ?
+            ''', (max_attempts, max_attempts, retry_at, error[:500], campaign_id, worker_id))
+            return cursor.rowcount == 1
+    
+    def get_delivered_recipient_ids(self, campaign_id: int, after_id: int = 0) -> set:
+        """Получатели кампании с записанным итогом (доставлено или ошибка) после точки продолжения"""
+        summary = self.get_delivery_summary(campaign_id)
+        if not summary:
+            return set()
+        return {uid for uid in summary['delivered'] + summary['failed'] if uid > after_id}
+    
+    def get_recipient_batch(self, bot_user_id: int, after_id: int = None, limit: int = 1000) -> List[int]:
+        """Очередная пачка id активных подписчиков бота по возрастанию после after_id (по первичному ключу bot_subscribers)"""
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT user_id FROM bot_subscribers
+                WHERE bot_user_id = ? AND user_id > ? AND status = 'active'
+                ORDER BY user_id
+                LIMIT ?
+            ''', (bot_user_id, after_id if after_id is not None else -2 ** 63, limit))
+            return [row[0] for row in cursor.fetchall()]
+    
+    def iter_recipient_ids(self, bot_user_id: int, after_id: int = None, batch: int = 1000) -> Iterator[int]:
+        """Получатели рассылки потоком: пачки по batch id, каждая — отдельный короткий запрос.
+        Последний выданный id — курсор, с которого можно продолжить прерванную рассылку (after_id)."""
+        while True:
+            ids = self.get_recipient_batch(bot_user_id, after_id, batch)
+            yield from ids
+            if len(ids) < batch:
+                return
+            after_id = ids[-1]
+
+    # ===== Аренда ботов раннерами =====
+    def acquire_bot_lease(self, bot_user_id: int, owner_id: str, ttl_seconds: int = 60) -> bool:
+        """Атомарно взять (или продлить свою) аренду бота. False — бот арендован другим живым процессом"""
+        now_ms = _now_ms()
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO bot_leases (bot_user_id, owner_id, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(bot_user_id) DO UPDATE SET owner_id = excluded.owner_id, expires_at = excluded.expires_at
+                WHERE bot_leases.owner_id = excluded.owner_id OR bot_leases.expires_at < ?
+            ''', (bot_user_id, owner_id, now_ms + ttl_seconds * 1000, now_ms))
+            return cursor.rowcount > 0
+    
+    def renew_bot_leases(self, owner_id: str, bot_user_ids: List[int], ttl_seconds: int = 60) -> set:
+        """Продлить аренды процесса. Возвращает id ботов, аренда которых всё ещё за ним"""
+        if not bot_user_ids:
+            return set()
+        now_ms = _now_ms()
+        placeholders = ','.join('?' * len(bot_user_ids))
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                UPDATE bot_leases SET expires_at = ?
+                WHERE owner_id = ? AND bot_user_id IN ({placeholders})
+            ''', (now_ms + ttl_seconds * 1000, owner_id, *bot_user_ids))
+            cursor.execute(f'''
+                SELECT bot_user_id FROM bot_leases
+                WHERE owner_id = ? AND bot_user_id IN ({placeholders})
+            ''', (owner_id, *bot_user_ids))
+            return {row[0] for row in cursor.fetchall()}
+    
+    def release_bot_lease(self, bot_user_id: int, owner_id: str) -> bool:
+        """Отпустить аренду бота, если она принадлежит процессу"""
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                DELETE FROM bot_leases WHERE bot_user_id = ? AND owner_id = ?
+            ''', (bot_user_id, owner_id))
+            return cursor.rowcount > 0
+    
+    def release_bot_leases(self, owner_id: str) -> int:
+        """Отпустить все аренды процесса (при остановке)"""
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM bot_leases WHERE owner_id = ?', (owner_id,))
+            return cursor.rowcount
+    
+    def get_bot_leases(self) -> List[Dict]:
+        """Текущие аренды ботов"""
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT bot_user_id, owner_id, expires_at FROM bot_leases ORDER BY bot_user_id')
+            return [
+                {'bot_user_id': row[0], 'owner_id': row[1], 'expires_at': row[2]}
+                for row in cursor.fetchall()
+            ]
+    
+    # ===== Команды управления ботами (веб-панель -> раннер) =====
+    def enqueue_bot_command(self, bot_user_id: int, command: str, payload: Dict = None) -> int:
+        """Поставить команду раннеру ботов. Возвращает id команды"""
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO bot_commands (bot_user_id, command, payload, created_at) VALUES (?, ?, ?, ?)
+            ''', (bot_user_id, command, json.dumps(payload or {}), _now_ms()))
+            return cursor.lastrowid
+    
+    def get_bot_command(self, command_id: int) -> Optional[Dict]:
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, bot_user_id, command, payload, status, result, owner_id, created_at, processed_at
+                FROM bot_commands WHERE id = ?
+            ''', (command_id,))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            return {
+                'id': row[0],
+                'bot_user_id': row[1],
+                'command': row[2],
+                'payload': json.loads(row[3] or '{}'),
+                'status': row[4],
+                'result': json.loads(row[5]) if row[5] else None,
+                'owner_id': row[6],
+                'created_at': row[7],
+                'processed_at': row[8],
+            }
+    
+    def claim_bot_commands(self, owner_id: str, limit: int = 20) -> List[Dict]:
+        """Кандидаты для раннера: команды его ботов и ботов без живой аренды.
+        Каждую команду нужно ещё забрать через take_bot_command."""
+        now_ms = _now_ms()
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT c.id, c.bot_user_id, c.command, c.payload
+                FROM bot_commands c
+                LEFT JOIN bot_leases l ON l.bot_user_id = c.bot_user_id AND l.expires_at >= ?
+                WHERE c.status = 'pending' AND (l.owner_id IS NULL OR l.owner_id = ?)
+                ORDER BY c.id
+                LIMIT ?
+            ''', (now_ms, owner_id, limit))
+            return [
+                {'id': row[0], 'bot_user_id': row[1], 'command': row[2], 'payload': json.loads(row[3] or '{}')}
+                for row in cursor.fetchall()
+            ]
+    
+    def take_bot_command(self, command_id: int, owner_id: str) -> bool:
+        """Забрать команду (условный UPDATE: выполняет только один раннер)"""
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE bot_commands SET status = 'running', owner_id = ?
+                WHERE id = ? AND status = 'pending'
+            ''', (owner_id, command_id))
+            return cursor.rowcount > 0
+    
+    def finish_bot_command(self, command_id: int, ok: bool, result: Dict = None):
+        """Записать результат команды"""
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE bot_commands SET status = ?, result = ?, processed_at = ?
+                WHERE id = ?
+            ''', ('done' if ok else 'failed', json.dumps(result or {}, ensure_ascii=False), _now_ms(), command_id))
+    
+    def expire_bot_command(self, command_id: int) -> bool:
+        """Отменить команду, которую так и не взял ни один раннер"""
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE bot_commands SET status = 'expired', processed_at = ?
+                WHERE id = ? AND status = 'pending'
+            ''', (_now_ms(), command_id))
+            return cursor.rowcount > 0
+    
+    def cleanup_bot_commands(self, older_than_seconds: int = 3600) -> int:
+        """Удалить обработанные команды старше заданного возраста"""
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                DELETE FROM bot_commands WHERE status != 'pending' AND created_at < ?
+            ''', (_now_ms() - older_than_seconds * 1000,))
+            return cursor.rowcount
+    
+    # ===== Кэш file_id =====
+    def get_cached_file_id(self, bot_id: str, content_hash: str) -> Optional[str]:
+        """file_id файла с данным содержимым, уже загруженного этим ботом"""
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT file_id FROM file_id_cache WHERE bot_id = ? AND content_hash = ?
+            ''', (bot_id, content_hash))
+            row = cursor.fetchone()
+            return row[0] if row else None
+    
+    def save_cached_file_id(self, bot_id: str, content_hash: str, file_id: str):
+        """Запомнить file_id после первой успешной загрузки"""
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR REPLACE INTO file_id_cache (bot_id, content_hash, file_id, created_at)
+                VALUES (?, ?, ?, ?)
+            ''', (bot_id, content_hash, file_id, _now_ms()))
+    
+    def delete_cached_file_id(self, bot_id: str, content_hash: str):
+        """Забыть file_id, который Telegram перестал принимать"""
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                DELETE FROM file_id_cache WHERE bot_id = ? AND content_hash = ?
+            ''', (bot_id, content_hash))
 
     def get_users_for_bot(self, bot_user_id):
-        """Получить пользователей, которые общались с конкретным ботом"""
-        with sqlite3.connect(self.db_path) as conn:
+        """Получить подписчиков конкретного бота (из материализованной таблицы bot_subscribers)"""
+        with self.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                SELECT DISTINCT u.id, u.username, u.first_name, u.last_name, u.created_at,
-                       m.text as last_message_text, m.timestamp as last_message_time
-                FROM users u
-                INNER JOIN (
-                    SELECT user_id, text, timestamp,
-                           ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY timestamp DESC) as rn
-                    FROM messages
-                    WHERE bot_user_id = ?
-                ) m ON u.id = m.user_id AND m.rn = 1
-                ORDER BY u.created_at DESC
+                SELECT s.user_id, u.username, u.first_name, u.last_name, u.created_at,
+                       m.text as last_message_text, m.ts as last_message_time
+                FROM bot_subscribers s
+                LEFT JOIN users u ON u.id = s.user_id
+                LEFT JOIN messages m ON m.id = s.last_message_id
+                WHERE s.bot_user_id = ?
+                ORDER BY s.first_seen DESC
             ''', (bot_user_id,))
             
             users = []
@@ -872,54 +1353,153 @@ class Database:
                     'last_name': row[3],
                     'created_at': row[4],
                     'last_message_text': row[5],
-                    'last_message_time': row[6]
+                    'last_message_time': _ms_to_iso(row[6])
                 })
             return users
 
-    def get_messages_between_users(self, user_id, bot_user_id):
-        """Получить сообщения между пользователем и конкретным ботом"""
-        with sqlite3.connect(self.db_path) as conn:
+    def get_threads(self, bot_user_id: int, limit: int = 50, before: tuple = None) -> List[Dict]:
+        """Диалоги бота от последних к старым одной выборкой по idx_threads_recent.
+        before — курсор (last_message_at, user_id) последней строки предыдущей страницы."""
+        with self.transaction() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                SELECT id, text, timestamp, is_from_user
-                FROM messages
-                WHERE user_id = ? AND bot_user_id = ?
-                ORDER BY timestamp ASC
-            ''', (user_id, bot_user_id))
+            if before:
+                cursor.execute('''
+                    SELECT t.user_id, u.username, u.first_name, u.last_name, u.full_name,
+                           t.last_message_text, t.last_message_at, t.unread_count, t.message_count
+                    FROM threads t
+                    LEFT JOIN users u ON u.id = t.user_id
+                    WHERE t.bot_user_id = ? AND (t.last_message_at, t.user_id) < (?, ?)
+                    ORDER BY t.last_message_at DESC, t.user_id DESC
+                    LIMIT ?
+                ''', (bot_user_id, before[0], before[1], limit))
+            else:
+                cursor.execute('''
+                    SELECT t.user_id, u.username, u.first_name, u.last_name, u.full_name,
+                           t.last_message_text, t.last_message_at, t.unread_count, t.message_count
+                    FROM threads t
+                    LEFT JOIN users u ON u.id = t.user_id
+                    WHERE t.bot_user_id = ?
+                    ORDER BY t.last_message_at DESC, t.user_id DESC
+                    LIMIT ?
+                ''', (bot_user_id, limit))
             
-            messages = []
-            for row in cursor.fetchall():
-                messages.append({
-                    'id': row[0],
-                    'text': row[1],
-                    'timestamp': row[2],
-                    'is_from_user': bool(row[3])
-                })
+            return [{
+                'id': row[0],
+                'username': row[1],
+                'first_name': row[2],
+                'last_name': row[3],
+                'full_name': row[4],
+                'last_message_text': row[5],
+                'last_message_at': row[6],
+                'last_message_time': datetime.fromtimestamp(row[6] / 1000).isoformat(),
+                'unread_count': row[7],
+                'message_count': row[8],
+            } for row in cursor.fetchall()]
+    
+    def get_thread(self, bot_user_id: int, user_id: int) -> Optional[Dict]:
+        """Строка диалога (для ETag истории сообщений и счётчика непрочитанных)"""
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT last_message_id, last_message_at, unread_count, message_count
+                FROM threads WHERE bot_user_id = ? AND user_id = ?
+            ''', (bot_user_id, user_id))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            return {
+                'last_message_id': row[0],
+                'last_message_at': row[1],
+                'unread_count': row[2],
+                'message_count': row[3],
+            }
+    
+    def get_message_page(self, user_id: int, bot_user_id: int, before_id: int = None, after_id: int = None,
+                         limit: int = 50) -> List[Dict]:
+        """Страница истории диалога по idx_messages_thread, сообщения по возрастанию id.
+        after_id — новые сообщения после известного (дельта для опроса),
+        before_id — более старые (прокрутка вверх), без параметров — последние limit сообщений."""
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            if after_id is not None:
+                cursor.execute('''
+                    SELECT id, text, ts, is_from_user
+                    FROM messages
+                    WHERE bot_user_id = ? AND user_id = ? AND id > ?
+                    ORDER BY id ASC
+                    LIMIT ?
+                ''', (bot_user_id, user_id, after_id, limit))
+                rows = cursor.fetchall()
+            else:
+                cursor.execute('''
+                    SELECT id, text, ts, is_from_user
+                    FROM messages
+                    WHERE bot_user_id = ? AND user_id = ? AND id < ?
+                    ORDER BY id DESC
+                    LIMIT ?
+                ''', (bot_user_id, user_id, before_id if before_id is not None else 2 ** 63 - 1, limit))
+                rows = cursor.fetchall()[::-1]
             
-            logger.info(f"📊 Получено {len(messages)} сообщений для пользователя {user_id} с ботом {bot_user_id}")
-            # Логируем в файл
-            with open('/tmp/debug.log', 'a') as f:
-                f.write(f"📊 DEBUG: Получено {len(messages)} сообщений для пользователя {user_id} с ботом {bot_user_id}\n")
-            return messages
+            return [{
+                'id': row[0],
+                'text': row[1],
+                'timestamp': _ms_to_iso(row[2]),
+                'is_from_user': bool(row[3])
+            } for row in rows]
+    
+    def get_last_message_id(self) -> int:
+        """Наибольший id в messages (начальная позиция потока событий)"""
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM messages')
+            return cursor.fetchone()[0]
+    
+    def get_messages_after(self, after_id: int, limit: int = 500) -> List[Dict]:
+        """Новые сообщения всех ботов после after_id по первичному ключу (лента для /api/stream/dialogs)"""
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, bot_user_id, user_id, is_from_user, substr(text, 1, 200)
+                FROM messages
+                WHERE id > ?
+                ORDER BY id
+                LIMIT ?
+            ''', (after_id, limit))
+            return [{
+                'id': row[0],
+                'bot_user_id': row[1],
+                'user_id': row[2],
+                'is_from_user': bool(row[3]),
+                'text': row[4],
+            } for row in cursor.fetchall()]
+    
+    def mark_thread_read(self, bot_user_id: int, user_id: int):
+        """Сбросить счётчик непрочитанных (администратор открыл диалог)"""
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE threads SET unread_count = 0
+                WHERE bot_user_id = ? AND user_id = ? AND unread_count > 0
+            ''', (bot_user_id, user_id))
 
     def get_last_message_for_user(self, user_id, bot_user_id):
         """Получить последнее сообщение для пользователя от конкретного бота"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                SELECT id, text, timestamp, is_from_user
+                SELECT id, text, ts, is_from_user
                 FROM messages
-                WHERE user_id = ? AND bot_user_id = ?
-                ORDER BY timestamp DESC
+                WHERE bot_user_id = ? AND user_id = ?
+                ORDER BY id DESC
                 LIMIT 1
-            ''', (user_id, bot_user_id))
+            ''', (bot_user_id, user_id))
             
             row = cursor.fetchone()
             if row:
                 return {
                     'id': row[0],
                     'text': row[1],
-                    'timestamp': row[2],
+                    'timestamp': _ms_to_iso(row[2]),
                     'is_from_user': bool(row[3])
                 }
             return None
@@ -927,49 +1507,207 @@ class Database:
 
     def get_active_subscribers_count(self, bot_user_id, since_date):
         """Получить количество активных подписчиков с определенной даты"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                SELECT COUNT(DISTINCT user_id) 
-                FROM messages 
-                WHERE bot_user_id = ? AND timestamp >= ? AND is_from_user = 1
-            ''', (bot_user_id, since_date))
+                SELECT COUNT(*)
+                FROM bot_subscribers
+                WHERE bot_user_id = ? AND last_seen >= ?
+            ''', (bot_user_id, _to_ms(since_date)))
             return cursor.fetchone()[0] or 0
 
     def get_new_subscribers_count(self, bot_user_id, since_date):
         """Получить количество новых подписчиков с определенной даты"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                SELECT COUNT(DISTINCT user_id) 
-                FROM messages 
-                WHERE bot_user_id = ? AND timestamp >= ? AND is_from_user = 1
-                AND user_id NOT IN (
-                    SELECT DISTINCT user_id 
-                    FROM messages 
-                    WHERE bot_user_id = ? AND timestamp < ? AND is_from_user = 1
-                )
-            ''', (bot_user_id, since_date, bot_user_id, since_date))
+                SELECT COUNT(*)
+                FROM bot_subscribers
+                WHERE bot_user_id = ? AND first_seen >= ?
+            ''', (bot_user_id, _to_ms(since_date)))
             return cursor.fetchone()[0] or 0
 
-    def get_total_subscribers_count(self, bot_user_id):
-        """Получить общее количество подписчиков бота"""
-        with sqlite3.connect(self.db_path) as conn:
+    def get_total_subscribers_count(self, bot_user_id, active_only: bool = False):
+        """Получить общее количество подписчиков бота (active_only — только доступных для рассылки)"""
+        with self.transaction() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                SELECT COUNT(DISTINCT user_id) 
-                FROM messages 
-                WHERE bot_user_id = ? AND is_from_user = 1
+            cursor.execute(f'''
+                SELECT COUNT(*)
+                FROM bot_subscribers
+                WHERE bot_user_id = ?{" AND status = 'active'" if active_only else ''}
             ''', (bot_user_id,))
             return cursor.fetchone()[0] or 0
+    
+    def deactivate_subscribers(self, bot_user_id: int, subscribers: List[Tuple[int, str]]) -> int:
+        """Исключить подписчиков [(user_id, причина)] из аудитории бота после постоянной ошибки доставки.
+        Новое входящее сообщение подписчика вернёт его в аудиторию (_touch_subscriber)"""
+        if not subscribers:
+            return 0
+        now_ms = _now_ms()
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.executemany('''
+                UPDATE bot_subscribers SET status = 'inactive', inactive_reason = ?, inactive_since = ?
+                WHERE bot_user_id = ? AND user_id = ? AND status = 'active'
+            ''', [(reason, now_ms, bot_user_id, user_id) for user_id, reason in subscribers])
+            changed = cursor.rowcount
+        if changed:
+            logger.info(f"🚫 Бот {bot_user_id}: {changed} подписчиков исключены из рассылок (недоступны)")
+        return changed
 
     def get_messages_count_24h(self, bot_user_id, since_date):
         """Получить количество сообщений за последние 24 часа"""
-        with sqlite3.connect(self.db_path) as conn:
+        return self.get_bot_stats(bot_user_id, since_date)['messages']
+
+    def get_bot_stats(self, bot_user_id, since_date) -> Dict:
+        """Статистика бота за окно с since_date до текущего момента.
+        Полные часы суммируются по bot_stats_rollup, неполный первый час досчитывается точно
+        по покрывающим индексам messages(bot_user_id, is_from_user, ts) и bot_subscribers(bot_user_id, first_seen);
+        активные подписчики считаются по bot_subscribers.last_seen."""
+        since_ms = _to_ms(since_date)
+        # Начало первого полного часа окна
+        head_end = _hour_ms(since_ms) if since_ms == _hour_ms(since_ms) else _hour_ms(since_ms) + 3600000
+        with self.transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                SELECT COUNT(*) 
-                FROM messages 
-                WHERE bot_user_id = ? AND timestamp >= ?
-            ''', (bot_user_id, since_date))
-            return cursor.fetchone()[0] or 0
+                SELECT COALESCE(SUM(messages_in), 0), COALESCE(SUM(messages_out), 0), COALESCE(SUM(new_subscribers), 0)
+                FROM bot_stats_rollup
+                WHERE bot_user_id = ? AND hour >= ?
+            ''', (bot_user_id, head_end))
+            messages_in, messages_out, new_subscribers = cursor.fetchone()
+            
+            if head_end > since_ms:
+                cursor.execute('''
+                    SELECT
+                        (SELECT COUNT(*) FROM messages
+                         WHERE bot_user_id = :bot AND is_from_user = 1 AND ts >= :since AND ts < :head_end),
+                        (SELECT COUNT(*) FROM messages
+                         WHERE bot_user_id = :bot AND is_from_user = 0 AND ts >= :since AND ts < :head_end),
+                        (SELECT COUNT(*) FROM bot_subscribers
+                         WHERE bot_user_id = :bot AND first_seen >= :since AND first_seen < :head_end)
+                ''', {'bot': bot_user_id, 'since': since_ms, 'head_end': head_end})
+                head_in, head_out, head_new = cursor.fetchone()
+                messages_in += head_in
+                messages_out += head_out
+                new_subscribers += head_new
+            
+            cursor.execute('''
+                SELECT COUNT(*) FROM bot_subscribers WHERE bot_user_id = ? AND last_seen >= ?
+            ''', (bot_user_id, since_ms))
+            active_subscribers = cursor.fetchone()[0]
+            
+            return {
+                'messages_in': messages_in,
+                'messages_out': messages_out,
+                'messages': messages_in + messages_out,
+                'new_subscribers': new_subscribers,
+                'active_subscribers': active_subscribers,
+            }
+
+    # Окна метрик дашборда и админ-бота: (ключ, длительность в мс)
+    METRIC_WINDOWS = (('24h', 86400000), ('7d', 7 * 86400000), ('30d', 30 * 86400000))
+    
+    def get_dashboard_metrics(self, bot_user_id: int, now=None) -> Dict:
+        """Все показатели бота одним запросом (один согласованный снимок):
+        {'total_subscribers': N, 'inactive_subscribers': N, '24h': {...}, '7d': {...}, '30d': {...}},
+        в каждом окне new_subscribers, active_subscribers, messages_in, messages_out, messages.
+        Подписчики — один проход по строкам бота в bot_subscribers (first_seen — это MIN времени контакта,
+        так что «новые» не требуют NOT IN по истории), сообщения — полные часы из bot_stats_rollup
+        плюс точный подсчёт неполного первого часа окна по idx_messages_direction_ts."""
+        now_ms = _to_ms(now) if now is not None else _now_ms()
+        params = {'bot': bot_user_id}
+        subscriber_columns, rollup_columns, head_columns = [], [], []
+        for key, length in self.METRIC_WINDOWS:
+            since = now_ms - length
+            head_end = since if since == _hour_ms(since) else _hour_ms(since) + 3600000
+            params.update({f'since_{key}': since, f'head_{key}': head_end})
+            subscriber_columns += [
+                f'COALESCE(SUM(first_seen >= :since_{key}), 0)',
+                f'COALESCE(SUM(last_seen >= :since_{key}), 0)',
+            ]
+            rollup_columns += [
+                f'COALESCE(SUM(CASE WHEN hour >= :head_{key} THEN messages_in END), 0)',
+                f'COALESCE(SUM(CASE WHEN hour >= :head_{key} THEN messages_out END), 0)',
+            ]
+            head_columns += [
+                f'''(SELECT COUNT(*) FROM messages WHERE bot_user_id = :bot AND is_from_user = {direction}
+                     AND ts >= :since_{key} AND ts < :head_{key})'''
+                for direction in (1, 0)
+            ]
+        params['oldest'] = min(params[f'head_{key}'] for key, _ in self.METRIC_WINDOWS)
+        
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT s.*, r.*, {', '.join(head_columns)}
+                FROM (
+                    SELECT COUNT(*), COALESCE(SUM(status != 'active'), 0), {', '.join(subscriber_columns)}
+                    FROM bot_subscribers WHERE bot_user_id = :bot
+                ) s, (
+                    SELECT {', '.join(rollup_columns)}
+                    FROM bot_stats_rollup WHERE bot_user_id = :bot AND hour >= :oldest
+                ) r
+            ''', params)
+            row = cursor.fetchone()
+        
+        windows = len(self.METRIC_WINDOWS)
+        subscribers = row[2:2 + 2 * windows]
+        rollup = row[2 + 2 * windows:2 + 4 * windows]
+        head = row[2 + 4 * windows:]
+        metrics = {'total_subscribers': row[0], 'inactive_subscribers': row[1]}
+        for index, (key, _) in enumerate(self.METRIC_WINDOWS):
+            messages_in = rollup[2 * index] + head[2 * index]
+            messages_out = rollup[2 * index + 1] + head[2 * index + 1]
+            metrics[key] = {
+                'new_subscribers': subscribers[2 * index],
+                'active_subscribers': subscribers[2 * index + 1],
+                'messages_in': messages_in,
+                'messages_out': messages_out,
+                'messages': messages_in + messages_out,
+            }
+        return metrics
+
+# Пул потоков БД для AsyncDatabase: у каждого потока своё постоянное соединение
+_db_executor: Optional[ThreadPoolExecutor] = None
+_db_executor_lock = threading.Lock()
+
+def _get_db_executor() -> ThreadPoolExecutor:
+    global _db_executor
+    with _db_executor_lock:
+        if _db_executor is None:
+            from config import Config
+            _db_executor = ThreadPoolExecutor(max_workers=Config.DB_EXECUTOR_THREADS, thread_name_prefix='db')
+        return _db_executor
+
+class AsyncDatabase:
+    """Асинхронный фасад над Database для обработчиков ботов.
+    Повторяет методы Database (await adb.get_user_settings(...)), выполняя их в пуле потоков БД,
+    поэтому ожидание блокировки SQLite не останавливает event loop."""
+    
+    def __init__(self, db_path: str = 'data/bot.db'):
+        self.sync = Database(db_path)
+    
+    def __getattr__(self, name: str):
+        method = getattr(self.sync, name)
+        if name.startswith('_') or not callable(method):
+            return method
+        
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(_get_db_executor(), functools.partial(method, *args, **kwargs))
+        
+        call.__name__ = name
+        call.__doc__ = method.__doc__
+        # Кэшируем обёртку, чтобы не создавать её при каждом обращении
+        setattr(self, name, call)
+        return call
+    
+    async def iter_recipient_ids(self, bot_user_id: int, after_id: int = None, batch: int = 1000) -> AsyncIterator[int]:
+        """Асинхронный вариант Database.iter_recipient_ids: каждая пачка читается в пуле потоков БД"""
+        while True:
+            ids = await self.get_recipient_batch(bot_user_id, after_id, batch)
+            for chat_id in ids:
+                yield chat_id
+            if len(ids) < batch:
+                return
+            after_id = ids[-1]
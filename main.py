@@ -46,8 +46,17 @@ def main():
     # Запускаем менеджер пользовательских ботов
     try:
         from bot.user_bot_manager import bot_manager
+        from config import Config
         print("🤖 Запуск менеджера пользовательских ботов...")
         
+        # В режиме webhook сервер должен слушать до регистрации setWebhook ботами
+        if Config.BOT_INGRESS == 'webhook':
+            bot_manager.start_webhook_server()
+            print(f"🌐 Webhook-сервер запущен на {Config.WEBHOOK_HOST}:{Config.WEBHOOK_PORT}")
+        
+        # Команды веб-панели (перезагрузка, статус, остановка) приходят через таблицу bot_commands
+        bot_manager.start_control_server()
+        
         # Загружаем и запускаем всех активных ботов из базы данных
         from database import Database
         db = Database()
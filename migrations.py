@@ -0,0 +1,588 @@
+#!/usr/bin/env python3
+"""
+Версионированные миграции схемы базы данных
+Каждая миграция выполняется один раз, номер применённой версии хранится в таблице schema_version
+
+Использование:
+  python3 migrations.py                  # Применить недостающие миграции
+  python3 migrations.py status           # Показать текущую версию схемы
+  python3 migrations.py --db path/to.db  # Указать файл базы данных
+"""
+
+import logging
+import os
+import sqlite3
+import sys
+import zlib
+from array import array
+from itertools import accumulate
+from typing import Callable, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Реестр миграций: (версия, название, функция(cursor))
+MIGRATIONS: List[Tuple[int, str, Callable]] = []
+
+def migration(version: int, name: str):
+    """Регистрация миграции в реестре"""
+    def decorator(func):
+        MIGRATIONS.append((version, name, func))
+        return func
+    return decorator
+
+def _columns(cursor, table: str) -> List[str]:
+    cursor.execute(f"PRAGMA table_info({table})")
+    return [column[1] for column in cursor.fetchall()]
+
+def _add_column_if_missing(cursor, table: str, column: str, definition: str) -> bool:
+    """Добавить колонку, если её ещё нет. Возвращает True, если колонка добавлена"""
+    if column in _columns(cursor, table):
+        return False
+    cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    logger.info(f"➕ Добавлена колонка {table}.{column}")
+    return True
+
+def _ts_to_ms_sql(column: str) -> str:
+    """SQL-выражение для перевода текстовой метки времени в unix-ms.
+    Значения datetime.now().isoformat() (с 'T') записаны в локальном времени, CURRENT_TIMESTAMP — в UTC."""
+    return (f"CAST(ROUND((julianday({column}, CASE WHEN instr({column}, 'T') > 0 THEN 'utc' ELSE '+0 seconds' END)"
+            f" - 2440587.5) * 86400000) AS INTEGER)")
+
+def pack_ids(ids: Iterable[int]) -> bytes:
+    """Формат blob-ов campaign_deliveries: множество id как отсортированные разности соседних id (int64),
+    сжатые zlib. Формат хранения — часть схемы: менять его можно только вместе с новой миграцией"""
+    ordered = sorted(set(ids))
+    deltas = array('q', (b - a for a, b in zip([0] + ordered, ordered)))
+    return zlib.compress(deltas.tobytes())
+
+def unpack_ids(blob: Optional[bytes]) -> List[int]:
+    """Обратно к pack_ids: отсортированный список id"""
+    if not blob:
+        return []
+    deltas = array('q')
+    deltas.frombytes(zlib.decompress(blob))
+    return list(accumulate(deltas))
+
+# ===== Миграции =====
+
+@migration(1, 'initial schema')
+def _initial_schema(cursor):
+    # Таблица пользователей
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            full_name TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_message_text TEXT,
+            last_message_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Таблица сообщений
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            is_from_user BOOLEAN NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            bot_user_id INTEGER,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (bot_user_id) REFERENCES system_users (id)
+        )
+    ''')
+
+    # Таблица настроек (общие для системы)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS settings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT UNIQUE NOT NULL,
+            value TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Таблица пользователей системы
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS system_users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            role TEXT DEFAULT 'user',
+            full_name TEXT,
+            email TEXT,
+            account_expires TIMESTAMP,
+            is_active BOOLEAN DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_login TIMESTAMP,
+            created_by INTEGER,
+            FOREIGN KEY (created_by) REFERENCES system_users (id)
+        )
+    ''')
+
+    # Таблица индивидуальных настроек пользователей
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_settings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            welcome_message TEXT DEFAULT 'Добро пожаловать! 👋',
+            welcome_pdf_path TEXT DEFAULT '',
+            welcome_file_id TEXT DEFAULT '',
+            welcome_file_caption TEXT DEFAULT '',
+            bot_token TEXT DEFAULT '',
+            bot_username TEXT DEFAULT '',
+            bot_name TEXT DEFAULT 'Мой бот',
+            bot_description TEXT DEFAULT '',
+            start_command TEXT DEFAULT 'Добро пожаловать! Нажмите /help для справки.',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES system_users (id)
+        )
+    ''')
+
+    # Рассылки и логи доставки
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS campaigns (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            text TEXT,
+            photo_file_id TEXT,
+            scheduled_at TIMESTAMP,
+            status TEXT DEFAULT 'scheduled', -- scheduled, sending, sent, failed, canceled
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES system_users (id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS delivery_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,         -- подписчик (получатель)
+            bot_user_id INTEGER NOT NULL,     -- владелец бота
+            campaign_id INTEGER,
+            status TEXT NOT NULL,             -- success, failed
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (bot_user_id) REFERENCES system_users (id),
+            FOREIGN KEY (campaign_id) REFERENCES campaigns (id)
+        )
+    ''')
+
+    # Очищаем дублирующиеся записи пользователей (наследие старых версий)
+    cursor.execute('''
+        DELETE FROM users
+        WHERE id IN (
+            SELECT id FROM users
+            GROUP BY id
+            HAVING COUNT(*) > 1
+        )
+    ''')
+
+@migration(2, 'messages.bot_user_id')
+def _messages_bot_user_id(cursor):
+    """Бывший migrate_messages_table.py: разделение сообщений по ботам"""
+    if _add_column_if_missing(cursor, 'messages', 'bot_user_id', 'INTEGER DEFAULT 1'):
+        # Существующие сообщения привязываем к первому пользователю (админу)
+        cursor.execute('UPDATE messages SET bot_user_id = 1 WHERE bot_user_id IS NULL')
+
+@migration(3, 'user_settings bot columns')
+def _user_settings_bot_columns(cursor):
+    """Бывший migrate_user_settings.py и ALTER-страховки из init_database"""
+    for column_name, column_def in [
+        ('welcome_file_id', 'TEXT'),
+        ('welcome_file_caption', 'TEXT'),
+        ('bot_token', 'TEXT DEFAULT ""'),
+        ('bot_username', 'TEXT DEFAULT ""'),
+        ('bot_name', 'TEXT DEFAULT "Мой бот"'),
+        ('bot_description', 'TEXT DEFAULT ""'),
+        ('start_command', 'TEXT DEFAULT "Добро пожаловать! Нажмите /help для справки."'),
+    ]:
+        _add_column_if_missing(cursor, 'user_settings', column_name, column_def)
+
+    cursor.execute('''
+        UPDATE user_settings
+        SET bot_name = COALESCE(bot_name, 'Мой бот'),
+            bot_description = COALESCE(bot_description, ''),
+            start_command = COALESCE(start_command, 'Добро пожаловать! Нажмите /help для справки.')
+        WHERE bot_name IS NULL OR bot_description IS NULL OR start_command IS NULL
+    ''')
+
+@migration(4, 'base indexes')
+def _base_indexes(cursor):
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages(user_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_bot_user_id ON messages(bot_user_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_system_users_username ON system_users(username)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_system_users_role ON system_users(role)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_system_users_expires ON system_users(account_expires)')
+
+@migration(5, 'bot_subscribers')
+def _bot_subscribers(cursor):
+    """Материализованный список подписчиков каждого бота (вместо оконной функции по messages)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bot_subscribers (
+            bot_user_id INTEGER NOT NULL,     -- владелец бота
+            user_id INTEGER NOT NULL,         -- подписчик
+            first_seen INTEGER NOT NULL,      -- unix-ms первого контакта
+            last_seen INTEGER NOT NULL,       -- unix-ms последней активности подписчика
+            last_message_id INTEGER,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'active',
+            PRIMARY KEY (bot_user_id, user_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_bot_subscribers_first_seen ON bot_subscribers(bot_user_id, first_seen)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_bot_subscribers_last_seen ON bot_subscribers(bot_user_id, last_seen)')
+
+    # Разовое заполнение из истории сообщений
+    cursor.execute(f'''
+        INSERT OR IGNORE INTO bot_subscribers (bot_user_id, user_id, first_seen, last_seen, last_message_id, message_count)
+        SELECT bot_user_id, user_id, MIN(ts), COALESCE(MAX(CASE WHEN is_from_user THEN ts END), MIN(ts)), MAX(id), COUNT(*)
+        FROM (
+            SELECT bot_user_id, user_id, id, is_from_user, {_ts_to_ms_sql('timestamp')} AS ts
+            FROM messages
+            WHERE bot_user_id IS NOT NULL
+        )
+        GROUP BY bot_user_id, user_id
+    ''')
+
+@migration(6, 'bot_stats_rollup')
+def _bot_stats_rollup(cursor):
+    """Почасовая статистика ботов для дашборда и админ-бота"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bot_stats_rollup (
+            bot_user_id INTEGER NOT NULL,
+            hour INTEGER NOT NULL,                    -- unix-ms начала часа
+            messages_in INTEGER NOT NULL DEFAULT 0,
+            messages_out INTEGER NOT NULL DEFAULT 0,
+            active_users INTEGER NOT NULL DEFAULT 0,  -- уникальные подписчики, писавшие в этом часе
+            new_subscribers INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (bot_user_id, hour)
+        ) WITHOUT ROWID
+    ''')
+
+    # Разовое заполнение из истории сообщений и bot_subscribers
+    cursor.execute(f'''
+        INSERT OR IGNORE INTO bot_stats_rollup (bot_user_id, hour, messages_in, messages_out, active_users)
+        SELECT bot_user_id, ts - ts % 3600000 AS hour,
+               SUM(CASE WHEN is_from_user THEN 1 ELSE 0 END),
+               SUM(CASE WHEN is_from_user THEN 0 ELSE 1 END),
+               COUNT(DISTINCT CASE WHEN is_from_user THEN user_id END)
+        FROM (
+            SELECT bot_user_id, user_id, is_from_user, {_ts_to_ms_sql('timestamp')} AS ts
+            FROM messages
+            WHERE bot_user_id IS NOT NULL
+        )
+        GROUP BY bot_user_id, hour
+    ''')
+    cursor.execute('''
+        INSERT INTO bot_stats_rollup (bot_user_id, hour, new_subscribers)
+        SELECT bot_user_id, first_seen - first_seen % 3600000 AS hour, COUNT(*)
+        FROM bot_subscribers
+        GROUP BY bot_user_id, hour
+        ON CONFLICT (bot_user_id, hour) DO UPDATE SET new_subscribers = excluded.new_subscribers
+    ''')
+
+@migration(7, 'campaigns job queue')
+def _campaigns_job_queue(cursor):
+    """Поля очереди рассылок: содержимое, аренда воркера, точка продолжения и счётчики"""
+    for column_name, column_def in [
+        ('document_path', 'TEXT'),
+        ('filename', 'TEXT'),
+        ('caption', 'TEXT'),
+        ('parse_mode', 'TEXT'),
+        ('lease_owner', 'TEXT'),
+        ('lease_expires_at', 'INTEGER'),          # unix-ms
+        ('attempts', 'INTEGER NOT NULL DEFAULT 0'),
+        ('last_error', 'TEXT'),
+        ('last_recipient_id', 'INTEGER NOT NULL DEFAULT 0'),
+        ('sent_count', 'INTEGER NOT NULL DEFAULT 0'),
+        ('failed_count', 'INTEGER NOT NULL DEFAULT 0'),
+    ]:
+        _add_column_if_missing(cursor, 'campaigns', column_name, column_def)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_campaigns_status ON campaigns(status)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_delivery_logs_campaign ON delivery_logs(campaign_id, user_id)')
+
+@migration(8, 'file_id cache')
+def _file_id_cache(cursor):
+    """Кэш file_id загруженных файлов: один файл загружается в Telegram один раз на бота"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS file_id_cache (
+            bot_id TEXT NOT NULL,             -- числовая часть токена бота (file_id действителен только для него)
+            content_hash TEXT NOT NULL,       -- sha256 содержимого файла
+            file_id TEXT NOT NULL,
+            created_at INTEGER NOT NULL,      -- unix-ms
+            PRIMARY KEY (bot_id, content_hash)
+        ) WITHOUT ROWID
+    ''')
+
+@migration(9, 'bot_leases')
+def _bot_leases(cursor):
+    """Аренда ботов процессами-раннерами: один токен опрашивает только владелец аренды"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bot_leases (
+            bot_user_id INTEGER PRIMARY KEY,  -- владелец бота (system_users.id)
+            owner_id TEXT NOT NULL,           -- процесс-раннер: host:pid:экземпляр
+            expires_at INTEGER NOT NULL       -- unix-ms
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_bot_leases_owner ON bot_leases(owner_id)')
+
+@migration(10, 'bot_commands')
+def _bot_commands(cursor):
+    """Команды управления ботами от веб-панели процессу-раннеру"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bot_commands (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            bot_user_id INTEGER NOT NULL,
+            command TEXT NOT NULL,            -- start / stop / reload / status / send
+            payload TEXT,                     -- JSON
+            status TEXT NOT NULL DEFAULT 'pending',  -- pending / running / done / failed / expired
+            result TEXT,                      -- JSON
+            owner_id TEXT,                    -- раннер, взявший команду
+            created_at INTEGER NOT NULL,      -- unix-ms
+            processed_at INTEGER
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_bot_commands_pending ON bot_commands(status, id)')
+
+@migration(11, 'user_settings.settings_version')
+def _user_settings_version(cursor):
+    """Версия настроек бота: растёт при каждом изменении, раннер по ней обновляет кэш настроек"""
+    _add_column_if_missing(cursor, 'user_settings', 'settings_version', 'INTEGER NOT NULL DEFAULT 0')
+
+@migration(12, 'threads')
+def _threads(cursor):
+    """Денормализованный список диалогов бота: последнее сообщение, непрочитанные и счётчик на строку"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS threads (
+            bot_user_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            last_message_id INTEGER,
+            last_message_text TEXT,           -- первые 200 символов
+            last_message_at INTEGER NOT NULL, -- unix-ms последнего сообщения (или первого контакта)
+            unread_count INTEGER NOT NULL DEFAULT 0,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (bot_user_id, user_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_threads_recent ON threads(bot_user_id, last_message_at DESC, user_id DESC)
+    ''')
+
+    # Разовое заполнение: диалог на каждого подписчика, последнее сообщение из истории
+    cursor.execute(f'''
+        INSERT OR IGNORE INTO threads (bot_user_id, user_id, last_message_id, last_message_text, last_message_at, message_count)
+        SELECT s.bot_user_id, s.user_id, m.id, substr(m.text, 1, 200),
+               COALESCE({_ts_to_ms_sql('m.timestamp')}, s.first_seen), s.message_count
+        FROM bot_subscribers s
+        LEFT JOIN messages m ON m.id = s.last_message_id
+    ''')
+
+@migration(13, 'messages thread index')
+def _messages_thread_index(cursor):
+    """Постраничная история диалога: WHERE bot_user_id = ? AND user_id = ? AND id < / > ?"""
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_thread ON messages(bot_user_id, user_id, id)
+    ''')
+
+@migration(14, 'messages.ts')
+def _messages_ts(cursor):
+    """Время сообщения целым unix-ms вместо смеси isoformat и CURRENT_TIMESTAMP в текстовом timestamp.
+    Составные индексы покрывают выборки диалогов и подсчёты по направлению за период."""
+    if _add_column_if_missing(cursor, 'messages', 'ts', 'INTEGER'):
+        cursor.execute(f'''
+            UPDATE messages SET ts = COALESCE({_ts_to_ms_sql('timestamp')}, 0) WHERE ts IS NULL
+        ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_user_ts ON messages(bot_user_id, user_id, ts)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_direction_ts ON messages(bot_user_id, is_from_user, ts)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages(ts)')
+    # Текстовый индекс и индекс-префикс новых больше не нужны
+    cursor.execute('DROP INDEX IF EXISTS idx_messages_timestamp')
+    cursor.execute('DROP INDEX IF EXISTS idx_messages_bot_user_id')
+
+@migration(15, 'campaign_deliveries')
+def _campaign_deliveries(cursor):
+    """Сводка доставки кампании одной строкой: счётчики и сжатые отсортированные массивы id получателей.
+    delivery_logs дальше хранит только неудачные доставки с текстом ошибки."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS campaign_deliveries (
+            campaign_id INTEGER PRIMARY KEY,
+            bot_user_id INTEGER NOT NULL,
+            sent_count INTEGER NOT NULL DEFAULT 0,
+            failed_count INTEGER NOT NULL DEFAULT 0,
+            delivered BLOB,                   -- получатели, которым доставлено
+            failed BLOB,                      -- получатели с ошибкой (и без успешной доставки)
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (campaign_id) REFERENCES campaigns (id)
+        )
+    ''')
+
+    # Разовое заполнение из построчного журнала
+    cursor.execute('''
+        SELECT campaign_id, bot_user_id, user_id, MAX(status = 'success') FROM delivery_logs
+        WHERE campaign_id IS NOT NULL
+        GROUP BY campaign_id, bot_user_id, user_id
+        ORDER BY campaign_id
+    ''')
+    summaries = {}
+    for campaign_id, bot_user_id, user_id, ok in cursor.fetchall():
+        delivered, failed = summaries.setdefault((campaign_id, bot_user_id), ([], []))
+        (delivered if ok else failed).append(user_id)
+    for (campaign_id, bot_user_id), (delivered, failed) in summaries.items():
+        cursor.execute('''
+            INSERT OR IGNORE INTO campaign_deliveries (campaign_id, bot_user_id, sent_count, failed_count, delivered, failed)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (campaign_id, bot_user_id, len(delivered), len(failed), pack_ids(delivered), pack_ids(failed)))
+
+@migration(16, 'bot_subscribers inactive status')
+def _bot_subscribers_inactive(cursor):
+    """Подписчики, до которых рассылка не доходит (заблокировали бота, удалили аккаунт), помечаются
+    status = 'inactive' с причиной; число активных подписчиков считается по частичному индексу"""
+    _add_column_if_missing(cursor, 'bot_subscribers', 'inactive_reason', 'TEXT')
+    _add_column_if_missing(cursor, 'bot_subscribers', 'inactive_since', 'INTEGER')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_bot_subscribers_active ON bot_subscribers(bot_user_id, user_id)
+        WHERE status = 'active'
+    ''')
+
+@migration(17, 'drop idx_messages_user_ts')
+def _drop_messages_user_ts(cursor):
+    """Внутри диалога id и ts растут вместе, выборки диалога идут по idx_messages_thread(bot_user_id, user_id, id);
+    лишний индекс только замедлял вставку сообщений"""
+    cursor.execute('DROP INDEX IF EXISTS idx_messages_user_ts')
+
+@migration(18, 'campaign_delivery_chunks')
+def _campaign_delivery_chunks(cursor):
+    """Итоги доставки дописываются по пачкам (строка на пачку), сводка campaign_deliveries собирает их
+    при завершении кампании. Запись пачки не зависит от размера кампании."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS campaign_delivery_chunks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            campaign_id INTEGER NOT NULL,
+            delivered BLOB,                   -- получатели пачки, которым доставлено (pack_ids)
+            failed BLOB,                      -- получатели пачки с ошибкой
+            FOREIGN KEY (campaign_id) REFERENCES campaigns (id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_campaign_delivery_chunks ON campaign_delivery_chunks(campaign_id)')
+
+@migration(19, 'drop bot_stats_rollup.active_users')
+def _drop_rollup_active_users(cursor):
+    """Сумма уникальных активных по часам не даёт число уникальных за окно, колонку никто не читал:
+    активные подписчики считаются по bot_subscribers.last_seen. DROP COLUMN есть с SQLite 3.35,
+    на более старых версиях колонка остаётся неиспользуемой (DEFAULT 0)"""
+    if sqlite3.sqlite_version_info >= (3, 35, 0) and 'active_users' in _columns(cursor, 'bot_stats_rollup'):
+        cursor.execute('ALTER TABLE bot_stats_rollup DROP COLUMN active_users')
+
+@migration(20, 'campaigns.run_at')
+def _campaigns_run_at(cursor):
+    """Момент запуска кампании в очереди целым unix-ms: scheduled_at записан в локальном времени,
+    created_at — в UTC (CURRENT_TIMESTAMP), и порядок по COALESCE из них сдвигался на смещение часового пояса.
+    Кампании, оставшиеся в 'scheduled' от отключённого планировщика админ-бота (созданы до появления очереди,
+    миграция 7), воркеру не отдаются: status = 'stale', run_at не заполняется"""
+    if not _add_column_if_missing(cursor, 'campaigns', 'run_at', 'INTEGER'):
+        return
+    cursor.execute('''
+        UPDATE campaigns SET status = 'stale', last_error = 'Создана до очереди рассылок, не отправлена'
+        WHERE status = 'scheduled'
+          AND created_at <= (SELECT applied_at FROM schema_version WHERE version = 7)
+    ''')
+    cursor.execute('''
+        UPDATE campaigns
+        SET run_at = CAST(ROUND((COALESCE(julianday(scheduled_at, 'utc'), julianday(created_at)) - 2440587.5)
+                                * 86400000) AS INTEGER)
+        WHERE status != 'stale'
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_campaigns_queue ON campaigns(status, run_at)')
+
+# ===== Применение =====
+
+def _ensure_version_table(conn: sqlite3.Connection):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+
+def get_current_version(conn: sqlite3.Connection) -> int:
+    """Текущая версия схемы (0 для пустой базы)"""
+    _ensure_version_table(conn)
+    row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    return row[0] or 0
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Применить недостающие миграции в одной транзакции.
+    Возвращает количество применённых миграций."""
+    _ensure_version_table(conn)
+
+    # Если версия уже актуальна, обходимся без блокировки на запись
+    latest = max(version for version, _, _ in MIGRATIONS)
+    if get_current_version(conn) >= latest:
+        return 0
+
+    # BEGIN IMMEDIATE сериализует параллельный запуск из нескольких процессов
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        current = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()[0] or 0
+        cursor = conn.cursor()
+        applied = 0
+        for version, name, func in sorted(MIGRATIONS, key=lambda m: m[0]):
+            if version <= current:
+                continue
+            logger.info(f"🔄 Применяем миграцию {version}: {name}")
+            func(cursor)
+            cursor.execute('INSERT INTO schema_version (version, name) VALUES (?, ?)', (version, name))
+            applied += 1
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    if applied:
+        logger.info(f"✅ Применено миграций: {applied}, версия схемы: {latest}")
+    return applied
+
+def main(argv: List[str]) -> int:
+    db_path = 'data/bot.db'
+    if '--db' in argv:
+        db_path = argv[argv.index('--db') + 1]
+
+    if 'status' in argv:
+        if not os.path.exists(db_path):
+            print(f"❌ База данных не найдена: {db_path}")
+            return 1
+        with sqlite3.connect(db_path) as conn:
+            current = get_current_version(conn)
+        print(f"📋 Версия схемы: {current}")
+        for version, name, _ in sorted(MIGRATIONS, key=lambda m: m[0]):
+            mark = '✅' if version <= current else '⏳'
+            print(f"  {mark} {version}: {name}")
+        return 0
+
+    os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+    print(f"🚀 Запуск миграций для {db_path}...")
+    try:
+        with sqlite3.connect(db_path) as conn:
+            applied = migrate(conn)
+            current = get_current_version(conn)
+        print(f"🎉 Применено миграций: {applied}, версия схемы: {current}")
+        return 0
+    except Exception as e:
+        print(f"💥 Миграция завершилась с ошибкой: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    sys.exit(main(sys.argv[1:]))
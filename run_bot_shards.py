@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+"""
+Запуск пользовательских ботов в нескольких процессах
+Супервизор распределяет боты по BOT_SHARDS процессам и перезапускает упавшие
+"""
+
+import logging
+import os
+import signal
+import sys
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+def main():
+    # Ensure project root on path
+    root = os.path.dirname(os.path.abspath(__file__))
+    sys.path.append(os.path.join(root, 'bot'))
+    from bot.shard_supervisor import ShardSupervisor
+    shards = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    supervisor = ShardSupervisor(shards)
+    signal.signal(signal.SIGTERM, lambda *_: supervisor.stop())
+    # Отчёт по шардам по запросу: kill -USR1 <pid>
+    signal.signal(signal.SIGUSR1, lambda *_: supervisor.log_report())
+    try:
+        supervisor.run_forever()
+    except KeyboardInterrupt:
+        supervisor.stop_shards()
+        print("\n👋 Завершение работы...")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+"""
+Запуск воркера очереди рассылок
+Веб-панель и админ-бот только ставят кампании в очередь, рассылает их этот процесс
+"""
+
+import logging
+import os
+import sys
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+def main():
+    # Ensure project root on path
+    root = os.path.dirname(os.path.abspath(__file__))
+    sys.path.append(os.path.join(root, 'bot'))
+    from bot.broadcast_worker import BroadcastWorker
+    worker = BroadcastWorker()
+    try:
+        worker.run_forever()
+    except KeyboardInterrupt:
+        worker.stop()
+        print("\n👋 Завершение работы...")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+"""
+Запуск потока событий диалогов (SSE) для веб-панели
+Страница /dialogs получает новые сообщения отсюда вместо опроса /api/messages каждые 5 секунд
+"""
+
+import asyncio
+import logging
+import os
+import sys
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+def main():
+    # Ensure project root on path
+    root = os.path.dirname(os.path.abspath(__file__))
+    sys.path.append(root)
+    from web.stream import DialogStreamServer
+    try:
+        asyncio.run(DialogStreamServer().serve_forever())
+    except KeyboardInterrupt:
+        print("\n👋 Завершение работы...")
+
+if __name__ == "__main__":
+    main()
@@ -35,10 +35,19 @@ def main():
         
         # Импортируем менеджер ботов
         from bot.user_bot_manager import bot_manager
+        from config import Config
         from database import Database
         
         print("✅ Менеджер ботов загружен")
         
+        # В режиме webhook сервер должен слушать до регистрации setWebhook ботами
+        if Config.BOT_INGRESS == 'webhook':
+            bot_manager.start_webhook_server()
+            print(f"🌐 Webhook-сервер запущен на {Config.WEBHOOK_HOST}:{Config.WEBHOOK_PORT}")
+        
+        # Команды веб-панели (перезагрузка, статус, остановка) приходят через таблицу bot_commands
+        bot_manager.start_control_server()
+        
         # Получаем всех пользователей с настройками ботов
         db = Database()
         system_users = db.get_all_system_users()
@@ -69,7 +78,7 @@ def main():
                         print(f"✅ Бот пользователя {user['username']} успешно запущен")
                     else:
                         failed_bots += 1
-                        print(f"❌ Ошибка запуска бота пользователя {user['username']}")
+                        print(f"❌ Бот пользователя {user['username']} не запущен (ошибка или его аренда у другого процесса)")
                 else:
                     print(f"⚠️ У пользователя {user['username']} нет настроек бота")
         
@@ -0,0 +1,41 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database  # noqa: E402
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    """Отдельный файл БД на тест (абсолютный путь: пул соединений и миграции кешируются по пути)"""
+    return str(tmp_path / 'data' / 'bot.db')
+
+
+@pytest.fixture
+def db(db_path):
+    database = Database(db_path)
+    yield database
+    database.close()
+
+
+@pytest.fixture
+def bot_owner(db):
+    """Владелец бота с токеном и 100 подписчиками (user_id 1..100)"""
+    owner_id = 5
+    db.get_user_settings(owner_id)
+    db.update_user_bot_token(owner_id, '123:abc', 'test_bot')
+    for user_id in range(1, 101):
+        db.add_user(user_id, f'user{user_id}', 'Имя', 'Фамилия', bot_user_id=owner_id)
+    return owner_id
+
+
+@pytest.fixture
+def default_db(db, db_path, monkeypatch):
+    """Database() и AsyncDatabase() без явного пути (менеджер ботов, кэш file_id) открывают тестовую БД"""
+    from database import AsyncDatabase
+    monkeypatch.setattr(Database.__init__, '__defaults__', (db_path,))
+    monkeypatch.setattr(AsyncDatabase.__init__, '__defaults__', (db_path,))
+    return db
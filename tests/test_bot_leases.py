@@ -0,0 +1,53 @@
+import threading
+
+from database import Database
+
+
+def test_only_one_runner_gets_the_lease(db, db_path):
+    """Раннеры гонятся за арендой одного бота, каждый со своим соединением: побеждает ровно один"""
+    barrier = threading.Barrier(8)
+    winners = []
+
+    def runner(index):
+        database = Database(db_path)
+        try:
+            barrier.wait()
+            if database.acquire_bot_lease(5, f'runner-{index}', ttl_seconds=60):
+                winners.append(index)
+        finally:
+            database.close()
+
+    threads = [threading.Thread(target=runner, args=(index,)) for index in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(winners) == 1
+    assert db.get_bot_leases()[0]['owner_id'] == f'runner-{winners[0]}'
+
+
+def test_lease_is_renewed_by_owner_and_taken_over_after_expiry(db):
+    assert db.acquire_bot_lease(5, 'a', ttl_seconds=60)
+    # Своя аренда продлевается, чужая живая — нет
+    assert db.acquire_bot_lease(5, 'a', ttl_seconds=60)
+    assert not db.acquire_bot_lease(5, 'b', ttl_seconds=60)
+
+    with db.transaction() as conn:
+        conn.execute('UPDATE bot_leases SET expires_at = 0 WHERE bot_user_id = 5')
+    assert db.acquire_bot_lease(5, 'b', ttl_seconds=60)
+    # Прежний владелец узнаёт о потере аренды при продлении
+    assert db.renew_bot_leases('a', [5]) == set()
+    assert db.renew_bot_leases('b', [5, 6]) == {5}
+
+
+def test_release_only_own_leases(db):
+    db.acquire_bot_lease(5, 'a')
+    db.acquire_bot_lease(6, 'a')
+    db.acquire_bot_lease(7, 'b')
+
+    assert not db.release_bot_lease(7, 'a')
+    assert db.release_bot_lease(5, 'a')
+    assert db.release_bot_leases('a') == 1
+    assert [lease['bot_user_id'] for lease in db.get_bot_leases()] == [7]
+    assert db.acquire_bot_lease(5, 'b')
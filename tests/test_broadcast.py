@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+
+from bot.broadcast import BroadcastEngine, RateLimiter
+
+
+class RetryAfter(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f'Flood control exceeded. Retry in {retry_after} seconds')
+        self.retry_after = retry_after
+
+
+def make_engine(concurrency=4, max_retries=None):
+    engine = BroadcastEngine(f'test-token-{id(object())}', concurrency=concurrency, max_retries=max_retries)
+    # Лимитер без ожиданий: тестируем параллелизм и обработку ошибок, а не темп
+    engine.limiter = RateLimiter(10 ** 6, per_chat_interval=0)
+    return engine
+
+
+def test_engine_sends_everyone_with_bounded_concurrency():
+    engine = make_engine(concurrency=4)
+    active = {'now': 0, 'max': 0}
+    sent = []
+    results = []
+
+    async def send(chat_id):
+        active['now'] += 1
+        active['max'] = max(active['max'], active['now'])
+        await asyncio.sleep(0.001)
+        active['now'] -= 1
+        if chat_id % 10 == 0:
+            raise Exception('Forbidden: bot was blocked by the user')
+        sent.append(chat_id)
+
+    async def run():
+        return await engine.run(range(1, 101), send, on_result=lambda chat_id, ok, error: results.append((chat_id, ok)))
+
+    assert asyncio.run(run()) == (90, 10)
+    assert sorted(sent) == [chat_id for chat_id in range(1, 101) if chat_id % 10]
+    assert len(results) == 100
+    assert active['max'] == 4
+
+
+def test_engine_reads_async_source_lazily():
+    engine = make_engine(concurrency=2)
+    read = []
+
+    async def source():
+        for chat_id in range(1, 1001):
+            read.append(chat_id)
+            yield chat_id
+
+    async def send(chat_id):
+        await asyncio.sleep(0)
+
+    async def run():
+        stream = engine.stream(source(), send, progress_every=10)
+        first = await stream.__anext__()
+        # Источник читается не дальше буфера очереди и воркеров
+        assert len(read) <= first['processed'] + engine.concurrency * 3 + 1
+        async for progress in stream:
+            pass
+        return progress
+
+    progress = asyncio.run(run())
+    assert progress == {'processed': 1000, 'sent': 1000, 'failed': 0, 'done': True}
+
+
+def test_engine_retries_after_rate_limit():
+    engine = make_engine(concurrency=2, max_retries=2)
+    attempts = {}
+
+    async def send(chat_id):
+        attempts[chat_id] = attempts.get(chat_id, 0) + 1
+        if chat_id == 7 and attempts[chat_id] == 1:
+            raise RetryAfter(0.01)
+        if chat_id == 8:
+            raise RetryAfter(0.01)
+
+    assert asyncio.run(engine.run([6, 7, 8], send)) == (2, 1)
+    assert attempts == {6: 1, 7: 2, 8: 3}
+
+
+def test_failed_source_cancels_workers():
+    engine = make_engine(concurrency=8)
+    sent = []
+
+    async def source():
+        for chat_id in range(1, 6):
+            yield chat_id
+        raise RuntimeError('database is locked')
+
+    async def send(chat_id):
+        sent.append(chat_id)
+
+    async def run():
+        with pytest.raises(RuntimeError):
+            await engine.run(source(), send)
+        await asyncio.sleep(0)
+        # Ни один воркер не остался ждать очередь на общем event loop
+        return [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+    assert asyncio.run(run()) == []
+    assert len(sent) <= 5
+
+
+def test_rate_limiter_spaces_messages_to_one_chat():
+    limiter = RateLimiter(rate=100, burst=100, per_chat_interval=1.0)
+    assert limiter.reserve(1) == 0
+    assert limiter.reserve(2) == 0
+    assert limiter.reserve(1) == pytest.approx(1.0, abs=0.01)
+
+
+def test_rate_limiter_token_bucket_and_pause():
+    limiter = RateLimiter(rate=10, burst=2, per_chat_interval=0)
+    assert limiter.reserve() == 0
+    assert limiter.reserve() == 0
+    assert limiter.reserve() == pytest.approx(0.1, abs=0.01)
+
+    limiter.pause(5)
+    assert limiter.pause_remaining() == pytest.approx(5, abs=0.01)
+    assert limiter.reserve() >= 4.9
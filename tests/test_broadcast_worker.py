@@ -0,0 +1,186 @@
+import asyncio
+from collections import Counter
+from datetime import datetime, timedelta
+
+import pytest
+
+import bot.broadcast_worker as broadcast_worker
+from bot.broadcast import BroadcastEngine, RateLimiter
+
+
+class FakeTelegram:
+    """Подмена bot.broadcast.broadcast: тот же движок, отправка в память.
+    crash_after — после стольких отправок источник получателей падает (как упавший процесс/сеть)"""
+
+    def __init__(self, crash_after: int = None, blocked=()):
+        self.sent = []
+        self.crash_after = crash_after
+        self.blocked = set(blocked)
+
+    async def broadcast(self, bot_token, chat_ids, on_result=None, **content):
+        async def send(chat_id):
+            self.sent.append(chat_id)
+            if chat_id in self.blocked:
+                raise Exception('Forbidden: bot was blocked by the user')
+
+        async def source():
+            async for chat_id in chat_ids:
+                if self.crash_after is not None and len(self.sent) >= self.crash_after:
+                    raise RuntimeError('соединение потеряно')
+                yield chat_id
+
+        engine = BroadcastEngine(bot_token, concurrency=4)
+        engine.limiter = RateLimiter(10 ** 6, per_chat_interval=0)
+        return await engine.run(source(), send, on_result=on_result)
+
+
+@pytest.fixture
+def worker(db_path):
+    worker = broadcast_worker.BroadcastWorker('test-worker', db_path=db_path)
+    worker.heartbeat_seconds = 0.01
+    return worker
+
+
+def run_campaign(db, worker, fake, monkeypatch):
+    """Взять кампанию из очереди и обработать её (повтор после сбоя — сразу, без задержки)"""
+    monkeypatch.setattr(broadcast_worker, 'broadcast', fake.broadcast)
+    with db.transaction() as conn:
+        conn.execute("UPDATE campaigns SET run_at = 0 WHERE status = 'scheduled'")
+    job = db.claim_campaign(worker.worker_id)
+    assert job is not None
+    asyncio.run(worker.process(job))
+    return job['id']
+
+
+def assert_counts_consistent(db, campaign_id):
+    campaign = db.get_campaign(campaign_id)
+    summary = db.get_delivery_summary(campaign_id)
+    assert (campaign['sent_count'], campaign['failed_count']) == (summary['sent_count'], summary['failed_count'])
+    assert summary['sent_count'] == len(summary['delivered'])
+    assert summary['failed_count'] == len(summary['failed'])
+    return campaign, summary
+
+
+def test_claim_order_and_due_time_use_one_clock(db):
+    soon = (datetime.now() + timedelta(minutes=5)).isoformat(' ', timespec='seconds')
+    past = (datetime.now() - timedelta(minutes=5)).isoformat(' ', timespec='seconds')
+    later = db.create_campaign(5, text='через 5 минут', scheduled_at=soon)
+    now = db.create_campaign(5, text='сейчас')
+    earlier = db.create_campaign(5, text='5 минут назад', scheduled_at=past)
+
+    # Запланированная в прошлом идёт раньше созданной сейчас, будущая ещё не выдаётся
+    assert db.claim_campaign('w1')['id'] == earlier
+    assert db.claim_campaign('w1')['id'] == now
+    assert db.claim_campaign('w1') is None
+    assert db.get_campaign(later)['status'] == 'scheduled'
+
+
+def test_expired_lease_is_reclaimed(db):
+    campaign_id = db.create_campaign(5, text='привет')
+    assert db.claim_campaign('w1', lease_seconds=60)['id'] == campaign_id
+    assert db.claim_campaign('w2') is None
+
+    with db.transaction() as conn:
+        conn.execute('UPDATE campaigns SET lease_expires_at = 0 WHERE id = ?', (campaign_id,))
+    job = db.claim_campaign('w2')
+    assert job['id'] == campaign_id and job['lease_owner'] == 'w2' and job['attempts'] == 2
+    # Старый воркер больше не может ни продлить, ни завершить кампанию
+    assert not db.heartbeat_campaign(campaign_id, 'w1', 10, 10, 0)
+    assert not db.complete_campaign(campaign_id, 'w1')
+    assert db.complete_campaign(campaign_id, 'w2')
+
+
+def test_retry_delays_campaign_and_fails_after_max_attempts(db):
+    campaign_id = db.create_campaign(5, text='привет')
+    db.claim_campaign('w1')
+    assert db.retry_campaign(campaign_id, 'w1', 'сбой', delay_seconds=60, max_attempts=2)
+    campaign = db.get_campaign(campaign_id)
+    assert campaign['status'] == 'scheduled' and campaign['scheduled_at'] is None
+    assert db.claim_campaign('w1') is None
+
+    with db.transaction() as conn:
+        conn.execute('UPDATE campaigns SET run_at = 0 WHERE id = ?', (campaign_id,))
+    db.claim_campaign('w1')
+    assert db.retry_campaign(campaign_id, 'w1', 'снова сбой', max_attempts=2)
+    assert db.get_campaign(campaign_id)['status'] == 'failed'
+
+
+def test_crash_and_resume_delivers_everyone_once(db, bot_owner, worker, monkeypatch):
+    db.create_campaign(bot_owner, text='привет')
+    fake = FakeTelegram(crash_after=37, blocked={10, 20, 30, 40, 50})
+
+    campaign_id = run_campaign(db, worker, fake, monkeypatch)
+    campaign = db.get_campaign(campaign_id)
+    assert campaign['status'] == 'scheduled'
+    assert 0 < len(fake.sent) < 100
+    # Итоги отправленного до сбоя записаны, точка продолжения не впереди записанных итогов
+    counts = db.get_delivery_counts(campaign_id)
+    assert counts['sent_count'] + counts['failed_count'] == len(fake.sent)
+    assert campaign['last_recipient_id'] <= max(fake.sent)
+
+    fake.crash_after = None
+    run_campaign(db, worker, fake, monkeypatch)
+
+    campaign, summary = assert_counts_consistent(db, campaign_id)
+    assert campaign['status'] == 'sent'
+    assert Counter(fake.sent) == Counter(range(1, 101))
+    assert summary['failed'] == [10, 20, 30, 40, 50]
+    assert (campaign['sent_count'], campaign['failed_count']) == (95, 5)
+    # Заблокировавшие бота исключены из аудитории
+    assert db.get_total_subscribers_count(bot_owner, active_only=True) == 95
+
+
+def test_unrecorded_results_are_resent(db, bot_owner, worker, monkeypatch):
+    """Если итоги не удалось записать, точка продолжения не сдвигается: получатели получат сообщение
+    повторно (at-least-once), но счётчики не задваиваются"""
+    db.create_campaign(bot_owner, text='привет')
+    fake = FakeTelegram(crash_after=40)
+    original = worker.db.record_deliveries
+
+    def locked(*args):
+        raise Exception('database is locked')
+
+    monkeypatch.setattr(worker.db, 'record_deliveries', locked)
+    campaign_id = run_campaign(db, worker, fake, monkeypatch)
+    assert db.get_campaign(campaign_id)['last_recipient_id'] == 0
+    assert db.get_delivery_counts(campaign_id) == {'sent_count': 0, 'failed_count': 0}
+
+    monkeypatch.setattr(worker.db, 'record_deliveries', original)
+    fake.crash_after = None
+    run_campaign(db, worker, fake, monkeypatch)
+
+    campaign, summary = assert_counts_consistent(db, campaign_id)
+    assert campaign['status'] == 'sent'
+    assert set(fake.sent) == set(range(1, 101))
+    assert summary['sent_count'] == 100
+
+
+def test_lost_lease_keeps_document(db, bot_owner, worker, monkeypatch, tmp_path):
+    monkeypatch.setattr(broadcast_worker, 'BROADCAST_UPLOAD_FOLDER', str(tmp_path))
+    document = tmp_path / 'price.pdf'
+    document.write_bytes(b'%PDF')
+    db.create_campaign(bot_owner, document_path=str(document), filename='price.pdf')
+    fake = FakeTelegram()
+
+    async def steal_lease(bot_token, chat_ids, on_result=None, **content):
+        result = await fake.broadcast(bot_token, chat_ids, on_result=on_result, **content)
+        # Пока шла рассылка, кампанию забрал другой воркер
+        with db.transaction() as conn:
+            conn.execute("UPDATE campaigns SET lease_owner = 'other-worker'")
+        return result
+
+    monkeypatch.setattr(broadcast_worker, 'broadcast', steal_lease)
+    job = db.claim_campaign(worker.worker_id)
+    asyncio.run(worker.process(job))
+
+    assert document.exists()
+    assert db.get_campaign(job['id'])['status'] == 'sending'
+
+    # Завершение собственной кампании удаляет файл
+    with db.transaction() as conn:
+        conn.execute("UPDATE campaigns SET lease_expires_at = 0")
+    job = db.claim_campaign(worker.worker_id)
+    monkeypatch.setattr(broadcast_worker, 'broadcast', fake.broadcast)
+    asyncio.run(worker.process(job))
+    assert db.get_campaign(job['id'])['status'] == 'sent'
+    assert not document.exists()
@@ -0,0 +1,99 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import bot.control as control
+from config import Config
+from database import Database
+
+
+class FakeManager:
+    """UserBotManager для канала управления: запоминает выполненные команды"""
+
+    def __init__(self, owner_id):
+        self.owner_id = owner_id
+        self.bots = {}
+        self.executed = []
+        self.lock = threading.Lock()
+
+    def get_bot(self, user_id):
+        return self.bots.get(user_id)
+
+    def reload_bot(self, user_id):
+        with self.lock:
+            self.executed.append(('reload', user_id))
+        self.bots[user_id] = SimpleNamespace(is_running=True, bot_username='test_bot', start_failed=False)
+        return True
+
+    def stop_bot(self, user_id):
+        with self.lock:
+            self.executed.append(('stop', user_id))
+        return self.bots.pop(user_id, None) is not None
+
+    def refresh_settings(self):
+        return 0
+
+
+@pytest.fixture
+def runners(db, db_path, monkeypatch):
+    monkeypatch.setattr(control, 'Database', lambda: Database(db_path))
+    monkeypatch.setattr(Config, 'CONTROL_POLL_SECONDS', 0.01)
+    servers = []
+
+    def start(*owner_ids):
+        managers = [FakeManager(owner_id) for owner_id in owner_ids]
+        for manager in managers:
+            server = control.ControlServer(manager)
+            server.start()
+            servers.append(server)
+        return managers
+
+    yield start
+    for server in servers:
+        server.stop()
+        server._thread.join(timeout=5)
+
+
+def test_command_runs_once_on_the_lease_owner(db, runners):
+    db.acquire_bot_lease(5, 'runner-b')
+    runner_a, runner_b = runners('runner-a', 'runner-b')
+
+    assert control.send_command(5, 'start', timeout=5) == {'ok': True, 'message': 'Бот успешно перезагружен'}
+    assert runner_a.executed == []
+    assert runner_b.executed == [('reload', 5)]
+
+    status = control.send_command(5, 'status', timeout=5)
+    assert status['ok'] and status['running'] and status['owner_id'] == 'runner-b'
+
+
+def test_command_for_unleased_bot_runs_exactly_once(db, runners):
+    managers = runners('runner-a', 'runner-b', 'runner-c')
+
+    results = [control.send_command(user_id, 'reload', timeout=5) for user_id in (1, 2, 3, 4)]
+    assert all(result['ok'] for result in results)
+    executed = sorted(command for manager in managers for command in manager.executed)
+    assert executed == [('reload', 1), ('reload', 2), ('reload', 3), ('reload', 4)]
+
+
+def test_failed_command_reports_error(db, runners):
+    runners('runner-a')
+    assert control.send_command(5, 'stop', timeout=5) == {'ok': False, 'error': 'Бот не запущен'}
+
+
+def test_unanswered_command_expires(db, db_path, monkeypatch):
+    monkeypatch.setattr(control, 'Database', lambda: Database(db_path))
+    monkeypatch.setattr(Config, 'CONTROL_POLL_SECONDS', 0.01)
+    # Бот арендован раннером, который не отвечает
+    db.acquire_bot_lease(5, 'dead-runner')
+
+    assert control.send_command(5, 'reload', timeout=0.1) == {'ok': False, 'error': 'Процесс ботов не отвечает'}
+    conn = db._get_connection()
+    assert conn.execute('SELECT status FROM bot_commands').fetchone() == ('expired',)
+    # Просроченную команду уже никто не заберёт
+    assert db.claim_bot_commands('dead-runner') == []
+
+
+def test_unknown_command_is_rejected():
+    with pytest.raises(ValueError):
+        control.send_command(5, 'format_disk')
@@ -0,0 +1,131 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from bot.broadcast import DeliveryRecorder, classify_delivery_error
+from migrations import pack_ids, unpack_ids
+
+
+@pytest.mark.parametrize('ids', [
+    [],
+    [42],
+    [5, 3, 3, 1, 9],
+    [-1001234567890, -5, 0, 7],
+    list(range(10 ** 9, 10 ** 9 + 50000, 7)),
+])
+def test_pack_ids_round_trip(ids):
+    assert unpack_ids(pack_ids(ids)) == sorted(set(ids))
+
+
+def test_pack_ids_is_compact():
+    ids = list(range(10 ** 9, 10 ** 9 + 100000, 3))
+    assert len(pack_ids(ids)) < len(ids)
+
+
+def test_unpack_empty_blob():
+    assert unpack_ids(None) == []
+    assert unpack_ids(b'') == []
+
+
+def test_record_deliveries_appends_batches_and_compacts(db):
+    campaign_id = db.create_campaign(5, text='привет')
+
+    totals = db.record_deliveries(campaign_id, 5, [(1, True, None), (2, False, 'transient: timeout'), (3, True, None)])
+    assert totals == {'sent_count': 2, 'failed_count': 1}
+    totals = db.record_deliveries(campaign_id, 5, [(4, False, 'blocked: Forbidden'), (2, True, None)])
+    assert totals == {'sent_count': 3, 'failed_count': 2}
+    assert db.get_delivery_counts(campaign_id) == totals
+
+    # Пока кампания идёт, пачки сливаются при чтении
+    summary = db.get_delivery_summary(campaign_id)
+    assert summary['delivered'] == [1, 2, 3]
+    assert summary['failed'] == [4]
+    assert db.get_failed_recipient_ids(campaign_id) == [4]
+    assert db.get_delivered_recipient_ids(campaign_id, after_id=2) == {3, 4}
+
+    # Сборка в сводку: точные счётчики без повторов, пачки удалены
+    assert db.compact_deliveries(campaign_id) == {'sent_count': 3, 'failed_count': 1}
+    conn = db._get_connection()
+    assert conn.execute('SELECT COUNT(*) FROM campaign_delivery_chunks').fetchone()[0] == 0
+    assert db.get_delivery_summary(campaign_id)['delivered'] == [1, 2, 3]
+    assert db.get_failed_recipient_ids(campaign_id) == [4]
+
+    # В журнал построчно пишутся только ошибки
+    logged = conn.execute(
+        'SELECT user_id, status, error FROM delivery_logs WHERE campaign_id = ? ORDER BY id', (campaign_id,)
+    ).fetchall()
+    assert logged == [(2, 'failed', 'transient: timeout'), (4, 'failed', 'blocked: Forbidden')]
+
+
+def test_record_deliveries_rolls_back_whole_batch(db):
+    campaign_id = db.create_campaign(5, text='привет')
+    with pytest.raises(sqlite3.Error):
+        db.record_deliveries(campaign_id, 5, [(1, True, None), (2, False, object())])
+    assert db.get_delivery_counts(campaign_id) == {'sent_count': 0, 'failed_count': 0}
+    assert db.get_delivery_summary(campaign_id) is None
+
+
+def test_recorder_keeps_results_after_failed_flush(db, monkeypatch):
+    campaign_id = db.create_campaign(5, text='привет')
+    calls = {'n': 0}
+    original = db.record_deliveries
+
+    def flaky(*args):
+        calls['n'] += 1
+        if calls['n'] == 1:
+            raise sqlite3.OperationalError('database is locked')
+        return original(*args)
+
+    monkeypatch.setattr(db, 'record_deliveries', flaky)
+
+    async def run():
+        recorder = DeliveryRecorder(db, campaign_id, 5)
+        recorder.add(1, True, None)
+        assert await recorder.flush() is False
+        recorder.add(2, True, None)
+        assert await recorder.flush(final=True) is True
+        return recorder.totals
+
+    assert asyncio.run(run()) == {'sent_count': 2, 'failed_count': 0}
+
+
+class Forbidden(Exception):
+    pass
+
+
+class RetryAfter(Exception):
+    retry_after = 5
+
+
+@pytest.mark.parametrize('error, kind', [
+    (Forbidden('Forbidden: bot was blocked by the user'), 'blocked'),
+    (Forbidden('Forbidden: user is deactivated'), 'deactivated'),
+    (Exception('Bad Request: chat not found'), 'chat_not_found'),
+    (RetryAfter('Flood control exceeded'), 'rate_limited'),
+    (TimeoutError('timed out'), 'transient'),
+    (Exception("Bad Request: can't parse entities"), 'transient'),
+])
+def test_classify_delivery_error(error, kind):
+    assert classify_delivery_error(error) == kind
+
+
+def test_recorder_deactivates_unreachable_and_inbound_reactivates(db, bot_owner):
+    campaign_id = db.create_campaign(bot_owner, text='привет')
+
+    async def run():
+        recorder = DeliveryRecorder(db, campaign_id, bot_owner, flush_seconds=60)
+        recorder.start()
+        recorder.add(1, True, None)
+        recorder.add(2, False, Forbidden('Forbidden: bot was blocked by the user'))
+        recorder.add(3, False, TimeoutError('timed out'))
+        await recorder.close(final=True)
+        return recorder.totals
+
+    assert asyncio.run(run()) == {'sent_count': 1, 'failed_count': 2}
+    audience = set(db.iter_recipient_ids(bot_owner))
+    assert 2 not in audience and {1, 3} <= audience
+    assert db.get_total_subscribers_count(bot_owner, active_only=True) == 99
+
+    db.add_message(2, 'я вернулся', True, bot_owner)
+    assert 2 in set(db.iter_recipient_ids(bot_owner))
@@ -0,0 +1,71 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from bot.file_cache import FileIdCache, file_sha256
+
+
+class FakeBot:
+    """telegram.Bot с одной операцией send_document: загрузка файла возвращает новый file_id"""
+
+    def __init__(self, valid_file_ids=None):
+        self.uploads = 0
+        self.by_file_id = []
+        self.valid_file_ids = valid_file_ids
+
+    async def send_document(self, chat_id, document, filename=None, caption=None):
+        await asyncio.sleep(0.001)
+        if isinstance(document, str):
+            if self.valid_file_ids is not None and document not in self.valid_file_ids:
+                raise Exception('Bad Request: wrong file identifier/http url specified')
+            self.by_file_id.append(chat_id)
+            return SimpleNamespace(document=SimpleNamespace(file_id=document))
+        assert document.read() == b'%PDF-1.4'
+        self.uploads += 1
+        file_id = f'file-{self.uploads}'
+        if self.valid_file_ids is not None:
+            self.valid_file_ids.add(file_id)
+        return SimpleNamespace(document=SimpleNamespace(file_id=file_id))
+
+
+@pytest.fixture
+def document(tmp_path):
+    path = tmp_path / 'price.pdf'
+    path.write_bytes(b'%PDF-1.4')
+    return str(path)
+
+
+def test_concurrent_sends_upload_once(db, document):
+    cache = FileIdCache('123:abc', document, db=db)
+    bot = FakeBot()
+
+    async def run():
+        await asyncio.gather(*(cache.send(bot, chat_id) for chat_id in range(20)))
+
+    asyncio.run(run())
+    assert bot.uploads == 1
+    assert len(bot.by_file_id) == 19
+    # file_id переживает процесс: следующий кэш того же файла сразу отправляет по нему
+    assert db.get_cached_file_id('123', file_sha256(document)) == 'file-1'
+    assert FileIdCache('123:abc', document, db=db).file_id == 'file-1'
+    # file_id другого бота недействителен
+    assert FileIdCache('456:def', document, db=db).file_id is None
+
+
+def test_rejected_file_id_is_uploaded_again(db, document):
+    db.save_cached_file_id('123', file_sha256(document), 'expired')
+    cache = FileIdCache('123:abc', document, db=db)
+    bot = FakeBot(valid_file_ids=set())
+
+    asyncio.run(cache.send(bot, 1))
+    assert bot.uploads == 1
+    assert cache.file_id == 'file-1'
+    assert db.get_cached_file_id('123', file_sha256(document)) == 'file-1'
+
+
+def test_changed_file_gets_new_hash(document):
+    first = file_sha256(document)
+    with open(document, 'ab') as file:
+        file.write(b'\n% v2')
+    assert file_sha256(document) != first
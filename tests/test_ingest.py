@@ -0,0 +1,52 @@
+from bot.ingest import IngestBuffer
+
+
+def test_ingest_batch_assigns_message_ids_in_order(db):
+    # Строки до пачки: id пачки продолжают последовательность
+    db.add_message(1, 'раньше', True, 5)
+    now = 1_700_000_000_000
+    messages = [
+        (1, 'первое', True, 5, now),
+        (2, 'от другого', True, 5, now + 1),
+        (1, 'ответ', False, 5, now + 2),
+        (3, 'другой бот', True, 7, now + 3),
+        (4, 'без бота', True, None, now + 4),
+    ]
+    assert db.ingest_batch([], messages) == len(messages)
+
+    conn = db._get_connection()
+    rows = conn.execute('SELECT id, user_id, text, bot_user_id, ts FROM messages WHERE id > 1 ORDER BY id').fetchall()
+    assert [row[0] for row in rows] == [2, 3, 4, 5, 6]
+    assert [(row[1], row[2], row[3], row[4]) for row in rows] == [
+        (user_id, text, bot_user_id, ts) for user_id, text, _, bot_user_id, ts in messages
+    ]
+
+    # Подписчики и диалоги ссылаются на свои сообщения
+    last_ids = dict(conn.execute('SELECT user_id, last_message_id FROM bot_subscribers WHERE bot_user_id = 5'))
+    assert last_ids == {1: 4, 2: 3}
+    assert conn.execute(
+        'SELECT last_message_id, last_message_text, unread_count FROM threads WHERE bot_user_id = 5 AND user_id = 1'
+    ).fetchone() == (4, 'ответ', 0)
+    assert conn.execute(
+        'SELECT last_message_id FROM threads WHERE bot_user_id = 7 AND user_id = 3'
+    ).fetchone() == (5,)
+
+
+def test_ingest_buffer_dead_letters_bad_row(db, db_path):
+    buffer = IngestBuffer(flush_ms=60000, max_retries=1, db_path=db_path)
+    buffer.add_message(1, 'хорошее', True, 5)
+    buffer.add_message(2, object(), True, 5)
+    buffer.add_user(3, 'user3', 'Имя', 'Фамилия', 5)
+
+    assert buffer.flush() == 0  # первая ошибка — повтор всей пачки
+    assert buffer.flush() == 2  # повторы исчерпаны — построчно, плохая строка в dead-letter
+    assert buffer.stats() == {'pending': 0, 'dropped': 0, 'dead_lettered': 1}
+    assert db.get_total_subscribers_count(5) == 2
+
+
+def test_ingest_buffer_is_bounded(db_path):
+    buffer = IngestBuffer(flush_ms=60000, max_pending=3, db_path=db_path)
+    for _ in range(5):
+        buffer.add_message(1, 'текст', True, 5)
+    assert buffer.stats() == {'pending': 3, 'dropped': 2, 'dead_lettered': 0}
+    buffer.close()
@@ -0,0 +1,70 @@
+import pytest
+
+OWNER = 5
+
+
+@pytest.fixture
+def dialog(db):
+    """Диалог из 12 сообщений (id 1..12) и чужие сообщения между ними"""
+    now = 1_700_000_000_000
+    messages = []
+    for i in range(12):
+        messages.append((1, f'сообщение {i}', i % 2 == 0, OWNER, now + i))
+        messages.append((2, 'другой подписчик', True, OWNER, now + i))
+        messages.append((1, 'другой бот', True, 7, now + i))
+    db.ingest_batch([], messages)
+    return [row[0] for row in db._get_connection().execute(
+        'SELECT id FROM messages WHERE bot_user_id = ? AND user_id = 1 ORDER BY id', (OWNER,))]
+
+
+def test_message_page_scrolls_back_without_gaps(db, dialog):
+    page = db.get_message_page(1, OWNER, limit=5)
+    assert [message['id'] for message in page] == dialog[-5:]
+
+    seen = list(page)
+    while page:
+        page = db.get_message_page(1, OWNER, before_id=page[0]['id'], limit=5)
+        seen = page + seen
+    assert [message['id'] for message in seen] == dialog
+    assert [message['text'] for message in seen] == [f'сообщение {i}' for i in range(12)]
+
+
+def test_message_page_after_id_returns_only_new(db, dialog):
+    assert [message['id'] for message in db.get_message_page(1, OWNER, after_id=dialog[8])] == dialog[9:]
+    assert [message['id'] for message in db.get_message_page(1, OWNER, after_id=dialog[2], limit=2)] == dialog[3:5]
+    assert db.get_message_page(1, OWNER, after_id=dialog[-1]) == []
+
+
+@pytest.fixture
+def client(default_db):
+    from werkzeug.security import generate_password_hash
+    from web.app import app
+
+    default_db.create_system_user('owner', generate_password_hash('secret'))
+    owner = default_db.get_system_user('owner')
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        with client.session_transaction() as session:
+            session['_user_id'] = str(owner['id'])
+        client.owner_id = owner['id']
+        yield client
+
+
+def test_messages_api_pages_and_revalidates(client, default_db):
+    for i in range(3):
+        default_db.add_message(1, f'сообщение {i}', True, client.owner_id)
+
+    response = client.get('/api/messages/1?limit=2')
+    data = response.get_json()
+    assert [message['text'] for message in data['messages']] == ['сообщение 1', 'сообщение 2']
+    assert data['has_more'] is True
+    assert default_db.get_thread(client.owner_id, 1)['unread_count'] == 0
+
+    # Диалог не менялся — 304 без тела
+    etag = response.headers['ETag']
+    assert client.get('/api/messages/1?limit=2', headers={'If-None-Match': etag}).status_code == 304
+
+    default_db.add_message(1, 'новое', True, client.owner_id)
+    response = client.get('/api/messages/1?limit=2', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.get_json()['messages'][-1]['text'] == 'новое'
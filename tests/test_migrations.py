@@ -0,0 +1,220 @@
+import calendar
+import os
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+from database import Database
+from migrations import MIGRATIONS, get_current_version, migrate
+
+# Схема до версионированных миграций (Database.init_database исходной версии)
+BASELINE_SCHEMA = '''
+    CREATE TABLE users (
+        id INTEGER PRIMARY KEY, username TEXT, first_name TEXT, last_name TEXT, full_name TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        last_message_text TEXT, last_message_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, text TEXT NOT NULL,
+        is_from_user BOOLEAN NOT NULL, timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP, bot_user_id INTEGER
+    );
+    CREATE TABLE settings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT UNIQUE NOT NULL, value TEXT,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE system_users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE NOT NULL, password_hash TEXT NOT NULL,
+        role TEXT DEFAULT 'user', full_name TEXT, email TEXT, account_expires TIMESTAMP, is_active BOOLEAN DEFAULT 1,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, last_login TIMESTAMP, created_by INTEGER
+    );
+    CREATE TABLE user_settings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL,
+        welcome_message TEXT DEFAULT 'Добро пожаловать! 👋', welcome_pdf_path TEXT DEFAULT '',
+        welcome_file_id TEXT DEFAULT '', welcome_file_caption TEXT DEFAULT '', bot_token TEXT DEFAULT '',
+        bot_username TEXT DEFAULT '', bot_name TEXT DEFAULT 'Мой бот', bot_description TEXT DEFAULT '',
+        start_command TEXT DEFAULT 'Добро пожаловать! Нажмите /help для справки.',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE campaigns (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, text TEXT, photo_file_id TEXT,
+        scheduled_at TIMESTAMP, status TEXT DEFAULT 'scheduled',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE delivery_logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, bot_user_id INTEGER NOT NULL,
+        campaign_id INTEGER, status TEXT NOT NULL, error TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX idx_messages_user_id ON messages(user_id);
+'''
+
+# isoformat (с 'T') писался в локальном времени, CURRENT_TIMESTAMP — в UTC
+LOCAL_TS = '2025-01-01T10:00:00'
+UTC_TS = '2025-01-01 12:30:00'
+
+
+def local_ms(value: str) -> int:
+    return int(datetime.fromisoformat(value).timestamp() * 1000)
+
+
+def utc_ms(value: str) -> int:
+    return calendar.timegm(datetime.fromisoformat(value).timetuple()) * 1000
+
+
+def make_baseline_db(path: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.executemany('INSERT INTO users (id, username) VALUES (?, ?)', [(1, 'alice'), (2, 'bob')])
+    conn.executemany(
+        'INSERT INTO messages (id, user_id, text, is_from_user, timestamp, bot_user_id) VALUES (?, ?, ?, ?, ?, ?)',
+        [
+            (1, 1, 'привет', 1, LOCAL_TS, 5),
+            (2, 1, 'ответ', 0, UTC_TS, 5),
+            (3, 2, 'здравствуйте', 1, UTC_TS, 5),
+        ],
+    )
+    conn.execute("INSERT INTO campaigns (id, user_id, text, status) VALUES (1, 5, 'рассылка', 'sent')")
+    conn.executemany(
+        'INSERT INTO delivery_logs (user_id, bot_user_id, campaign_id, status, error) VALUES (?, ?, ?, ?, ?)',
+        [
+            (1, 5, 1, 'success', None),
+            (2, 5, 1, 'failed', 'timeout'),
+            (2, 5, 1, 'success', None),  # повтор после ошибки
+            (3, 5, 1, 'failed', 'Forbidden'),
+        ],
+    )
+    conn.commit()
+    conn.close()
+
+
+def test_baseline_db_migrates_to_latest(db_path):
+    make_baseline_db(db_path)
+    db = Database(db_path)
+    conn = db._get_connection()
+
+    latest = max(version for version, _, _ in MIGRATIONS)
+    assert get_current_version(conn) == latest
+    versions = [row[0] for row in conn.execute('SELECT version FROM schema_version ORDER BY version')]
+    assert versions == sorted(version for version, _, _ in MIGRATIONS)
+    # Повторный запуск ничего не применяет
+    assert migrate(conn) == 0
+
+    # Данные старой схемы сохранены
+    assert conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0] == 3
+    assert conn.execute('SELECT COUNT(*) FROM delivery_logs').fetchone()[0] == 4
+
+
+def test_migration_versions_are_unique():
+    versions = [version for version, _, _ in MIGRATIONS]
+    assert len(versions) == len(set(versions))
+    assert sorted(versions) == list(range(1, len(versions) + 1))
+
+
+def test_fresh_db_has_latest_schema(db):
+    conn = db._get_connection()
+    assert get_current_version(conn) == max(version for version, _, _ in MIGRATIONS)
+
+
+def test_migrations_run_once_per_process(db, db_path, monkeypatch):
+    import database
+
+    def fail(conn):
+        raise AssertionError('миграции уже применены в этом процессе')
+
+    monkeypatch.setattr(database, 'migrate', fail)
+    Database(db_path)
+
+
+def test_failed_migration_rolls_back(db_path, monkeypatch):
+    make_baseline_db(db_path)
+
+    def broken(cursor):
+        cursor.execute('CREATE TABLE half_applied (id INTEGER)')
+        raise sqlite3.OperationalError('сбой миграции')
+
+    latest = max(version for version, _, _ in MIGRATIONS)
+    monkeypatch.setattr('migrations.MIGRATIONS', MIGRATIONS + [(latest + 1, 'broken', broken)])
+    conn = sqlite3.connect(db_path)
+    with pytest.raises(sqlite3.OperationalError):
+        migrate(conn)
+    assert get_current_version(conn) == 0
+    assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'half_applied'").fetchone() is None
+    conn.close()
+
+
+def test_subscribers_backfilled_from_history(db_path):
+    make_baseline_db(db_path)
+    db = Database(db_path)
+    conn = db._get_connection()
+
+    subscribers = {
+        row[0]: row[1:]
+        for row in conn.execute(
+            'SELECT user_id, first_seen, last_seen, last_message_id, message_count, status FROM bot_subscribers'
+        )
+    }
+    # last_seen — по входящим сообщениям подписчика, ответ бота его не сдвигает
+    assert subscribers[1] == (local_ms(LOCAL_TS), local_ms(LOCAL_TS), 2, 2, 'active')
+    assert subscribers[2] == (utc_ms(UTC_TS), utc_ms(UTC_TS), 3, 1, 'active')
+    assert [user['id'] for user in db.get_users_for_bot(5)] == [2, 1]
+    assert db.get_users_for_bot(5)[1]['last_message_text'] == 'ответ'
+
+
+def test_stale_scheduled_campaigns_leave_the_queue(db_path):
+    make_baseline_db(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO campaigns (id, user_id, text, scheduled_at, status) VALUES (2, 5, 'старая', NULL, 'scheduled')")
+    conn.execute("INSERT INTO campaigns (id, user_id, text, scheduled_at, status) "
+                 "VALUES (3, 5, 'старая', '2030-01-01 10:00:00', 'scheduled')")
+    conn.commit()
+    conn.close()
+
+    # Кампании старого планировщика админ-бота не уходят воркеру рассылок после обновления
+    db = Database(db_path)
+    assert [db.get_campaign(campaign_id)['status'] for campaign_id in (1, 2, 3)] == ['sent', 'stale', 'stale']
+    assert db.get_campaign(2)['run_at'] is None
+    assert db.claim_campaign('worker') is None
+    fresh = db.create_campaign(5, text='новая')
+    assert db.claim_campaign('worker')['id'] == fresh
+
+
+def test_threads_backfilled_from_history(db_path):
+    make_baseline_db(db_path)
+    db = Database(db_path)
+
+    threads = db.get_threads(5)
+    assert [(thread['id'], thread['last_message_text']) for thread in threads] == [(2, 'здравствуйте'), (1, 'ответ')]
+    assert db.get_thread(5, 1)['message_count'] == 2
+    assert db.get_thread(5, 2)['last_message_at'] == utc_ms(UTC_TS)
+
+
+def test_message_ts_backfilled_from_timestamp(db_path):
+    make_baseline_db(db_path)
+    db = Database(db_path)
+    conn = db._get_connection()
+
+    assert dict(conn.execute('SELECT id, ts FROM messages')) == {
+        1: local_ms(LOCAL_TS), 2: utc_ms(UTC_TS), 3: utc_ms(UTC_TS),
+    }
+    # Выборки диалога идут по idx_messages_thread, idx_messages_user_ts удалён миграцией 17
+    indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {'idx_messages_thread', 'idx_messages_direction_ts', 'idx_messages_ts'} <= indexes
+    assert 'idx_messages_user_ts' not in indexes
+
+    # Время последнего сообщения отдаётся из ts в локальном isoformat
+    reply_time = datetime.fromtimestamp(utc_ms(UTC_TS) / 1000).isoformat()
+    users = {user['id']: user for user in db.get_all_users()}
+    assert (users[1]['last_message_text'], users[1]['last_message_time']) == ('ответ', reply_time)
+    assert users[2]['last_message_text'] == 'здравствуйте'
+    assert db.get_users_for_bot(5)[1]['last_message_time'] == reply_time
+
+
+def test_campaign_deliveries_backfilled_from_logs(db_path):
+    make_baseline_db(db_path)
+    db = Database(db_path)
+
+    # Успешный повтор снимает ошибку получателя 2
+    summary = db.get_delivery_summary(1)
+    assert (summary['sent_count'], summary['failed_count']) == (2, 1)
+    assert (summary['delivered'], summary['failed']) == ([1, 2], [3])
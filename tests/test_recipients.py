@@ -0,0 +1,46 @@
+import asyncio
+from itertools import islice
+
+from database import AsyncDatabase
+
+
+def test_recipients_stream_in_batches(db, bot_owner, monkeypatch):
+    db.deactivate_subscribers(bot_owner, [(user_id, 'Forbidden') for user_id in (3, 50, 100)])
+    db.add_user(1, 'user1', 'Имя', 'Фамилия', bot_user_id=7)
+    active = [user_id for user_id in range(1, 101) if user_id not in (3, 50, 100)]
+
+    batches = []
+    get_recipient_batch = db.get_recipient_batch
+
+    def counting_batch(*args):
+        batches.append(get_recipient_batch(*args))
+        return batches[-1]
+
+    monkeypatch.setattr(db, 'get_recipient_batch', counting_batch)
+
+    # Пачки читаются по мере потребления, а не все сразу
+    recipients = db.iter_recipient_ids(bot_owner, batch=10)
+    assert list(islice(recipients, 15)) == active[:15]
+    assert len(batches) == 2
+
+    assert list(recipients) == active[15:]
+    assert [len(batch) for batch in batches] == [10] * 9 + [7]
+
+
+def test_recipients_resume_after_cursor(db, bot_owner):
+    assert db.get_recipient_batch(bot_owner, after_id=95, limit=10) == [96, 97, 98, 99, 100]
+    # Прерванная рассылка продолжается с последнего выданного id
+    assert list(db.iter_recipient_ids(bot_owner, after_id=90, batch=5)) == list(range(91, 101))
+    assert list(db.iter_recipient_ids(bot_owner, after_id=100)) == []
+    assert list(db.iter_recipient_ids(6)) == []
+
+
+def test_async_recipients_match_sync(db, db_path, bot_owner):
+    adb = AsyncDatabase(db_path)
+
+    async def collect(**kwargs):
+        return [chat_id async for chat_id in adb.iter_recipient_ids(bot_owner, **kwargs)]
+
+    assert asyncio.run(collect(batch=7)) == list(db.iter_recipient_ids(bot_owner, batch=7)) == list(range(1, 101))
+    # Пачка ровно по границе: последний запрос возвращает пустой список
+    assert asyncio.run(collect(after_id=80, batch=10)) == list(range(81, 101))
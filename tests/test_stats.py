@@ -0,0 +1,87 @@
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+
+def rollup(db, bot_user_id):
+    conn = db._get_connection()
+    return conn.execute('''
+        SELECT COALESCE(SUM(messages_in), 0), COALESCE(SUM(messages_out), 0), COALESCE(SUM(new_subscribers), 0)
+        FROM bot_stats_rollup WHERE bot_user_id = ?
+    ''', (bot_user_id,)).fetchone()
+
+
+def test_outbound_message_does_not_create_subscriber(db):
+    db.add_message(1, 'сообщение от администратора', False, 5)
+
+    assert db.get_total_subscribers_count(5) == 0
+    assert rollup(db, 5) == (0, 1, 0)
+
+    db.add_message(1, 'ответ подписчика', True, 5)
+    db.add_message(1, 'ещё одно', True, 5)
+    assert db.get_total_subscribers_count(5) == 1
+    assert rollup(db, 5) == (2, 1, 1)
+
+
+def test_outbound_message_updates_existing_subscriber(db):
+    db.add_message(1, 'привет', True, 5)
+    db.add_message(1, 'ответ', False, 5)
+
+    conn = db._get_connection()
+    last_message_id, message_count = conn.execute(
+        'SELECT last_message_id, message_count FROM bot_subscribers WHERE bot_user_id = 5 AND user_id = 1'
+    ).fetchone()
+    assert (last_message_id, message_count) == (2, 2)
+    assert rollup(db, 5) == (1, 1, 1)
+
+
+def test_bot_stats_window(db, bot_owner):
+    db.add_message(1, 'привет', True, bot_owner)
+    db.add_message(2, 'привет', True, bot_owner)
+    db.add_message(1, 'ответ', False, bot_owner)
+
+    stats = db.get_bot_stats(bot_owner, datetime.now() - timedelta(hours=24))
+    assert stats == {
+        'messages_in': 2,
+        'messages_out': 1,
+        'messages': 3,
+        'new_subscribers': 100,
+        'active_subscribers': 100,
+    }
+    assert db.get_bot_stats(bot_owner, datetime.now() + timedelta(minutes=1))['messages'] == 0
+
+
+@pytest.mark.skipif(sqlite3.sqlite_version_info < (3, 35, 0), reason='DROP COLUMN появился в SQLite 3.35')
+def test_rollup_has_no_active_users_column(db):
+    columns = {row[1] for row in db._get_connection().execute('PRAGMA table_info(bot_stats_rollup)')}
+    assert 'active_users' not in columns
+
+
+def test_dashboard_metrics_match_direct_counts(db):
+    hour, day = 3600000, 86400000
+    now = 1_700_000_000_000 // hour * hour + 25 * 60000  # середина часа: окна начинаются с неполного часа
+    offsets = [5 * 60000, 3 * hour, day - 10 * 60000, day + 10 * 60000, 3 * day, 7 * day - 60000, 8 * day, 31 * day]
+    # Подписчик i впервые пишет за offsets[i] до now, каждый второй получает ответ
+    messages = []
+    for user_id, offset in enumerate(sorted(offsets, reverse=True), start=1):
+        messages.append((user_id, 'вопрос', True, 5, now - offset))
+        if user_id % 2 == 0:
+            messages.append((user_id, 'ответ', False, 5, now - offset + 1))
+    messages.append((1, 'другой бот', True, 7, now - 60000))
+    db.ingest_batch([], messages)
+    db.deactivate_subscribers(5, [(1, 'Forbidden')])
+
+    metrics = db.get_dashboard_metrics(5, now=now)
+    assert (metrics['total_subscribers'], metrics['inactive_subscribers']) == (len(offsets), 1)
+    for key, length in db.METRIC_WINDOWS:
+        window = [m for m in messages if m[3] == 5 and m[4] >= now - length]
+        messages_in = sum(1 for m in window if m[2])
+        assert metrics[key] == {
+            'new_subscribers': messages_in,
+            'active_subscribers': messages_in,
+            'messages_in': messages_in,
+            'messages_out': len(window) - messages_in,
+            'messages': len(window),
+        }, key
+    assert metrics['24h']['messages_in'] == 3
@@ -0,0 +1,93 @@
+import asyncio
+import json
+import socket
+
+from config import Config
+from web.stream import QUEUE_SIZE, DialogStreamServer, stream_token
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def connect(server, token):
+    """Открыть поток и прочитать заголовки, возвращает (код ответа, reader, writer)"""
+    reader, writer = await asyncio.open_connection(server.host, server.port)
+    writer.write(f'GET {Config.STREAM_URL}?token={token} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode())
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    while (await reader.readline()) not in (b'\r\n', b''):
+        pass
+    return status, reader, writer
+
+
+async def read_event(reader):
+    """Следующее событие потока (пропуская retry и пинги)"""
+    while True:
+        lines = []
+        while (line := await asyncio.wait_for(reader.readline(), 5)) != b'\n':
+            lines.append(line.decode().rstrip('\n'))
+        fields = dict(line.split(': ', 1) for line in lines if line.startswith(('event:', 'data:')))
+        if 'event' in fields:
+            return fields['event'], json.loads(fields['data'])
+
+
+def test_stream_delivers_only_own_bot_messages(default_db):
+    server = DialogStreamServer('127.0.0.1', free_port(), poll_ms=10)
+
+    async def run():
+        await server.start()
+        try:
+            status, reader, writer = await connect(server, stream_token(5))
+            # Подключение до первого чтения: диспетчер начинает с текущего конца messages
+            await asyncio.sleep(0.2)
+            default_db.add_message(1, 'чужому боту', True, 7)
+            default_db.add_message(1, 'привет', True, 5)
+            event = await read_event(reader)
+            writer.close()
+            return status, event
+        finally:
+            await server.stop()
+
+    status, (name, data) = asyncio.run(run())
+    assert status == 200
+    assert name == 'message'
+    assert (data['bot_user_id'], data['user_id'], data['text'], data['is_from_user']) == (5, 1, 'привет', True)
+    assert server.subscribers == {}
+
+
+def test_stream_rejects_bad_token(default_db):
+    server = DialogStreamServer('127.0.0.1', free_port(), poll_ms=10)
+
+    async def run():
+        await server.start()
+        try:
+            statuses = []
+            for token in ('', 'подделка', stream_token(5) + 'x'):
+                status, _, writer = await connect(server, token)
+                writer.close()
+                statuses.append(status)
+            return statuses
+        finally:
+            await server.stop()
+
+    assert asyncio.run(run()) == [403, 403, 403]
+
+
+def test_slow_tab_gets_resync(default_db):
+    server = DialogStreamServer('127.0.0.1', free_port())
+
+    async def run():
+        slow, fast = asyncio.Queue(maxsize=QUEUE_SIZE), asyncio.Queue(maxsize=QUEUE_SIZE * 2)
+        server.subscribers[5] = {slow, fast}
+        for message_id in range(QUEUE_SIZE + 1):
+            server.publish(5, {'type': 'message', 'id': message_id})
+        server.publish(7, {'type': 'message', 'id': -1})
+        return [slow.get_nowait() for _ in range(slow.qsize())], fast.qsize()
+
+    slow_events, fast_size = asyncio.run(run())
+    # Переполненная очередь сбрасывается: вкладка перезагрузит открытый диалог
+    assert slow_events == [{'type': 'resync'}]
+    assert fast_size == QUEUE_SIZE + 1
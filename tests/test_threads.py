@@ -0,0 +1,45 @@
+def test_thread_tracks_last_message_and_unread(db):
+    db.add_user(1, 'alice', 'Алиса', '', bot_user_id=5)
+    thread = db.get_thread(5, 1)
+    assert (thread['last_message_id'], thread['unread_count'], thread['message_count']) == (None, 0, 0)
+
+    db.add_message(1, 'первое', True, 5)
+    db.add_message(1, 'второе', True, 5)
+    thread = db.get_thread(5, 1)
+    assert (thread['last_message_id'], thread['unread_count'], thread['message_count']) == (2, 2, 2)
+
+    # Ответ администратора означает, что диалог прочитан
+    db.add_message(1, 'ответ', False, 5)
+    thread = db.get_thread(5, 1)
+    assert (thread['last_message_id'], thread['unread_count'], thread['message_count']) == (3, 0, 3)
+
+    db.add_message(1, 'ещё вопрос', True, 5)
+    db.mark_thread_read(5, 1)
+    assert db.get_thread(5, 1)['unread_count'] == 0
+    assert db.get_threads(5)[0]['last_message_text'] == 'ещё вопрос'
+
+
+def test_threads_are_per_bot(db):
+    db.add_message(1, 'боту 5', True, 5)
+    db.add_message(1, 'боту 7', True, 7)
+    assert [thread['last_message_text'] for thread in db.get_threads(5)] == ['боту 5']
+    assert [thread['last_message_text'] for thread in db.get_threads(7)] == ['боту 7']
+
+
+def test_threads_keyset_pages_cover_every_dialog_once(db):
+    now = 1_700_000_000_000
+    # Несколько диалогов с одинаковым временем: порядок и курсор добиваются user_id
+    messages = [(user_id, f'сообщение {user_id}', True, 5, now + user_id // 3) for user_id in range(1, 26)]
+    db.ingest_batch([], messages)
+
+    pages, before = [], None
+    while True:
+        page = db.get_threads(5, limit=7, before=before)
+        if not page:
+            break
+        pages.append([thread['id'] for thread in page])
+        before = (page[-1]['last_message_at'], page[-1]['id'])
+
+    seen = [user_id for page in pages for user_id in page]
+    assert [len(page) for page in pages] == [7, 7, 7, 4]
+    assert seen == sorted(range(1, 26), key=lambda user_id: (user_id // 3, user_id), reverse=True)
@@ -0,0 +1,129 @@
+import asyncio
+import threading
+
+import pytest
+
+from bot.user_bot_manager import UserBot, UserBotManager
+
+
+@pytest.fixture
+def bot_loop():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, name='bot-loop', daemon=True)
+    thread.start()
+    yield loop
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(timeout=5)
+    loop.close()
+
+
+def on_loop(loop, func):
+    """Выполнить func на цикле бота и вернуть результат (заодно дождаться ранее переданных туда вызовов)"""
+    async def call():
+        return func()
+    return asyncio.run_coroutine_threadsafe(call(), loop).result(timeout=5)
+
+
+def running_bot(db, owner_id, loop) -> UserBot:
+    """Бот, работающий на цикле loop (без Application: обработчики читают только кэш настроек)"""
+    user_bot = UserBot(owner_id, '123:abc', 'test_bot', 'старое приветствие', '/start',
+                       settings=db.get_user_settings(owner_id))
+    user_bot.loop = loop
+    user_bot.is_running = True
+    user_bot.is_starting = False
+    return user_bot
+
+
+def test_settings_cache_changes_on_the_bot_loop(default_db, bot_owner, bot_loop, tmp_path):
+    user_bot = running_bot(default_db, bot_owner, bot_loop)
+    document = tmp_path / 'welcome.pdf'
+    document.write_bytes(b'%PDF')
+    applied_on = []
+    set_settings = user_bot._set_settings
+
+    def record(settings, welcome_document):
+        applied_on.append(threading.current_thread().name)
+        set_settings(settings, welcome_document)
+
+    user_bot._set_settings = record
+    default_db.update_user_welcome_message(bot_owner, 'новое приветствие')
+    default_db.update_user_welcome_pdf(bot_owner, str(document))
+    settings = default_db.get_user_settings(bot_owner)
+
+    # Файл хэшируется в вызывающем потоке, кэш бота меняется на его цикле
+    user_bot.apply_settings(settings)
+    welcome = on_loop(bot_loop, lambda: (user_bot.welcome_message, user_bot.welcome_document))
+    assert applied_on == ['bot-loop']
+    assert welcome[0] == 'новое приветствие'
+    assert welcome[1].file_path == str(document)
+    assert user_bot.settings_version == settings['settings_version']
+
+
+def test_refresh_settings_applies_only_changed_versions(default_db, bot_owner, bot_loop):
+    manager = UserBotManager(loops=1)
+    user_bot = running_bot(default_db, bot_owner, bot_loop)
+    manager.user_bots[bot_owner] = user_bot
+
+    assert manager.refresh_settings() == 0
+
+    default_db.update_user_welcome_message(bot_owner, 'обновлено в веб-панели')
+    assert manager.refresh_settings() == 1
+    assert on_loop(bot_loop, lambda: user_bot.welcome_message) == 'обновлено в веб-панели'
+    assert manager.refresh_settings() == 0
+
+
+def test_starting_bot_is_not_restarted_by_settings_refresh(default_db, bot_owner, monkeypatch):
+    manager = UserBotManager(loops=1)
+    # Бот только что добавлен сверкой с БД: настроек ещё нет (settings_version = -1), start() не завершился
+    user_bot = UserBot(bot_owner, '123:abc', 'test_bot', 'приветствие', '/start')
+    manager.user_bots[bot_owner] = user_bot
+    restarts = []
+    monkeypatch.setattr(manager, 'add_bot', lambda *args, **kwargs: restarts.append(args) or True)
+
+    assert manager.refresh_settings() == 1
+    assert restarts == []
+    assert user_bot.settings_version == default_db.get_user_settings(bot_owner)['settings_version']
+    assert manager.refresh_settings() == 0
+
+    # Смена токена перезапускает бота и во время запуска
+    default_db.update_user_bot_token(bot_owner, '456:def', 'other_bot')
+    assert manager.refresh_settings() == 1
+    assert restarts[0][:2] == (bot_owner, '456:def')
+
+
+def test_reconfigure_keeps_running_bot_with_same_token(default_db, bot_owner, bot_loop, monkeypatch):
+    manager = UserBotManager(loops=1)
+    user_bot = running_bot(default_db, bot_owner, bot_loop)
+    manager.user_bots[bot_owner] = user_bot
+    restarts = []
+    monkeypatch.setattr(manager, 'add_bot', lambda *args, **kwargs: restarts.append(args) or True)
+
+    default_db.update_user_welcome_message(bot_owner, 'без перезапуска')
+    assert manager.reload_bot(bot_owner)
+    assert restarts == []
+    assert on_loop(bot_loop, lambda: user_bot.welcome_message) == 'без перезапуска'
+
+    user_bot.start_failed = True
+    assert manager.reload_bot(bot_owner)
+    assert len(restarts) == 1
+
+
+def test_bots_share_a_fixed_number_of_event_loops():
+    manager = UserBotManager(loops=2)
+
+    async def current_loop():
+        await asyncio.sleep(0)
+        return threading.current_thread().name, asyncio.get_running_loop()
+
+    try:
+        placements = {
+            user_id: manager.run_coroutine(user_id, current_loop()).result(timeout=5)
+            for user_id in range(1, 9)
+        }
+        # Бот всегда работает на одном и том же цикле, все боты — на двух потоках
+        assert {name for name, _ in placements.values()} == {'user-bots-loop-0', 'user-bots-loop-1'}
+        assert manager.run_coroutine(3, current_loop()).result(timeout=5) == placements[3]
+        assert placements[2] == placements[4] and placements[1] != placements[2]
+    finally:
+        for loop_thread in manager._loops:
+            loop_thread.loop.call_soon_threadsafe(loop_thread.loop.stop)
@@ -0,0 +1,135 @@
+import asyncio
+import json
+import socket
+import threading
+
+import pytest
+
+from bot.webhook_server import WebhookServer, webhook_path, webhook_secret
+
+
+class FakeUserBot:
+    """UserBot для маршрутизации: очередь обновлений на своём event loop"""
+
+    def __init__(self, bot_token, loop=None, capacity=10):
+        self.bot_token = bot_token
+        self.loop = loop
+        self.capacity = capacity
+        self.updates = []
+        self.loops = []
+
+    async def enqueue_update(self, data):
+        self.loops.append(asyncio.get_running_loop())
+        if len(self.updates) >= self.capacity:
+            return False
+        self.updates.append(data)
+        return True
+
+
+class FakeManager:
+    def __init__(self, *bots):
+        self.bots = {bot.bot_token.split(':', 1)[0]: bot for bot in bots}
+
+    def get_bot_by_telegram_id(self, bot_id):
+        return self.bots.get(bot_id)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def post(reader, writer, path, body=b'{}', headers=None, method='POST'):
+    """Один запрос на открытом keep-alive соединении, возвращает код ответа"""
+    lines = [f'{method} {path} HTTP/1.1', 'Host: localhost', f'Content-Length: {len(body)}']
+    lines += [f'{name}: {value}' for name, value in (headers or {}).items()]
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+    await writer.drain()
+    status_line = await reader.readline()
+    while (await reader.readline()) not in (b'\r\n', b''):
+        pass
+    return int(status_line.split()[1])
+
+
+@pytest.fixture
+def bot_loop():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield loop
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(timeout=5)
+    loop.close()
+
+
+def test_routes_updates_to_the_right_bot(bot_loop):
+    first = FakeUserBot('111:aaa')
+    second = FakeUserBot('222:bbb', loop=bot_loop)
+    server = WebhookServer(FakeManager(first, second), '127.0.0.1', free_port())
+
+    async def run():
+        first.loop = asyncio.get_running_loop()
+        await server.start()
+        reader, writer = await asyncio.open_connection(server.host, server.port)
+        try:
+            statuses = [
+                await post(reader, writer, webhook_path(first.bot_token), json.dumps({'update_id': 1}).encode()),
+                # Бот на другом event loop: обновление передаётся в его цикл
+                await post(reader, writer, webhook_path(second.bot_token), json.dumps({'update_id': 2}).encode(),
+                           {'X-Telegram-Bot-Api-Secret-Token': webhook_secret(second.bot_token)}),
+            ]
+        finally:
+            writer.close()
+            await server.stop()
+        return statuses
+
+    assert asyncio.run(run()) == [200, 200]
+    assert first.updates == [{'update_id': 1}]
+    assert second.updates == [{'update_id': 2}]
+    assert second.loops == [bot_loop]
+
+
+def test_rejects_bad_requests():
+    user_bot = FakeUserBot('111:aaa', capacity=1)
+    other_secret = webhook_secret('111:other')
+    server = WebhookServer(FakeManager(user_bot), '127.0.0.1', free_port())
+    path = webhook_path(user_bot.bot_token)
+
+    async def run():
+        user_bot.loop = asyncio.get_running_loop()
+        await server.start()
+        reader, writer = await asyncio.open_connection(server.host, server.port)
+        try:
+            return [
+                await post(reader, writer, path, method='GET'),
+                await post(reader, writer, '/tg/999/' + webhook_secret('999:x')),
+                await post(reader, writer, f'/tg/111/{other_secret}'),
+                await post(reader, writer, path, headers={'X-Telegram-Bot-Api-Secret-Token': other_secret}),
+                await post(reader, writer, path, b'not json'),
+                await post(reader, writer, path),
+                # Очередь бота заполнена: 503, Telegram повторит доставку
+                await post(reader, writer, path),
+            ]
+        finally:
+            writer.close()
+            await server.stop()
+
+    assert asyncio.run(run()) == [405, 404, 404, 403, 400, 200, 503]
+    assert user_bot.updates == [{}]
+
+
+def test_bot_without_loop_is_unavailable():
+    user_bot = FakeUserBot('111:aaa')
+    server = WebhookServer(FakeManager(user_bot), '127.0.0.1', free_port())
+
+    async def run():
+        await server.start()
+        reader, writer = await asyncio.open_connection(server.host, server.port)
+        try:
+            return await post(reader, writer, webhook_path(user_bot.bot_token))
+        finally:
+            writer.close()
+            await server.stop()
+
+    assert asyncio.run(run()) == 503
@@ -109,11 +109,12 @@ def rate_limit(max_attempts=5, window=300):
         return decorated_function
     return decorator
 
-# Инициализация менеджера ботов
-try:
-    from bot.user_bot_manager import bot_manager
-except ImportError:
-    bot_manager = None
+def get_user_bot_token(user_id) -> str:
+    """Токен бота пользователя из настроек. Сами боты работают в отдельном процессе,
+    управление ими идёт через bot.control.send_command"""
+    from database import Database
+    settings = Database().get_user_settings(user_id)
+    return (settings or {}).get('bot_token') or ''
 
 class User(UserMixin):
     def __init__(self, id, username, role='user'):
@@ -148,32 +149,18 @@ def load_user(user_id):
 @login_required
 def dashboard():
     try:
-        from bot.user_bot_manager import bot_manager
         from database import Database
-        from datetime import datetime, timedelta
-        
-        # Получаем статистику для текущего пользователя
-        db = Database()
-        
-        # Количество активных подписчиков (кто писал за последние 30 дней)
-        thirty_days_ago = (datetime.now() - timedelta(days=30)).isoformat()
-        active_subscribers = db.get_active_subscribers_count(current_user.id, thirty_days_ago)
         
-        # Количество новых подписчиков за последние 24 часа
-        yesterday = (datetime.now() - timedelta(days=1)).isoformat()
-        new_subscribers_24h = db.get_new_subscribers_count(current_user.id, yesterday)
-        
-        # Общее количество подписчиков
-        total_subscribers = db.get_total_subscribers_count(current_user.id)
-        
-        # Количество сообщений за последние 24 часа
-        messages_24h = db.get_messages_count_24h(current_user.id, yesterday)
+        # Все показатели текущего пользователя одним запросом
+        metrics = Database().get_dashboard_metrics(current_user.id)
         
         stats = {
-            'active_subscribers': active_subscribers,
-            'new_subscribers_24h': new_subscribers_24h,
-            'total_subscribers': total_subscribers,
-            'messages_24h': messages_24h
+            # Активные подписчики (кто писал за последние 30 дней)
+            'active_subscribers': metrics['30d']['active_subscribers'],
+            'new_subscribers_24h': metrics['24h']['new_subscribers'],
+            'total_subscribers': metrics['total_subscribers'],
+            'inactive_subscribers': metrics['inactive_subscribers'],
+            'messages_24h': metrics['24h']['messages']
         }
         
         return render_template('dashboard.html', stats=stats)
@@ -183,6 +170,7 @@ def dashboard():
             'active_subscribers': 0,
             'new_subscribers_24h': 0,
             'total_subscribers': 0,
+            'inactive_subscribers': 0,
             'messages_24h': 0
         })
 
@@ -216,55 +204,16 @@ def broadcast():
         message = request.form.get('message')
         if message:
             try:
-                # Используем новую систему с bot_manager
-                from bot.user_bot_manager import bot_manager
-                user_bot = bot_manager.get_bot(current_user.id)
-                
-                if not user_bot:
+                if not get_user_bot_token(current_user.id):
                     flash('Ваш бот не настроен или не запущен', 'error')
                     return redirect(url_for('broadcast'))
                 
-                # Отправляем рассылку через бота пользователя (синхронно)
-                import requests
+                # Ставим рассылку в очередь, отправляет её воркер рассылок
                 from database import Database
                 
                 db = Database()
-                users = db.get_users_for_bot(current_user.id)
-                
-                success_count = 0
-                failed_count = 0
-                
-                bot_token = user_bot.bot_token
-                url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-                
-                for user in users:
-                    user_id = user['id']
-                    try:
-                        data = {
-                            'chat_id': user_id,
-                            'text': message,
-                            'parse_mode': 'HTML'
-                        }
-                        
-                        response = requests.post(url, json=data, timeout=30)
-                        
-                        if response.status_code == 200:
-                            result = response.json()
-                            if result.get('ok'):
-                                success_count += 1
-                            else:
-                                failed_count += 1
-                        else:
-                            failed_count += 1
-                            
-                    except Exception as e:
-                        print(f"Ошибка отправки пользователю {user_id}: {e}")
-                        failed_count += 1
-                
-                if success_count > 0:
-                    flash(f'Сообщение отправлено {success_count} подписчикам!', 'success')
-                if failed_count > 0:
-                    flash(f'Ошибка отправки {failed_count} подписчикам', 'error')
+                job_id = db.create_campaign(current_user.id, text=message, parse_mode='HTML')
+                flash(f'Рассылка #{job_id} поставлена в очередь', 'success')
                     
             except Exception as e:
                 print(f"Общая ошибка рассылки: {e}")
@@ -369,10 +318,7 @@ def settings():
 @login_required
 def subscribers():
     try:
-        from bot.user_bot_manager import bot_manager
-        user_bot = bot_manager.get_bot(current_user.id)
-        
-        if not user_bot:
+        if not get_user_bot_token(current_user.id):
             flash('Ваш бот не настроен или не запущен', 'error')
             return redirect(url_for('dashboard'))
         
@@ -397,54 +343,19 @@ def send_broadcast():
     
     try:
         # Отправляем сообщение через бота текущего пользователя
-        from bot.user_bot_manager import bot_manager
-        user_bot = bot_manager.get_bot(current_user.id)
-        
-        if not user_bot:
+        if not get_user_bot_token(current_user.id):
             return jsonify({'error': 'Ваш бот не настроен или не запущен'}), 500
         
-        # Отправляем рассылку через бота пользователя (синхронно)
-        import requests
+        # Ставим рассылку в очередь, отправляет её воркер рассылок
         from database import Database
         
         db = Database()
-        users = db.get_users_for_bot(current_user.id)
-        
-        success_count = 0
-        failed_count = 0
-        
-        bot_token = user_bot.bot_token
-        url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-        
-        for user in users:
-            user_id = user['id']
-            try:
-                data = {
-                    'chat_id': user_id,
-                    'text': message,
-                    'parse_mode': 'HTML'
-                }
-                
-                response = requests.post(url, json=data, timeout=30)
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    if result.get('ok'):
-                        success_count += 1
-                    else:
-                        failed_count += 1
-                else:
-                    failed_count += 1
-                    
-            except Exception as e:
-                print(f"Ошибка отправки пользователю {user_id}: {e}")
-                failed_count += 1
+        job_id = db.create_campaign(current_user.id, text=message, parse_mode='HTML')
         
         return jsonify({
             'success': True,
-            'message': f'Сообщение отправлено {success_count} подписчикам',
-            'success_count': success_count,
-            'failed_count': failed_count
+            'message': f'Рассылка #{job_id} поставлена в очередь',
+            'job_id': job_id
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -470,25 +381,31 @@ def users():
 def dialogs():
     """Страница диалогов с пользователями"""
     try:
-        from bot.user_bot_manager import bot_manager
         from database import Database
         
         # Проверяем, настроен ли бот у текущего пользователя
-        user_bot = bot_manager.get_bot(current_user.id)
-        if not user_bot:
+        if not get_user_bot_token(current_user.id):
             flash('Ваш бот не настроен. Сначала настройте бота в разделе "Настройки"', 'info')
             return redirect(url_for('settings'))
         
-        # Получаем только пользователей, которые общались с ботом текущего пользователя
-        db = Database()
-        users = db.get_users_for_bot(current_user.id)
-        
-        # Добавляем время последнего сообщения
-        for user in users:
-            last_message = db.get_last_message_for_user(user['id'], current_user.id)
-            user['last_message_time'] = last_message['timestamp'] if last_message else None
+        # Диалоги бота текущего пользователя страницами по Config.DIALOGS_PAGE_SIZE (курсор ?before=<ms>:<user_id>)
+        before = None
+        if request.args.get('before'):
+            try:
+                before_at, before_user = request.args['before'].split(':', 1)
+                before = (int(before_at), int(before_user))
+            except ValueError:
+                before = None
         
-        return render_template('dialogs.html', users=users)
+        db = Database()
+        users = db.get_threads(current_user.id, Config.DIALOGS_PAGE_SIZE, before)
+        next_cursor = None
+        if len(users) == Config.DIALOGS_PAGE_SIZE:
+            next_cursor = f"{users[-1]['last_message_at']}:{users[-1]['id']}"
+        
+        from web.stream import stream_url
+        return render_template('dialogs.html', users=users, next_cursor=next_cursor,
+                               stream_url=stream_url(current_user.id))
     except Exception as e:
         flash(f'Ошибка загрузки диалогов: {e}', 'error')
         return redirect(url_for('dashboard'))
@@ -496,39 +413,39 @@ def dialogs():
 @app.route('/api/messages/<int:user_id>')
 @login_required
 def get_messages(user_id):
-    """Получение сообщений для конкретного пользователя"""
+    """История диалога страницами: ?before_id= — более старые сообщения, ?after_id= — новые с момента
+    последнего опроса, ?limit= — размер страницы. Неизменившийся диалог отвечает 304 по ETag."""
+    import logging
+    logger = logging.getLogger(__name__)
     try:
         from database import Database
-        import logging
-        logger = logging.getLogger(__name__)
         
-        logger.info(f"Запрашиваем сообщения для пользователя {user_id}, bot_user_id={current_user.id}")
+        before_id = request.args.get('before_id', type=int)
+        after_id = request.args.get('after_id', type=int)
+        limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
         
-        # Получаем сообщения только для бота текущего пользователя
+        # ETag по строке диалога: новое сообщение меняет last_message_id и message_count
         db = Database()
-        messages = db.get_messages_between_users(user_id, current_user.id)
-        logger.info(f"Получено {len(messages)} сообщений для пользователя {user_id} с ботом {current_user.id}")
+        thread = db.get_thread(current_user.id, user_id) or {}
+        etag = (f"{thread.get('last_message_id')}-{thread.get('message_count', 0)}-"
+                f"{before_id}-{after_id}-{limit}")
+        if request.if_none_match.contains(etag):
+            return '', 304, {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
         
-        # Логируем в файл
-        with open('/tmp/debug.log', 'a') as f:
-            f.write(f"🔍 DEBUG: API get_messages: user_id={user_id}, bot_user_id={current_user.id}, messages_count={len(messages)}\n")
+        # Получаем сообщения только для бота текущего пользователя
+        messages = db.get_message_page(user_id, current_user.id, before_id, after_id, limit)
+        if thread.get('unread_count'):
+            db.mark_thread_read(current_user.id, user_id)
         
-        # Форматируем сообщения для фронтенда
-        formatted_messages = []
-        for msg in messages:
-            try:
-                formatted_messages.append({
-                    'id': msg['id'],
-                    'text': msg['text'],
-                    'timestamp': msg['timestamp'],
-                    'is_from_user': msg['is_from_user']
-                })
-            except KeyError as key_error:
-                logger.error(f"Ошибка форматирования сообщения: {key_error}, сообщение: {msg}")
-                continue
-        
-        logger.info(f"Отправляем {len(formatted_messages)} отформатированных сообщений")
-        return jsonify({'success': True, 'messages': formatted_messages})
+        response = jsonify({
+            'success': True,
+            'messages': messages,
+            # Есть ли ещё более старые сообщения (для прокрутки вверх)
+            'has_more': after_id is None and len(messages) == limit,
+        })
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
     except Exception as e:
         logger.error(f"Ошибка получения сообщений для пользователя {user_id}: {e}")
         return jsonify({'success': False, 'error': str(e)})
@@ -537,6 +454,8 @@ def get_messages(user_id):
 @login_required
 def send_message():
     """Отправка сообщения пользователю"""
+    import logging
+    logger = logging.getLogger(__name__)
     try:
         data = request.get_json()
         user_id = data.get('user_id')
@@ -545,45 +464,28 @@ def send_message():
         if not user_id or not message:
             return jsonify({'success': False, 'error': 'Неверные параметры'})
         
-        from bot.user_bot_manager import bot_manager
-        
-        # Получаем бота текущего пользователя
-        user_bot = bot_manager.get_bot(current_user.id)
-        if not user_bot:
+        # Получаем токен бота текущего пользователя
+        bot_token = get_user_bot_token(current_user.id)
+        if not bot_token:
             return jsonify({'success': False, 'error': 'Ваш бот не настроен'})
         
         # Отправляем сообщение через бота пользователя (синхронно)
         try:
-            import requests
+            from bot.bot_api import get_client
             
-            # Используем прямой HTTP API вместо асинхронного кода
-            bot_token = user_bot.bot_token
-            url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-            data = {
-                'chat_id': user_id,
-                'text': message,
-                'parse_mode': 'HTML'
-            }
+            # Синхронный клиент Bot API с keep-alive соединениями на токен бота
+            result = get_client(bot_token).send_message(user_id, message, parse_mode='HTML')
             
-            response = requests.post(url, json=data, timeout=30)
-            
-            if response.status_code == 200:
-                result = response.json()
-                if result.get('ok'):
-                    # Сохраняем сообщение в базу данных
-                    from database import Database
-                    db = Database()
-                    # Логируем в файл
-                    with open('/tmp/debug.log', 'a') as f:
-                        f.write(f"🔍 DEBUG: Отправляем сообщение в базу: user_id={user_id}, message='{message[:50]}...', bot_id={current_user.id}\n")
-                    success = db.add_message(user_id, message, False, current_user.id)  # False = от бота
-                    with open('/tmp/debug.log', 'a') as f:
-                        f.write(f"🔍 DEBUG: Результат сохранения в базу: {success}\n")
-                    return jsonify({'success': True})
-                else:
-                    return jsonify({'success': False, 'error': f'Telegram API ошибка: {result}'})
+            if result.get('ok'):
+                # Сохраняем сообщение в базу данных
+                from database import Database
+                db = Database()
+                if not db.add_message(user_id, message, False, current_user.id):  # False = от бота
+                    logger.warning(f"⚠️ Сообщение пользователю {user_id} отправлено, но не сохранено в истории "
+                                   f"(бот {current_user.id})")
+                return jsonify({'success': True})
             else:
-                return jsonify({'success': False, 'error': f'HTTP ошибка {response.status_code}'})
+                return jsonify({'success': False, 'error': f'Telegram API ошибка: {result}'})
                 
         except Exception as e:
             return jsonify({'success': False, 'error': f'Ошибка отправки: {str(e)}'})
@@ -603,11 +505,9 @@ def send_file():
         if not user_id or not file:
             return jsonify({'success': False, 'error': 'Неверные параметры'})
         
-        from bot.user_bot_manager import bot_manager
-        
-        # Получаем бота текущего пользователя
-        user_bot = bot_manager.get_bot(current_user.id)
-        if not user_bot:
+        # Получаем токен бота текущего пользователя
+        bot_token = get_user_bot_token(current_user.id)
+        if not bot_token:
             return jsonify({'success': False, 'error': 'Ваш бот не настроен'})
         
         # Сохраняем файл временно
@@ -618,31 +518,15 @@ def send_file():
             temp_path = tmp_file.name
         
         try:
-            # Отправляем файл через бота пользователя (синхронно)
-            import requests
+            # Отправляем файл через бота пользователя (синхронно); повторная отправка того же файла идёт по file_id
+            from bot.file_cache import FileIdCache
             
-            bot_token = user_bot.bot_token
-            url = f"https://api.telegram.org/bot{bot_token}/sendDocument"
+            result = FileIdCache(bot_token, temp_path).post(bot_token, user_id, file.filename, caption)
             
-            with open(temp_path, 'rb') as file:
-                files = {
-                    'document': (file.filename, file, 'application/octet-stream')
-                }
-                data = {
-                    'chat_id': user_id,
-                    'caption': caption
-                }
-                
-                response = requests.post(url, data=data, files=files, timeout=30)
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    if result.get('ok'):
-                        return jsonify({'success': True})
-                    else:
-                        return jsonify({'success': False, 'error': f'Telegram API ошибка: {result}'})
-                else:
-                    return jsonify({'success': False, 'error': f'HTTP ошибка {response.status_code}'})
+            if result.get('ok'):
+                return jsonify({'success': True})
+            else:
+                return jsonify({'success': False, 'error': f'Telegram API ошибка: {result}'})
         finally:
             # Удаляем временный файл
             try:
@@ -664,77 +548,79 @@ def send_broadcast_file():
         if not file:
             return jsonify({'success': False, 'error': 'Файл не выбран'})
         
-        from bot.user_bot_manager import bot_manager
-        
-        # Получаем бота текущего пользователя
-        user_bot = bot_manager.get_bot(current_user.id)
-        if not user_bot:
+        # Получаем токен бота текущего пользователя
+        bot_token = get_user_bot_token(current_user.id)
+        if not bot_token:
             return jsonify({'success': False, 'error': 'Ваш бот не настроен'})
         
-        # Сохраняем файл временно
-        import tempfile
-        import os
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[1]) as tmp_file:
-            file.save(tmp_file.name)
-            temp_path = tmp_file.name
+        # Сохраняем файл для воркера рассылок (он удалит его после завершения)
+        import uuid
+        from bot.broadcast_worker import BROADCAST_UPLOAD_FOLDER
+        from database import Database
         
-        try:
-            # Отправляем файл всем подписчикам (синхронно)
-            import requests
-            from database import Database
-            
-            db = Database()
-            users = db.get_users_for_bot(current_user.id)
-            
-            success_count = 0
-            failed_count = 0
-            
-            bot_token = user_bot.bot_token
-            url = f"https://api.telegram.org/bot{bot_token}/sendDocument"
-            
-            for user in users:
-                user_id = user['id']
-                try:
-                    with open(temp_path, 'rb') as file_obj:
-                        files = {
-                            'document': (file.filename, file_obj, 'application/octet-stream')
-                        }
-                        data = {
-                            'chat_id': user_id,
-                            'caption': caption
-                        }
-                        
-                        response = requests.post(url, data=data, files=files, timeout=30)
-                        
-                        if response.status_code == 200:
-                            result = response.json()
-                            if result.get('ok'):
-                                success_count += 1
-                            else:
-                                failed_count += 1
-                        else:
-                            failed_count += 1
-                            
-                except Exception as e:
-                    print(f"Ошибка отправки файла пользователю {user_id}: {e}")
-                    failed_count += 1
-            
-            return jsonify({
-                'success': True,
-                'message': f'Файл отправлен {success_count} подписчикам',
-                'success_count': success_count,
-                'failed_count': failed_count
-            })
-        finally:
-            # Удаляем временный файл
-            try:
-                os.unlink(temp_path)
-            except:
-                pass
+        os.makedirs(BROADCAST_UPLOAD_FOLDER, exist_ok=True)
+        document_path = os.path.join(BROADCAST_UPLOAD_FOLDER, uuid.uuid4().hex + os.path.splitext(file.filename)[1])
+        file.save(document_path)
+        
+        db = Database()
+        job_id = db.create_campaign(current_user.id, document_path=document_path,
+                                    filename=file.filename, caption=caption)
+        
+        return jsonify({
+            'success': True,
+            'message': f'Рассылка файла #{job_id} поставлена в очередь',
+            'job_id': job_id
+        })
             
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/api/broadcast/<int:job_id>')
+@login_required
+def broadcast_status(job_id):
+    """Статус рассылки из очереди"""
+    try:
+        from database import Database
+        db = Database()
+        job = db.get_campaign(job_id)
+        
+        if not job or str(job['user_id']) != str(current_user.id):
+            return jsonify({'success': False, 'error': 'Рассылка не найдена'}), 404
+        
+        return jsonify({
+            'success': True,
+            'job_id': job['id'],
+            'status': job['status'],
+            'sent_count': job['sent_count'],
+            'failed_count': job['failed_count'],
+            'attempts': job['attempts'],
+            'last_error': job['last_error']
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/broadcast/<int:job_id>/failed')
+@login_required
+def broadcast_failed(job_id):
+    """Получатели рассылки, которым сообщение не доставлено (из сводки кампании)"""
+    try:
+        from database import Database
+        db = Database()
+        job = db.get_campaign(job_id)
+        
+        if not job or str(job['user_id']) != str(current_user.id):
+            return jsonify({'success': False, 'error': 'Рассылка не найдена'}), 404
+        
+        failed = db.get_failed_recipient_ids(job_id)
+        return jsonify({
+            'success': True,
+            'job_id': job_id,
+            'failed_count': len(failed),
+            'user_ids': failed
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
 # ===== API ДЛЯ УПРАВЛЕНИЯ ПОЛЬЗОВАТЕЛЯМИ =====
 
 @app.route('/api/users', methods=['POST'])
@@ -843,14 +729,32 @@ def profile():
 @app.route('/api/bot/reload', methods=['POST'])
 @login_required
 def reload_bot():
-    """Перезагрузка бота пользователя"""
+    """Перезагрузка бота пользователя (выполняет процесс ботов)"""
     try:
-        from bot.user_bot_manager import bot_manager
+        from bot.control import send_command
+        
+        result = send_command(current_user.id, 'reload')
+        if result['ok']:
+            return jsonify({'success': True, 'message': result.get('message', 'Бот успешно перезагружен')})
+        else:
+            return jsonify({'success': False, 'error': result.get('error', 'Не удалось перезагрузить бота')})
+            
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/bot/status')
+@login_required
+def bot_status():
+    """Состояние бота пользователя в процессе ботов"""
+    try:
+        from bot.control import send_command
         
-        if bot_manager.reload_bot(current_user.id):
-            return jsonify({'success': True, 'message': 'Бот успешно перезагружен'})
+        result = send_command(current_user.id, 'status')
+        if result['ok']:
+            return jsonify({'success': True, 'running': result.get('running', False),
+                            'bot_username': result.get('bot_username')})
         else:
-            return jsonify({'success': False, 'error': 'Не удалось перезагрузить бота'})
+            return jsonify({'success': False, 'error': result.get('error')})
             
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
@@ -914,6 +818,7 @@ def initialize_bots():
                         user_settings.get('welcome_message', 'Добро пожаловать! 👋')  # Используем welcome_message для команды /start
                     )
         
+        bot_manager.start_control_server()
         print(f"Инициализировано {len(bot_manager.get_all_bots())} ботов")
         
     except Exception as e:
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Поток событий диалогов для веб-панели (Server-Sent Events)
+Отдельный асинхронный сервер держит открытые соединения вкладок /dialogs, не занимая sync-воркеры gunicorn.
+Новые сообщения читаются одним запросом по первичному ключу messages раз в STREAM_POLL_MS
+на все вкладки процесса (боты пишут из других процессов) и раздаются подписчикам нужного бота.
+Пока нет подписчиков, запросов к БД нет. Nginx проксирует /api/stream/ на STREAM_HOST:STREAM_PORT.
+"""
+
+import asyncio
+import json
+import logging
+from typing import Dict, Optional, Set
+from urllib.parse import parse_qs
+
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+from config import Config
+from bot.webhook_server import read_request
+
+logger = logging.getLogger(__name__)
+
+# Срок действия токена потока, выданного странице /dialogs (секунды)
+TOKEN_MAX_AGE = 24 * 3600
+# Комментарий-пинг, чтобы прокси не закрывал простаивающее соединение (секунды)
+PING_INTERVAL = 15
+# Очередь событий одной вкладки; при переполнении вкладка получает resync
+QUEUE_SIZE = 100
+# Сколько новых сообщений читать за один запрос
+BATCH_SIZE = 500
+
+def _serializer() -> URLSafeTimedSerializer:
+    return URLSafeTimedSerializer(Config.SECRET_KEY, salt='dialog-stream')
+
+def stream_token(bot_user_id: int) -> str:
+    """Подписанный токен для подключения страницы /dialogs к потоку своего бота"""
+    return _serializer().dumps(bot_user_id)
+
+def stream_url(bot_user_id: int) -> str:
+    return f"{Config.STREAM_URL}?token={stream_token(bot_user_id)}"
+
+def _bot_user_id_from_token(token: str) -> Optional[int]:
+    try:
+        return int(_serializer().loads(token, max_age=TOKEN_MAX_AGE))
+    except (BadSignature, TypeError, ValueError):
+        return None
+
+class DialogStreamServer:
+    """SSE-сервер: /api/stream/dialogs?token=..."""
+
+    def __init__(self, host: str = None, port: int = None, poll_ms: int = None):
+        from database import AsyncDatabase
+
+        self.host = host or Config.STREAM_HOST
+        self.port = port or Config.STREAM_PORT
+        self.poll_interval = (poll_ms or Config.STREAM_POLL_MS) / 1000
+        self.db = AsyncDatabase()
+        self.subscribers: Dict[int, Set[asyncio.Queue]] = {}
+        self._has_subscribers = asyncio.Event()
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._connections: Set[asyncio.Task] = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self._dispatcher = asyncio.create_task(self._dispatch_messages())
+        logger.info(f"📡 Поток диалогов слушает {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+        if self._server:
+            self._server.close()
+            self._server = None
+        # Открытые потоки вкладок сами не завершаются: закрываем их
+        for task in list(self._connections):
+            task.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+
+    async def serve_forever(self):
+        await self.start()
+        await self._server.serve_forever()
+
+    def publish(self, bot_user_id: int, event: Dict):
+        """Передать событие всем вкладкам бота"""
+        for queue in self.subscribers.get(bot_user_id, ()):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Вкладка не успевает читать: сбрасываем очередь, она перезагрузит открытый диалог
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait({'type': 'resync'})
+
+    async def _dispatch_messages(self):
+        """Чтение новых сообщений из БД, пока есть подписчики"""
+        last_id = await self.db.get_last_message_id()
+        while True:
+            if not self.subscribers:
+                self._has_subscribers.clear()
+                await self._has_subscribers.wait()
+                # Пока никто не слушал, события не нужны: начинаем с текущего конца
+                last_id = await self.db.get_last_message_id()
+            try:
+                messages = await self.db.get_messages_after(last_id, BATCH_SIZE)
+                for message in messages:
+                    last_id = message['id']
+                    if message['bot_user_id'] in self.subscribers:
+                        self.publish(message['bot_user_id'], {'type': 'message', **message})
+                if len(messages) == BATCH_SIZE:
+                    continue
+            except Exception as e:
+                logger.error(f"❌ Ошибка чтения новых сообщений для потока диалогов: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        queue: Optional[asyncio.Queue] = None
+        bot_user_id = None
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            request = await read_request(reader)
+            if request is None:
+                return
+            method, path, _, _ = request
+            route, _, query = path.partition('?')
+            token = (parse_qs(query).get('token') or [''])[0]
+            bot_user_id = _bot_user_id_from_token(token) if method == 'GET' else None
+            if route.rstrip('/') != Config.STREAM_URL.rstrip('/') or bot_user_id is None:
+                writer.write(b"HTTP/1.1 403 Forbidden\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                await writer.drain()
+                return
+
+            queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+            self.subscribers.setdefault(bot_user_id, set()).add(queue)
+            self._has_subscribers.set()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/event-stream\r\n"
+                b"Cache-Control: no-cache\r\n"
+                b"X-Accel-Buffering: no\r\n"
+                b"Connection: keep-alive\r\n\r\n"
+                b"retry: 3000\n\n"
+            )
+            await writer.drain()
+
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), PING_INTERVAL)
+                except asyncio.TimeoutError:
+                    writer.write(b": ping\n\n")
+                else:
+                    data = json.dumps(event, ensure_ascii=False)
+                    writer.write(f"event: {event['type']}\ndata: {data}\n\n".encode())
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            # Остановка сервера; отмену не пробрасываем, иначе asyncio.streams (3.11) пишет её в лог как ошибку
+            pass
+        finally:
+            if queue is not None:
+                queues = self.subscribers.get(bot_user_id)
+                if queues is not None:
+                    queues.discard(queue)
+                    if not queues:
+                        self.subscribers.pop(bot_user_id, None)
+            self._connections.discard(task)
+            writer.close()